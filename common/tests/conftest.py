@@ -0,0 +1,7 @@
+import sys
+from pathlib import Path
+
+BASE_DIR = Path(__file__).resolve().parent.parent.parent
+working_dir = str(BASE_DIR)
+if working_dir not in sys.path:
+    sys.path.append(working_dir)
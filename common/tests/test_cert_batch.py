@@ -0,0 +1,92 @@
+import io
+import os
+import subprocess
+import zipfile
+
+import pytest
+
+from common.utils.bp_ovpn.cert_batch import OPENSSL, MAX_REQ_SIZE, validate_req, read_reqs, make_req_dir
+
+DEVICE_UUID = "80b7caa2-b998-11ed-b796-c400ad53ffa4"
+DEVICE_PASSWORD = "0123456789abcdef"
+
+
+@pytest.fixture(autouse=True)
+def print_before_test():
+    print()
+
+
+@pytest.fixture(scope="module")
+def device_cert(tmp_path_factory):
+    """
+    PEM of a self-signed device cert made by openssl
+    """
+    if not os.path.exists(OPENSSL):
+        pytest.skip("openssl is not installed")
+    path = tmp_path_factory.mktemp("req")
+    subprocess.run(
+        [OPENSSL, "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-keyout", str(path / "key.pem"), "-out", str(path / "cert.pem"),
+         "-days", "30", "-subj", "/CN=" + DEVICE_UUID],
+        check=True, capture_output=True,
+    )
+    return (path / "cert.pem").read_text()
+
+
+def make_req(device_cert, device_uuid=DEVICE_UUID, password=DEVICE_PASSWORD):
+    return "{}\n{}\n{}".format(device_uuid, password, device_cert).encode("utf-8")
+
+
+def test_validate_req_ok(device_cert):
+    """
+    A well formed req: its device uuid and no error
+    """
+    assert validate_req(make_req(device_cert)) == (DEVICE_UUID, None)
+
+
+def test_validate_req_malformed_cert(device_cert):
+    """
+    A cert openssl can not read
+    """
+    lines = device_cert.split("\n")
+    broken = "\n".join(lines[:5] + ["!!!!"] + lines[6:])
+    assert validate_req(make_req(broken)) == (None, "DEVICE_CERT is malformed")
+
+
+def test_validate_req_header_checks():
+    """
+    The checks before openssl: text, line feeds, uuid type 1, password length
+    """
+    padding = "\n".join(["x"] * 14)
+    assert validate_req(b"\xff\xfe\x00") == (None, "not a text file")
+    assert validate_req(b"one\ntwo\n") == (None, "NOT ENOUGH LINE FEEDS")
+    # a random (type 4) uuid
+    assert validate_req("{}\n{}\n{}".format("3f2b8c1e-0a4d-4c2e-9b7f-1d2e3f4a5b6c", DEVICE_PASSWORD, padding).encode()) == \
+        (None, "DEVICE_UUID is malformed")
+    assert validate_req("{}\n{}\n{}".format(DEVICE_UUID, "short", padding).encode()) == \
+        (None, "DEVICE_PASSWORD length less than 12 chars")
+
+
+def test_read_reqs_zip_and_plain():
+    """
+    The .req entries of a zip, the too big ones as None, a plain .req file as is
+    """
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, "w") as zf:
+        zf.writestr("a.req", "a")
+        zf.writestr("dir/", "")
+        zf.writestr("notes.txt", "skipped")
+        zf.writestr("big.req", "x" * (MAX_REQ_SIZE + 1))
+    buf.seek(0)
+    assert list(read_reqs("batch.ZIP", buf)) == [("a.req", b"a"), ("big.req", None)]
+    assert list(read_reqs("b.req", io.BytesIO(b"b"))) == [("b.req", b"b")]
+    assert list(read_reqs("c.req", io.BytesIO(b"c" * (MAX_REQ_SIZE + 1)))) == [("c.req", None)]
+
+
+def test_make_req_dir(tmp_path):
+    """
+    Each job gets an empty req dir of its own, outside of the shared reqs dir
+    """
+    first, second = make_req_dir(str(tmp_path)), make_req_dir(str(tmp_path))
+    assert first != second
+    assert os.path.dirname(first) == str(tmp_path / "reqs-jobs")
+    assert os.listdir(first) == []
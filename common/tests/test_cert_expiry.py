@@ -0,0 +1,95 @@
+import base64
+import datetime
+import os
+import subprocess
+
+import pytest
+
+from common.utils.bp_ovpn.cert_expiry import read_not_after, _read_chunk
+
+OPENSSL = "/usr/bin/openssl"
+
+
+@pytest.fixture(autouse=True)
+def print_before_test():
+    print()
+
+
+def der(tag, content):
+    """ One DER element, long form length if needed. """
+    if len(content) < 0x80:
+        length = bytes([len(content)])
+    else:
+        n = (len(content).bit_length() + 7) // 8
+        length = bytes([0x80 | n]) + len(content).to_bytes(n, "big")
+    return bytes([tag]) + length + content
+
+
+def fake_cert(not_after, version=True, issuer_size=10):
+    """ Certificate with only the fields walked by read_not_after. """
+    tbs = b""
+    if version:
+        tbs += der(0xa0, der(0x02, b"\x02"))
+    tbs += der(0x02, b"\x01\x23")
+    tbs += der(0x30, der(0x06, b"\x2a\x86\x48"))
+    tbs += der(0x30, b"\x00" * issuer_size)
+    tbs += der(0x30, der(0x17, b"200101000000Z") + not_after)
+    tbs += der(0x30, b"")
+    return der(0x30, der(0x30, tbs) + der(0x30, b"") + der(0x03, b"\x00"))
+
+
+def test_read_not_after_utc_time():
+    """
+    UTCTime notAfter of a DER cert, long form lengths
+    """
+    data = fake_cert(der(0x17, b"361231235959Z"), issuer_size=300)
+    assert read_not_after(data) == datetime.datetime(2036, 12, 31, 23, 59, 59, tzinfo=datetime.timezone.utc)
+
+
+def test_read_not_after_utc_time_last_century():
+    """
+    UTCTime years 50-99 are 19xx, the version is optional
+    """
+    data = fake_cert(der(0x17, b"991231000000Z"), version=False)
+    assert read_not_after(data) == datetime.datetime(1999, 12, 31, tzinfo=datetime.timezone.utc)
+
+
+def test_read_not_after_generalized_time_pem():
+    """
+    GeneralizedTime notAfter of a PEM cert with text before it
+    """
+    data = fake_cert(der(0x18, b"20600101120000Z"))
+    pem = b"Certificate:\n    Data: ...\n-----BEGIN CERTIFICATE-----\n"
+    pem += b"\n".join(base64.b64encode(data)[i:i + 64] for i in range(0, len(base64.b64encode(data)), 64))
+    pem += b"\n-----END CERTIFICATE-----\n"
+    assert read_not_after(pem) == datetime.datetime(2060, 1, 1, 12, tzinfo=datetime.timezone.utc)
+
+
+def test_read_not_after_bad_time_tag():
+    """
+    Not a time where the notAfter is expected
+    """
+    with pytest.raises(ValueError):
+        read_not_after(fake_cert(der(0x04, b"361231235959Z")))
+
+
+@pytest.mark.skipif(not os.path.exists(OPENSSL), reason="openssl is not installed")
+def test_read_not_after_openssl_cert(tmp_path):
+    """
+    Same date as openssl for a real cert, a broken file is reported as None
+    """
+    crt = tmp_path / "boss-1.crt"
+    subprocess.run(
+        [OPENSSL, "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-keyout", str(tmp_path / "key.pem"), "-out", str(crt),
+         "-days", "30", "-subj", "/CN=boss-1"],
+        check=True, capture_output=True,
+    )
+    enddate = subprocess.run([OPENSSL, "x509", "-noout", "-enddate", "-in", str(crt)], check=True, capture_output=True, text=True)
+    expected = datetime.datetime.strptime(enddate.stdout.strip().split("=", 1)[1], "%b %d %H:%M:%S %Y GMT")
+    broken = tmp_path / "broken.crt"
+    broken.write_bytes(b"-----BEGIN CERTIFICATE-----\n!!!\n-----END CERTIFICATE-----\n")
+
+    results = dict(_read_chunk([str(crt), str(broken), str(tmp_path / "missing.crt")]))
+    assert results[str(crt)] == expected.replace(tzinfo=datetime.timezone.utc).isoformat()
+    assert results[str(broken)] is None
+    assert results[str(tmp_path / "missing.crt")] is None
@@ -0,0 +1,44 @@
+import pytest
+
+from common.utils.bp_ovpn.datatables import parse_datatables_args
+
+
+@pytest.fixture(autouse=True)
+def print_before_test():
+    print()
+
+
+def test_parse_datatables_args():
+    """
+    Paging, search and the orders in the order of their index
+    """
+    args = {
+        "draw": "3", "start": "40", "length": "20", "search[value]": "  boss  ", "search[regex]": "false",
+        "order[1][column]": "2", "order[1][dir]": "asc",
+        "order[0][column]": "1", "order[0][dir]": "desc",
+        "columns[0][data]": "",
+    }
+    assert parse_datatables_args(args) == {
+        "draw": 3, "start": 40, "length": 20, "search": "boss", "order": [(1, "desc"), (2, "asc")],
+    }
+
+
+def test_parse_datatables_args_length_capped():
+    """
+    Missing, invalid and too long lengths are served max_length rows, 'All' (-1) every row
+    """
+    assert parse_datatables_args({})["length"] == 1000
+    assert parse_datatables_args({"length": "-1"})["length"] == -1
+    assert parse_datatables_args({"length": "-5"})["length"] == 1000
+    assert parse_datatables_args({"length": "0"}, max_length=100)["length"] == 100
+    assert parse_datatables_args({"length": "5000"}, max_length=500)["length"] == 500
+    assert parse_datatables_args({"length": "not a number"}, max_length=100)["length"] == 100
+
+
+def test_parse_datatables_args_garbage():
+    """
+    Defaults for the values a client can forge: negative start, unknown direction, bad column
+    """
+    args = {"draw": "x", "start": "-10", "search[value]": None, "order[0][column]": "x", "order[0][dir]": "desc",
+            "order[1][column]": "3", "order[1][dir]": "sideways"}
+    assert parse_datatables_args(args) == {"draw": 0, "start": 0, "length": 1000, "search": "", "order": [(3, "asc")]}
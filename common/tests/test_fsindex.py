@@ -0,0 +1,36 @@
+import os
+import sys
+
+import pytest
+
+from common.utils.bp_ovpn.fsindex import DirIndex, Inotify
+
+
+@pytest.fixture(autouse=True)
+def print_before_test():
+    print()
+
+
+@pytest.mark.skipif(not sys.platform.startswith("linux"), reason="inotify is only available on linux")
+def test_watches_share_one_inotify_instance(tmp_path):
+    """
+    The directories are watched by one inotify fd, a rewrite in place is reported to its index only
+    """
+    first, second = tmp_path / "certs", tmp_path / "reqs"
+    os.makedirs(first)
+    os.makedirs(second)
+    (first / "boss-1.crt").write_text("x")
+    indexes = [DirIndex(first, (".crt",)), DirIndex(second, (".req",))]
+    assert all(index.refresh() for index in indexes)
+    assert indexes[0]._watch.wd != indexes[1]._watch.wd
+    assert all(index._watch in Inotify._watches[index._watch.wd] for index in indexes)
+
+    # the same size and the same directory mtime tick, only inotify sees it
+    (first / "boss-1.crt").write_text("y")
+    assert indexes[0]._watch.changed()
+    assert not indexes[1]._watch.changed()
+
+    wds = [index._watch.wd for index in indexes]
+    for index in indexes:
+        index._close_watch()
+    assert not any(wd in Inotify._watches for wd in wds)
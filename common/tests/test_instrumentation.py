@@ -0,0 +1,47 @@
+import json
+import os
+import threading
+
+import pytest
+
+from config import ProductionConfig
+from common.utils.bp_ovpn.instrumentation import RequestMetrics
+
+
+@pytest.fixture(autouse=True)
+def print_before_test():
+    print()
+
+
+def test_concurrent_flushes_one_writer(tmp_path, monkeypatch):
+    """
+    The request threads of one interval flush once, the snapshot is one complete file
+    """
+    monkeypatch.setattr(ProductionConfig, "OVPN_INSTRUMENTATION_DIR", str(tmp_path))
+    monkeypatch.setattr(RequestMetrics, "_pid", None)
+    monkeypatch.setattr(RequestMetrics, "_flushed", 0.0)
+    monkeypatch.setattr(RequestMetrics, "_histograms", {})
+    monkeypatch.setattr(RequestMetrics, "_requests", {})
+    writes = []
+    write = RequestMetrics._write.__func__
+    monkeypatch.setattr(RequestMetrics, "_write", classmethod(lambda cls: writes.append(1) or write(cls)))
+
+    barrier = threading.Barrier(16)
+
+    def request():
+        barrier.wait()
+        RequestMetrics.observe("ovpn.servers", "GET", 200, 0.01, 0.002, 3)
+
+    threads = [threading.Thread(target=request) for _ in range(16)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(writes) == 1
+
+    RequestMetrics.flush()
+    assert len(writes) == 2
+    names = os.listdir(tmp_path)
+    assert len(names) == 1 and names[0].startswith("{}-".format(os.getpid())) and names[0].endswith(".json")
+    requests = json.loads((tmp_path / names[0]).read_text())["requests"]
+    assert ["ovpn.servers", "GET", "200", 16] in requests
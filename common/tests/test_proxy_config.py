@@ -0,0 +1,142 @@
+import os
+
+import pytest
+
+from common.utils.bp_ovpn import proxy_config
+from common.utils.bp_ovpn.proxy_config import NginxMapBuilder, ProxyConfigIndex, ProxyConfigTemplate
+
+
+@pytest.fixture(autouse=True)
+def print_before_test():
+    print()
+
+
+@pytest.fixture(autouse=True)
+def clear_index_cache():
+    """
+    The indexes are cached per process by config file path
+    """
+    proxy_config._indexes.clear()
+    yield
+    proxy_config._indexes.clear()
+
+
+APACHE_CONFIG = """
+<Location "/RVRP@1111111111111-0x0a010101@">
+    ProxyPass "http://10.1.1.1:80/" retry=0
+    RequestHeader set X-Remote 192.168.0.254
+</Location>
+
+<Location "/RVRP@2222222222222-0x0a01010a@">
+    ProxyPass "http://10.1.1.10:80/" retry=0
+    RequestHeader set X-Remote 192.168.0.254
+</Location>
+"""
+
+
+def test_index_parses_apache_blocks(tmp_path):
+    """
+    One entry per client ip, whole addresses only, the IP_REMOTE of every block is excluded
+    """
+    config = tmp_path / "reverse_proxy_local.conf"
+    config.write_text(APACHE_CONFIG)
+    index = ProxyConfigIndex(config, exclude=("192.168.0.254",))
+    entries = index.entries()
+    assert sorted(entries) == ["10.1.1.1", "10.1.1.10"]
+    assert "http://10.1.1.1:80/" in index.find("10.1.1.1")
+    assert "http://10.1.1.10:80/" in index.find("10.1.1.10")
+    assert index.find("10.1.1.1").startswith("<Location")
+    assert index.find("10.1.1.2") is None
+    # the sidecar index is written for the next processes
+    assert (tmp_path / "reverse_proxy_local.conf.idx").exists()
+
+
+def test_index_append_and_stale_sidecar(tmp_path):
+    """
+    An appended block is found by the index, a stale sidecar is made again from the config file
+    """
+    config = tmp_path / "reverse_proxy_local.conf"
+    config.write_text(APACHE_CONFIG)
+    index = ProxyConfigIndex(config, exclude=("192.168.0.254",))
+    index.entries()
+    index.append("10.1.1.3", '<Location "/RVRP@3333333333333-0x0a010103@">\n    ProxyPass "http://10.1.1.3:80/"\n</Location>')
+    assert "http://10.1.1.3:80/" in index.find("10.1.1.3")
+
+    # another writer replaced the config file without updating the index
+    config.write_text('<Location "/x">\n    ProxyPass "http://10.2.2.2:80/"\n</Location>\n')
+    proxy_config._indexes.clear()
+    assert sorted(index.entries()) == ["10.2.2.2"]
+    assert index.find("10.1.1.3") is None
+
+
+def test_template_render():
+    """
+    The first block of the template, every placeholder replaced
+    """
+    template = ProxyConfigTemplate("__PROXY_PREFIX__@__IP_CODED__@ -> __IP_LOCALE__:__IP_PORT__ via __IP_REMOTE__\n\nignored")
+    values = {
+        "__PROXY_PREFIX__": "RVRP", "__IP_CODED__": "1-0x0a010101", "__IP_LOCALE__": "10.1.1.1",
+        "__IP_PORT__": "80", "__IP_REMOTE__": "192.168.0.254",
+    }
+    assert template.render(values) == "RVRP@1-0x0a010101@ -> 10.1.1.1:80 via 192.168.0.254"
+
+
+class FakeCursor(object):
+    """ The cursor of ProxyConfigBuilder.build, the rows of every table. """
+
+    def __init__(self, rows):
+        self.rows = rows
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def execute(self, sql, params=None):
+        pass
+
+    def fetchall(self):
+        return list(self.rows)
+
+
+class FakeConnection(object):
+    def __init__(self, rows):
+        self.rows = rows
+        self.committed = False
+
+    def cursor(self):
+        return FakeCursor(self.rows)
+
+    def commit(self):
+        self.committed = True
+
+    def rollback(self):
+        pass
+
+
+def test_nginx_map_build_and_index(tmp_path):
+    """
+    The map of the clients' backends and its index, the same when parsed from the map file
+    """
+    builder = NginxMapBuilder(str(tmp_path), "nginx", "RVRP", "192.168.0.254", "8080")
+    assert not builder.prepare()
+    os.makedirs(tmp_path / "nginx")
+    assert builder.prepare()
+    assert builder.config_file.read_text() == ""
+
+    conn = FakeConnection([("boss-1", "10.1.1.1", "1111111111111-0x0a010101"), ("boss-2", "10.1.1.10", "2222222222222-0x0a01010a")])
+    result = builder.build(conn, tables=("ovpnclients",))
+    assert result == {"clients": 2, "backfilled": 0, "changed": True}
+    assert conn.committed
+    assert builder.config_file.read_text() == (
+        '\n"RVRP@1111111111111-0x0a010101@" 10.1.1.1:8080;\n'
+        '\n"RVRP@2222222222222-0x0a01010a@" 10.1.1.10:8080;\n'
+    )
+    built = dict(builder.index.entries())
+    assert builder.index.find("10.1.1.10") == '"RVRP@2222222222222-0x0a01010a@" 10.1.1.10:8080;'
+
+    # the entries of the builder are those of a parse of the map file
+    proxy_config._indexes.clear()
+    os.unlink(builder.index.index_file)
+    assert ProxyConfigIndex(builder.config_file).entries() == built
@@ -0,0 +1,123 @@
+import json
+import time
+
+import pytest
+
+from config import ProductionConfig
+from common.utils.bp_ovpn import proxy_reload
+from common.utils.bp_ovpn.proxy_reload import ProxyReloader
+
+
+@pytest.fixture(autouse=True)
+def print_before_test():
+    print()
+
+
+@pytest.fixture
+def reloader(tmp_path, monkeypatch):
+    """
+    ProxyReloader with its state in tmp_path and the reload commands recorded instead of run
+    """
+    monkeypatch.setattr(ProductionConfig, "OVPN_PROXY_RELOAD_STATE", str(tmp_path / "run" / "proxy_reload.json"))
+    runs = []
+
+    def run_commands():
+        runs.append(1)
+        return True, "Syntax OK\n"
+
+    monkeypatch.setattr(ProxyReloader, "_run_commands", classmethod(lambda cls: run_commands()))
+    monkeypatch.setattr(proxy_reload, "publish_proxy_status", lambda status: None)
+    return runs
+
+
+def write_state(state):
+    with open(ProductionConfig.OVPN_PROXY_RELOAD_STATE, "w") as fp:
+        json.dump(state, fp)
+
+
+def test_reload_started_between_first_and_last_change(reloader):
+    """
+    Another worker reloaded after the first change of this process but before its last one:
+    the last change is not covered, this process must reload
+    """
+    with proxy_reload._flock(ProductionConfig.OVPN_PROXY_RELOAD_STATE + ".lock"):
+        pass
+    # changes of this process at 100 and 110, the other worker reloaded at 105
+    write_state({"requested": 110, "started": 105, "finished": 106, "ok": True})
+    ProxyReloader._reload(110, ["a", "b"])
+    assert reloader == [1]
+    state = ProxyReloader.status()
+    assert state["started"] > 110
+    assert state["ok"] is True
+    assert state["reasons"] == ["a", "b"]
+
+
+def test_reload_started_after_last_change_is_skipped(reloader):
+    """
+    A reload started after the last change of this process already covers it
+    """
+    with proxy_reload._flock(ProductionConfig.OVPN_PROXY_RELOAD_STATE + ".lock"):
+        pass
+    write_state({"requested": 110, "started": 115, "finished": 116, "ok": True})
+    ProxyReloader._reload(110, ["a"])
+    assert reloader == []
+    assert ProxyReloader.status()["started"] == 115
+
+
+def test_state_dir_is_created_private(reloader, tmp_path):
+    """
+    The runtime dir of the state is created on the first lock, not world writable
+    """
+    with proxy_reload._flock(ProductionConfig.OVPN_PROXY_RELOAD_STATE + ".lock"):
+        pass
+    assert (tmp_path / "run").stat().st_mode & 0o002 == 0
+
+
+@pytest.fixture
+def debounced(reloader, monkeypatch):
+    """
+    Short delays, the (last, reasons) of every reload of the background thread
+    """
+    monkeypatch.setattr(ProductionConfig, "OVPN_PROXY_RELOAD_DELAY", 0.3)
+    monkeypatch.setattr(ProductionConfig, "OVPN_PROXY_RELOAD_MAX_DELAY", 0.8)
+    reloads = []
+    monkeypatch.setattr(ProxyReloader, "_reload", classmethod(lambda cls, last, reasons: reloads.append((last, reasons))))
+    return reloads
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.05)
+    return condition()
+
+
+def test_debounce_burst_in_one_reload(debounced):
+    """
+    A burst of requests ends in one reload with all the reasons, after the delay
+    """
+    for reason in ("a", "b", "c"):
+        state = ProxyReloader.request(reason)
+        time.sleep(0.05)
+    assert state["pending"] is True
+    assert debounced == []
+    assert wait_for(lambda: len(debounced) == 1)
+    last, reasons = debounced[0]
+    assert reasons == ["a", "b", "c"]
+    assert last == ProxyReloader.status()["requested"]
+    time.sleep(0.5)
+    assert len(debounced) == 1
+
+
+def test_debounce_max_delay(debounced):
+    """
+    Requests that never stop are reloaded after the max delay since the first one
+    """
+    started, requests = time.monotonic(), 0
+    while time.monotonic() - started < 1.5:
+        ProxyReloader.request("x")
+        requests += 1
+        time.sleep(0.1)
+    # at least one reload before the requests stopped
+    assert len(debounced) >= 1
+    assert wait_for(lambda: sum(len(reasons) for _, reasons in debounced) == requests)
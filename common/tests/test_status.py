@@ -0,0 +1,80 @@
+import datetime
+
+import pytest
+
+from common.utils.bp_ovpn.status import parse_status_lines
+from common.utils.bp_ovpn.status_file import OvpnStatusFile
+
+
+@pytest.fixture(autouse=True)
+def print_before_test():
+    print()
+
+
+STATUS_V3 = [
+    "TITLE\tOpenVPN 2.5.9 x86_64-pc-linux-gnu",
+    "TIME\t2026-10-18 08:00:00\t1792310400",
+    "HEADER\tCLIENT_LIST\tCommon Name\tReal Address\tVirtual Address\tVirtual IPv6 Address\tBytes Received\tBytes Sent"
+    "\tConnected Since\tConnected Since (time_t)\tUsername\tClient ID\tPeer ID\tData Channel Cipher",
+    "CLIENT_LIST\tboss-1\t1.2.3.4:50000\t10.168.0.2\t\t1000\t2000\t2026-10-18 07:00:00\t1792306800\tUNDEF\t5\t0\tAES-256-GCM",
+    "CLIENT_LIST\tUNDEF\t1.2.3.5:50001\t\t\t10\t20\t2026-10-18 07:59:00\t1792310340\tUNDEF\t6\t1\tAES-256-GCM",
+    "HEADER\tROUTING_TABLE\tVirtual Address\tCommon Name\tReal Address\tLast Ref\tLast Ref (time_t)",
+    "ROUTING_TABLE\t10.168.0.2\tboss-1\t1.2.3.4:50000\t2026-10-18 07:59:59\t1792310399",
+    "GLOBAL_STATS\tMax bcast/mcast queue length\t0",
+    "END",
+    "CLIENT_LIST\tafter-end\t1.2.3.6:50002\t10.168.0.3\t\t0\t0\t\t\tUNDEF\t7\t2\t",
+]
+
+
+def test_parse_status_v3():
+    """
+    Tab separated status 3: the clients by cn, the routes by virtual address, the time
+    """
+    status = parse_status_lines(STATUS_V3)
+    assert list(status["clients"]) == ["boss-1"]
+    client = status["clients"]["boss-1"]
+    assert client["real_address"] == "1.2.3.4:50000"
+    assert client["virtual_address"] == "10.168.0.2"
+    assert client["bytes_received"] == 1000
+    assert client["bytes_sent"] == 2000
+    assert client["connected_since"] == datetime.datetime(2026, 10, 18, 7, 0, tzinfo=datetime.timezone.utc)
+    assert client["client_id"] == "5"
+    assert status["routes"]["10.168.0.2"]["cn"] == "boss-1"
+    assert status["routes"]["10.168.0.2"]["last_ref"] == datetime.datetime(2026, 10, 18, 7, 59, 59, tzinfo=datetime.timezone.utc)
+    assert status["updated"] == datetime.datetime(2026, 10, 18, 8, 0, tzinfo=datetime.timezone.utc)
+
+
+def test_parse_status_v2_without_headers():
+    """
+    Comma separated status 2 with the line endings of a file, the default headers apply
+    """
+    lines = [
+        "CLIENT_LIST,boss-2,5.6.7.8:1194,10.168.0.9,,42,43,2026-10-18 07:00:00,1792306800,UNDEF,9,3,AES-256-GCM\r\n",
+        "\n",
+        "ROUTING_TABLE,10.168.0.9,boss-2,5.6.7.8:1194,2026-10-18 07:00:00,not-a-time\n",
+    ]
+    status = parse_status_lines(lines)
+    assert status["clients"]["boss-2"]["bytes_received"] == 42
+    assert status["clients"]["boss-2"]["client_id"] == "9"
+    assert status["routes"]["10.168.0.9"]["last_ref"] is None
+    assert status["updated"] is None
+
+
+def test_parse_status_empty():
+    """
+    No lines: no clients, no routes
+    """
+    assert parse_status_lines([]) == {"clients": {}, "routes": {}, "updated": None}
+
+
+def test_status_file_requires_end(tmp_path):
+    """
+    A status file caught before its END line is not accepted, the complete one is parsed once
+    """
+    path = tmp_path / "openvpn-status.log"
+    path.write_text("\n".join(STATUS_V3[:5]) + "\n")
+    status_file = OvpnStatusFile(str(path))
+    assert status_file.read() is None
+    path.write_text("\n".join(STATUS_V3[:9]) + "\n")
+    assert status_file.read() == {"boss-1": ("10.168.0.2", datetime.datetime(2026, 10, 18, 7, 0, tzinfo=datetime.timezone.utc), "1.2.3.4:50000")}
+    assert status_file.read() is None
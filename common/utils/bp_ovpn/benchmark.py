@@ -0,0 +1,281 @@
+"""
+    Benchmark of the ovpn blueprint endpoints at fleet sizes, run by flask benchmark.
+
+    The test data of prepare-data is seeded at each clients size and a cert tree of the
+    first test server at each files size, then every endpoint is requested through the
+    Flask test client of the running app, logged in as super. The latency percentiles and
+    the SQL statements per request (counted on the engine, in the benchmark thread only)
+    are written to a JSON report; two reports of different commits can be compared.
+"""
+import datetime
+import json
+import math
+import os
+import platform
+import subprocess
+import threading
+import time
+
+from sqlalchemy import event, select
+
+from myproject.context import logger, engine, DBSession as dbsession
+from orm.ovpn import OfUser, OvpnServers
+from .seed import TestDataSeeder, remove_tree
+from .sysconfig import SystemConfig
+
+BENCH_USER = "super"
+# the cert files of the benchmark, by sysconfig dir of the server certs dir
+FILE_KINDS = (("DIR_REQS", ".req"), ("DIR_PLAIN_CERTS", ".conf"), ("DIR_ENCRYPT_CERTS", ".p7mb64"), ("DIR_ZIP_CERTS", ".zip"))
+# requests before the measured ones, the first is reported as cold
+WARMUP_REQUESTS = 3
+PAGE_LENGTH = 100
+
+
+def _datatables_form(action, start=0, search="", column=0, direction="desc") -> dict:
+    return {
+        "draw": "1", "start": str(start), "length": str(PAGE_LENGTH), "search[value]": search, "search[regex]": "false",
+        "order[0][column]": str(column), "order[0][dir]": direction, "action": action,
+    }
+
+
+def _percentile(values, pct) -> float:
+    """ Nearest rank percentile of sorted values. """
+    if not values:
+        return 0.0
+    rank = max(math.ceil(pct / 100.0 * len(values)) - 1, 0)
+    return values[min(rank, len(values) - 1)]
+
+
+class _QueryCounter(object):
+    """ SQL statements executed by the engine in one thread. """
+
+    def __init__(self):
+        self.thread = threading.get_ident()
+        self.count = 0
+
+    def __call__(self, conn, cursor, statement, parameters, context, executemany):
+        if threading.get_ident() == self.thread:
+            self.count += 1
+
+
+class EndpointBenchmark(object):
+    """ Latency and queries per request of the ovpn endpoints at several sizes.
+
+    Args:
+        app (Flask): the app, e.g. current_app._get_current_object()
+        requests (int, optional): measured requests per endpoint and variant
+        servers (int, optional): test servers the clients are spread over, the first one is requested
+    """
+
+    def __init__(self, app, requests=50, servers=1):
+        self.app = app
+        self.requests = requests
+        self.servers = servers
+        self.results = []
+
+    def __repr__(self) -> str:
+        return f"EndpointBenchmark(requests={self.requests!r}, servers={self.servers!r})"
+
+    def run(self, clients_sizes=(), files_sizes=(), keep=False) -> dict:
+        """ Seed every size, request all the endpoints, tear the test data down.
+
+        Args:
+            clients_sizes (list): test clients of each round of the DB endpoints
+            files_sizes (list): cert files per kind of each round of the file list endpoints
+            keep (bool, optional): keep the test data of the last size
+
+        Returns:
+            dict: the report, {'meta', 'results'}
+        """
+        client = self._login()
+        # the delete only needs the names of the servers, the same for every size
+        seeder = TestDataSeeder(users=0, servers=self.servers, clients=0)
+        try:
+            for size in clients_sizes:
+                seeder.delete()
+                TestDataSeeder(users=0, servers=self.servers, clients=size).add()
+                self._bench_db_endpoints(client, size)
+            if files_sizes:
+                if not clients_sizes:
+                    seeder.delete()
+                    seeder.add()
+                for size in files_sizes:
+                    self._bench_file_endpoints(client, size)
+        finally:
+            if not keep:
+                self._remove_files()
+                seeder.delete()
+        return self.report(clients_sizes, files_sizes)
+
+    def report(self, clients_sizes, files_sizes) -> dict:
+        try:
+            commit = subprocess.run(
+                ["git", "rev-parse", "HEAD"], capture_output=True, text=True, cwd=self.app.config["BASE_DIR"], timeout=10
+            ).stdout.strip()
+        except (OSError, subprocess.TimeoutExpired):
+            commit = ""
+        return {
+            "meta": {
+                "commit": commit,
+                "time": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+                "python": platform.python_version(),
+                "host": platform.node(),
+                "requests": self.requests,
+                "servers": self.servers,
+                "clients_sizes": list(clients_sizes),
+                "files_sizes": list(files_sizes),
+            },
+            "results": self.results,
+        }
+
+    def _login(self):
+        with self.app.app_context():
+            user = dbsession.scalar(select(OfUser).where(OfUser.username == BENCH_USER))
+            if user is None:
+                raise RuntimeError("The benchmark user {} does not exist".format(BENCH_USER))
+            user_id, name, group, page_size = user.id, user.name, user.group.name, user.page_size
+            dbsession.remove()
+        client = self.app.test_client()
+        with client.session_transaction() as sess:
+            sess["user_id"] = user_id
+            sess["name"] = name
+            sess["username"] = BENCH_USER
+            sess["group"] = group
+            sess["page_size"] = page_size
+        return client
+
+    def _test_server(self):
+        server = dbsession.scalar(select(OvpnServers).where(OvpnServers.server_name == "test1"))
+        dbsession.remove()
+        return server
+
+    def _bench_db_endpoints(self, client, size) -> None:
+        server = self._test_server()
+        base = "/ovpn/{}/clients".format(server.id)
+        action = "action_list_ovpn_clients"
+        labels = {"clients": size}
+        self._measure(client, "clients first page", "POST", base, _datatables_form(action), labels)
+        self._measure(client, "clients deep page", "POST", base, _datatables_form(action, start=size // self.servers // 2), labels)
+        self._measure(client, "clients search", "POST", base, _datatables_form(action, search="test1"), labels)
+        self._measure(client, "clients sort by cn", "POST", base, _datatables_form(action, column=1, direction="asc"), labels)
+        self._measure(client, "servers", "GET", "/ovpn/servers/", None, labels)
+        self._measure(client, "dashboard", "GET", "/ovpn/", None, labels)
+        self._measure(client, "dashboard refresh", "POST", "/ovpn/", {"action": "db_refresh"}, labels)
+
+    def _bench_file_endpoints(self, client, size) -> None:
+        server = self._test_server()
+        self._write_files(server, size)
+        labels = {"files": size}
+        for endpoint, action in (
+            ("reqs", "action_list_ovpn_reqs"),
+            ("plain_certs", "action_list_ovpn_plain_certs"),
+            ("encrypt_certs", "action_list_ovpn_encrypt_certs"),
+            ("zip_certs", "action_list_ovpn_zip_certs"),
+        ):
+            url = "/ovpn/{}/{}".format(server.id, endpoint)
+            self._measure(client, "{} first page".format(endpoint), "POST", url, _datatables_form(action), labels)
+            self._measure(client, "{} deep page".format(endpoint), "POST", url, _datatables_form(action, start=size // 2), labels)
+            self._measure(client, "{} search".format(endpoint), "POST", url, _datatables_form(action, search="bench-00001"), labels)
+
+    def _cert_root(self) -> str:
+        cert_root = SystemConfig.get("DIR_CERT_ROOT")
+        if platform.system().startswith("Window"):
+            cert_root = "D:/tmp/ovpn_flask"
+        return cert_root
+
+    def _write_files(self, server, size) -> None:
+        """ Exactly size files of each kind in the server certs dir, added or removed from the last size. """
+        for item, suffix in FILE_KINDS:
+            path = os.path.join(self._cert_root(), server.certs_dir, SystemConfig.get(item))
+            os.makedirs(path, exist_ok=True)
+            existing = {e.name for e in os.scandir(path)}
+            wanted = {"bench-{:07d}{}".format(i, suffix) for i in range(size)}
+            for name in existing - wanted:
+                os.unlink(os.path.join(path, name))
+            for name in wanted - existing:
+                with open(os.path.join(path, name), "w") as fp:
+                    fp.write("For benchmark purpose: {}\n".format(name))
+        logger.info("Benchmark files written: {} per kind".format(size))
+
+    def _remove_files(self) -> None:
+        server = self._test_server()
+        if server is None:
+            return
+        path = os.path.join(self._cert_root(), server.certs_dir)
+        if os.path.isdir(path):
+            remove_tree(path)
+
+    def _measure(self, client, name, method, url, data, labels) -> dict:
+        counter = _QueryCounter()
+        event.listen(engine, "before_cursor_execute", counter)
+        timings = []
+        cold = None
+        status = None
+        try:
+            for i in range(WARMUP_REQUESTS + self.requests):
+                if i == WARMUP_REQUESTS:
+                    counter.count = 0
+                started = time.perf_counter()
+                response = client.open(url, method=method, data=data)
+                elapsed = (time.perf_counter() - started) * 1000
+                response.close()
+                status = response.status_code
+                if status >= 400:
+                    raise RuntimeError("{} {}: {}".format(method, url, response.status))
+                if i == 0:
+                    cold = elapsed
+                elif i >= WARMUP_REQUESTS:
+                    timings.append(elapsed)
+        finally:
+            event.remove(engine, "before_cursor_execute", counter)
+        timings.sort()
+        result = dict(labels)
+        result.update({
+            "endpoint": name,
+            "method": method,
+            "requests": len(timings),
+            "status": status,
+            "cold_ms": round(cold, 3),
+            "mean_ms": round(sum(timings) / len(timings), 3) if timings else 0.0,
+            "p50_ms": round(_percentile(timings, 50), 3),
+            "p90_ms": round(_percentile(timings, 90), 3),
+            "p99_ms": round(_percentile(timings, 99), 3),
+            "max_ms": round(timings[-1], 3) if timings else 0.0,
+            "queries_per_request": round(counter.count / len(timings), 2) if timings else 0.0,
+        })
+        self.results.append(result)
+        logger.info("Benchmark {} {}: p50 {}ms p99 {}ms, {} queries/request".format(
+            name, labels, result["p50_ms"], result["p99_ms"], result["queries_per_request"]
+        ))
+        return result
+
+
+def _result_key(result) -> tuple:
+    return result["endpoint"], result.get("clients"), result.get("files")
+
+
+def compare_reports(old, new) -> list:
+    """ p50, p99 and queries of the results of new that are also in old.
+
+    Returns:
+        list: [{'endpoint', 'clients', 'files', 'p50_ms': (old, new, ratio), 'p99_ms': ..., 'queries_per_request': ...}]
+    """
+    previous = {_result_key(r): r for r in old.get("results", [])}
+    rows = []
+    for result in new.get("results", []):
+        before = previous.get(_result_key(result))
+        if before is None:
+            continue
+        row = {"endpoint": result["endpoint"], "clients": result.get("clients"), "files": result.get("files")}
+        for metric in ("p50_ms", "p99_ms", "queries_per_request"):
+            ratio = round(result[metric] / before[metric], 3) if before[metric] else None
+            row[metric] = (before[metric], result[metric], ratio)
+        rows.append(row)
+    return rows
+
+
+def write_report(report, path) -> None:
+    tmp = path + ".tmp"
+    with open(tmp, "w") as fp:
+        json.dump(report, fp, indent=2)
+    os.replace(tmp, path)
@@ -0,0 +1,180 @@
+"""
+    Batch issuance of the BOSS client certs from many .req files.
+
+    generate-boss-client-cert.sh signs every req of the reqs dir in one copy of the easyrsa
+    tree, but stops at the first malformed req. A batch validates all its reqs concurrently
+    first, stages only the valid ones and queues one job for all of them, so onboarding
+    hundreds of devices costs one workspace. The encrypted profiles of the batch are zipped
+    in one pass when the job is done.
+
+    The reqs of a job are staged in a req dir of their own, passed to the script as REQDIR:
+    the script moves all the reqs of its REQDIR to reqs-done when it ends, so a shared dir
+    would lose the reqs added while it ran.
+"""
+import io
+import os
+import re
+import subprocess
+import tempfile
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+from config import ProductionConfig
+from myproject.context import logger
+from .jobs import JobQueue
+
+OPENSSL = "/usr/bin/openssl"
+# dirs of the files dir, as used by the vpntool scripts
+REQ_DIR = "reqs"
+# req dirs of the queued jobs, one per job
+JOB_REQ_DIR = "reqs-jobs"
+VALIDATED_DIR = "validated"
+BATCH_DIR = "batches"
+UUID_TYPE1_RE = re.compile(r"^[0-9a-f]{8}-[0-9a-f]{4}-1[0-9a-f]{3}-[89ab][0-9a-f]{3}-[0-9a-f]{12}$")
+# bytes of one .req file
+MAX_REQ_SIZE = 64 * 1024
+
+
+def validate_req(data):
+    """ The integrity checks of generate-boss-client-cert.sh on one req.
+
+    Args:
+        data (bytes): content of the .req file
+
+    Returns:
+        tuple: (device uuid, None) or (None, error)
+    """
+    try:
+        req = data.decode("utf-8")
+    except UnicodeDecodeError:
+        return None, "not a text file"
+    lines = req.rstrip("\n").split("\n")
+    if len(lines) < 15:
+        return None, "NOT ENOUGH LINE FEEDS"
+    device_uuid, device_password, device_cert = lines[0], lines[1], "\n".join(lines[2:])
+    if not UUID_TYPE1_RE.match(device_uuid):
+        return None, "DEVICE_UUID is malformed"
+    if len(device_password) < 12:
+        return None, "DEVICE_PASSWORD length less than 12 chars"
+    try:
+        res = subprocess.run([OPENSSL, "x509", "-noout"], input=(device_cert + "\n").encode("utf-8"), capture_output=True, timeout=30)
+    except (OSError, subprocess.TimeoutExpired) as e:
+        return None, "DEVICE_CERT can not be checked: {}".format(str(e))
+    if res.returncode != 0:
+        return None, "DEVICE_CERT is malformed"
+    return device_uuid, None
+
+
+def read_reqs(name, stream):
+    """ (name, bytes) of the .req files of an uploaded .req or .zip file.
+
+    Args:
+        name (str): file name, a .zip is read entry by entry
+        stream (file): binary file object
+    """
+    if name.lower().endswith(".zip"):
+        with zipfile.ZipFile(stream if stream.seekable() else io.BytesIO(stream.read())) as zf:
+            for info in zf.infolist():
+                if info.is_dir() or not info.filename.lower().endswith(".req"):
+                    continue
+                if info.file_size > MAX_REQ_SIZE:
+                    yield info.filename, None
+                    continue
+                yield info.filename, zf.read(info)
+    else:
+        data = stream.read(MAX_REQ_SIZE + 1)
+        yield name, data if len(data) <= MAX_REQ_SIZE else None
+
+
+def make_req_dir(files_dir):
+    """ A new empty req dir of one job, pass it as meta={'env': {'REQDIR': req_dir}} to JobQueue.submit(). """
+    parent = os.path.join(files_dir, JOB_REQ_DIR)
+    os.makedirs(parent, exist_ok=True)
+    return tempfile.mkdtemp(dir=parent, prefix="job-")
+
+
+class CertBatch(object):
+    """ Validate, stage and issue a batch of BOSS reqs of one files dir. """
+
+    @classmethod
+    def submit(cls, files_dir, site_name, subdir, reqs, created_by=None) -> dict:
+        """ Queue one cert generation job for all the valid reqs.
+
+        Args:
+            files_dir (str): tun or tap files dir with the easyrsa PKI
+            site_name (str): SITE_NAME, the OSS backup dir of the script
+            subdir (str): tun-ovpn-files or tap-ovpn-files
+            reqs (iterable): (name, bytes or None if too big), see read_reqs()
+            created_by (str, optional): user name
+
+        Returns:
+            dict: {'job_id': str or None, 'accepted': [uuid], 'rejected': {name: error}}
+        """
+        reqs = list(reqs)
+        rejected = {}
+        if len(reqs) > ProductionConfig.OVPN_CERT_BATCH_MAX_REQS:
+            raise ValueError("Too many req files: {}, at most {}".format(len(reqs), ProductionConfig.OVPN_CERT_BATCH_MAX_REQS))
+
+        candidates = []
+        for name, data in reqs:
+            if data is None:
+                rejected[name] = "file larger than {} bytes".format(MAX_REQ_SIZE)
+            else:
+                candidates.append((name, data))
+        with ThreadPoolExecutor(max_workers=ProductionConfig.OVPN_CERT_BATCH_WORKERS, thread_name_prefix="req-check") as executor:
+            results = list(executor.map(lambda req: validate_req(req[1]), candidates))
+
+        accepted = {}
+        for (name, data), (device_uuid, error) in zip(candidates, results):
+            if error:
+                rejected[name] = error
+            elif device_uuid in accepted:
+                rejected[name] = "duplicate of {}".format(accepted[device_uuid][0])
+            else:
+                accepted[device_uuid] = (name, data)
+        if not accepted:
+            return {"job_id": None, "accepted": [], "rejected": rejected}
+
+        # no script sees the dir before the job is queued, the files need no atomic write
+        req_dir = make_req_dir(files_dir)
+        for device_uuid, (name, data) in accepted.items():
+            with open(os.path.join(req_dir, device_uuid + ".req"), "wb") as fp:
+                fp.write(data)
+
+        job_id = JobQueue.submit(
+            "boss_cert_batch", files_dir, [files_dir, site_name, subdir], created_by=created_by,
+            meta={"uuids": list(accepted), "rejected": rejected, "env": {"REQDIR": req_dir}},
+        )
+        logger.info("Cert batch {}: {} reqs queued, {} rejected".format(job_id, len(accepted), len(rejected)))
+        return {"job_id": job_id, "accepted": list(accepted), "rejected": rejected}
+
+    @classmethod
+    def package(cls, job) -> dict:
+        """ Zip the encrypted profiles of a finished batch job, see JobQueue.on_done. """
+        files_dir = job["pki"]
+        validated_dir = os.path.join(files_dir, VALIDATED_DIR)
+        batch_dir = os.path.join(files_dir, BATCH_DIR)
+        os.makedirs(batch_dir, exist_ok=True)
+        package = os.path.join(batch_dir, "batch-{}.zip".format(job["id"]))
+        missing = []
+        fd, tmp = tempfile.mkstemp(dir=batch_dir, prefix=".", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as fp, zipfile.ZipFile(fp, "w", zipfile.ZIP_DEFLATED) as zf:
+                for device_uuid in job["meta"].get("uuids", []):
+                    path = os.path.join(validated_dir, device_uuid + ".p7mb64")
+                    if os.path.exists(path):
+                        zf.write(path, device_uuid + ".p7mb64")
+                    else:
+                        missing.append(device_uuid)
+            os.replace(tmp, package)
+        except BaseException:
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+            raise
+        logger.info("Cert batch {} packaged: {}, {} missing".format(job["id"], package, len(missing)))
+        return {"package": package, "missing": missing}
+
+
+JobQueue.on_done("boss_cert_batch", CertBatch.package)
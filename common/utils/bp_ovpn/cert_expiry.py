@@ -0,0 +1,179 @@
+"""
+    Expire date of the issued client certs, stored to ovpn_clients.expire_date.
+
+    Replaces the update-expiredate perl cron jobs: the certs are parsed in a process pool
+    reading only the notAfter field of the DER, a cert is parsed again only if its file
+    changed since the last scan, and all the dates are written by one UPDATE ... FROM
+    unnest(...) that only touches the rows whose date differs.
+"""
+import base64
+import binascii
+import datetime
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from sqlalchemy import text
+
+from config import ProductionConfig
+from myproject.context import logger, engine
+from .pagination import invalidate_clients_cache
+from .proxy_config import write_atomic
+
+_PEM_BEGIN = b"-----BEGIN CERTIFICATE-----"
+_PEM_END = b"-----END CERTIFICATE-----"
+# certs per task of the process pool
+CHUNK_SIZE = 500
+
+
+def _der_element(der, pos):
+    """ (tag, content start, content end) of the DER element at pos. """
+    tag = der[pos]
+    length = der[pos + 1]
+    pos += 2
+    if length & 0x80:
+        n = length & 0x7f
+        length = int.from_bytes(der[pos:pos + n], "big")
+        pos += n
+    return tag, pos, pos + length
+
+
+def _der_time(tag, value):
+    value = value.decode("ascii")
+    if tag == 0x17:
+        # UTCTime YYMMDDHHMMSSZ, years 50-99 are 19xx
+        dt = datetime.datetime.strptime(value, "%y%m%d%H%M%SZ")
+        if dt.year >= 2050:
+            dt = dt.replace(year=dt.year - 100)
+    elif tag == 0x18:
+        dt = datetime.datetime.strptime(value, "%Y%m%d%H%M%SZ")
+    else:
+        raise ValueError("unexpected time tag 0x{:02x}".format(tag))
+    return dt.replace(tzinfo=datetime.timezone.utc)
+
+
+def read_not_after(data):
+    """ notAfter of a PEM or DER cert, only the elements before the validity are walked.
+
+    Returns:
+        datetime.datetime: the expire date, UTC
+    """
+    start = data.find(_PEM_BEGIN)
+    if start >= 0:
+        end = data.index(_PEM_END, start)
+        data = base64.b64decode(b"".join(data[start + len(_PEM_BEGIN):end].split()))
+    # Certificate -> tbsCertificate
+    _, pos, _ = _der_element(data, 0)
+    _, pos, _ = _der_element(data, pos)
+    # [0] version (optional), serialNumber, signature, issuer, then validity
+    tag, _, end = _der_element(data, pos)
+    if tag == 0xa0:
+        pos = end
+    for _ in range(3):
+        _, _, pos = _der_element(data, pos)
+    _, pos, _ = _der_element(data, pos)
+    _, _, pos = _der_element(data, pos)
+    tag, value_start, value_end = _der_element(data, pos)
+    return _der_time(tag, data[value_start:value_end])
+
+
+def _read_chunk(paths):
+    """ Process pool task: [(path, notAfter iso or None)]. """
+    results = []
+    for path in paths:
+        try:
+            with open(path, "rb") as fp:
+                results.append((path, read_not_after(fp.read()).isoformat()))
+        except (OSError, ValueError, IndexError, binascii.Error):
+            results.append((path, None))
+    return results
+
+
+class CertExpiryScanner(object):
+    """ Scan the issued certs dirs and update ovpn_clients.expire_date.
+
+    Args:
+        issued_dirs (list): dirs of <cn>.crt files, a cn in a later dir wins
+        state_file (str, optional): file stats and dates of the previous scan
+        workers (int, optional): processes of the pool, the cpu count by default
+    """
+
+    def __init__(self, issued_dirs, state_file=None, workers=None):
+        self.issued_dirs = list(issued_dirs)
+        self.state_file = state_file or ProductionConfig.OVPN_CERT_EXPIRY_STATE
+        self.workers = workers or ProductionConfig.OVPN_CERT_EXPIRY_WORKERS or os.cpu_count() or 1
+
+    def __repr__(self) -> str:
+        return f"CertExpiryScanner(issued_dirs={self.issued_dirs!r})"
+
+    def _load_state(self) -> dict:
+        try:
+            with open(self.state_file, "r") as fp:
+                return json.load(fp)
+        except (OSError, ValueError):
+            return {}
+
+    def scan(self, full=False) -> dict:
+        """ Parse the new and changed certs and write the expire dates.
+
+        Args:
+            full (bool, optional): parse all the certs, ignore the previous scan
+
+        Returns:
+            dict: {'certs', 'parsed', 'failed', 'updated'}
+        """
+        state = {} if full else self._load_state()
+        current = {}
+        # path -> [mtime_ns, size], a stat is cheap compared to parsing the cert
+        for issued_dir in self.issued_dirs:
+            try:
+                entries = os.scandir(issued_dir)
+            except FileNotFoundError:
+                logger.warning("Issued certs dir {} does not exist".format(issued_dir))
+                continue
+            with entries:
+                for entry in entries:
+                    if entry.name.endswith(".crt") and entry.is_file():
+                        st = entry.stat()
+                        current[entry.path] = [st.st_mtime_ns, st.st_size]
+
+        changed = [path for path, stat in current.items() if (state.get(path) or [None, None])[:2] != stat]
+        parsed, failed = 0, 0
+        if changed:
+            chunks = [changed[i:i + CHUNK_SIZE] for i in range(0, len(changed), CHUNK_SIZE)]
+            if len(chunks) > 1 and self.workers > 1:
+                with ProcessPoolExecutor(max_workers=min(self.workers, len(chunks))) as executor:
+                    results = [r for chunk in executor.map(_read_chunk, chunks) for r in chunk]
+            else:
+                results = [r for chunk in chunks for r in _read_chunk(chunk)]
+            for path, not_after in results:
+                if not_after is None:
+                    failed += 1
+                    logger.error("Failed to read the expire date of {}".format(path))
+                    continue
+                parsed += 1
+                state[path] = current[path] + [not_after]
+
+        # the dates of all the known certs, the unchanged rows are not written
+        dates = {}
+        for path in current:
+            if path in state and len(state[path]) == 3:
+                dates[os.path.basename(path)[:-len(".crt")]] = state[path][2]
+        updated = 0
+        if dates:
+            with engine.begin() as conn:
+                updated = conn.execute(
+                    text(
+                        "UPDATE ovpn_clients AS c SET expire_date = v.expire_date, update_time = now() "
+                        "FROM unnest(CAST(:cns AS text[]), CAST(:dates AS timestamptz[])) AS v(cn, expire_date) "
+                        "WHERE c.cn = v.cn AND c.expire_date IS DISTINCT FROM v.expire_date"
+                    ),
+                    {"cns": list(dates), "dates": list(dates.values())},
+                ).rowcount
+            if updated:
+                invalidate_clients_cache()
+
+        write_atomic(self.state_file, json.dumps({path: state[path] for path in current if path in state}))
+        result = {"certs": len(current), "parsed": parsed, "failed": failed, "updated": updated}
+        logger.info("Cert expire dates scanned: {}".format(result))
+        return result
@@ -0,0 +1,171 @@
+"""
+    Server side DataTables requests answered by one SQL statement.
+
+    The page rows, the filtered count (``count(*) over()``) and the unfiltered total
+    (an uncorrelated scalar subquery) are read by a single SELECT, instead of one
+    query for the rows and one count query each for recordsFiltered and recordsTotal.
+"""
+import re
+
+from sqlalchemy import select, func, or_, tuple_, bindparam
+
+_ORDER_ARG = re.compile(r"^order\[(\d+)\]\[(column|dir)\]$")
+
+
+def _to_int(value, default=0) -> int:
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return default
+
+
+def parse_datatables_args(args, max_length=1000) -> dict:
+    """ Get the paging, search and order parameters of a DataTables post.
+
+    Args:
+        args (dict): request form, e.g. ``request.form.to_dict()``
+        max_length (int, optional): max page length, also used for a missing or invalid length
+
+    Returns:
+        dict: {'draw', 'start', 'length', 'search', 'order': [(column index, 'asc'|'desc'), ...]},
+              length is -1 for the 'All' page size of the user settings, every row is read then
+    """
+    start = max(_to_int(args.get('start')), 0)
+    length = _to_int(args.get('length'), max_length)
+    if length != -1 and not 0 < length <= max_length:
+        length = max_length
+
+    # order[i][column] / order[i][dir], in the order of i
+    orders = {}
+    for name, value in args.items():
+        m = _ORDER_ARG.match(name)
+        if m:
+            orders.setdefault(int(m.group(1)), {})[m.group(2)] = value
+    order = []
+    for i in sorted(orders):
+        column = _to_int(orders[i].get('column'), -1)
+        direction = 'desc' if orders[i].get('dir') == 'desc' else 'asc'
+        if column >= 0:
+            order.append((column, direction))
+
+    return {
+        'draw': _to_int(args.get('draw')),
+        'start': start,
+        'length': length,
+        'search': (args.get('search[value]') or '').strip(),
+        'order': order,
+    }
+
+
+class DataTablesQuery(object):
+    """ One DataTables list of a mapped class.
+
+    Args:
+        entity (Base): mapped class of the rows
+        columns (list): order expression of each DataTables column index, None if not orderable
+        search_columns (list, optional): columns matched by ilike against search[value]
+        tiebreaker (Column, optional): unique column appended to the order, default entity.id
+        reverse (bool, optional): sort the opposite of the posted direction
+    """
+
+    def __init__(self, entity, columns, search_columns=(), tiebreaker=None, reverse=False):
+        self.entity = entity
+        self.columns = list(columns)
+        self.search_columns = list(search_columns)
+        self.tiebreaker = tiebreaker if tiebreaker is not None else entity.id
+        self.reverse = reverse
+
+    def __repr__(self) -> str:
+        return f"DataTablesQuery(entity={self.entity.__name__!r}, columns={len(self.columns)!r})"
+
+    def get_order(self, order) -> list:
+        """ Map the posted (column index, dir) to [(expression, descending)], unknown columns are ignored. """
+        result = []
+        seen = set()
+        for column, direction in order:
+            if column in seen or column >= len(self.columns) or self.columns[column] is None:
+                continue
+            seen.add(column)
+            result.append((self.columns[column], (direction == 'desc') != self.reverse))
+        return result
+
+    def get_search(self, search):
+        if not search or not self.search_columns:
+            return None
+        # % and _ of the search value are literal characters
+        pattern = '%{}%'.format(search.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_'))
+        return or_(*[c.ilike(pattern, escape='\\') for c in self.search_columns])
+
+    def fetch(self, session, params, where=(), total=None, cursors=None, cursor_key=None) -> dict:
+        """ Read one page and its counts.
+
+        Args:
+            session (Session): db session
+            params (dict): result of parse_datatables_args()
+            where (tuple, optional): filters of the whole list, e.g. the server id
+            total (int, optional): known unfiltered total, the total subquery is skipped then
+            cursors (KeysetCursorCache, optional): page boundaries, enables keyset pagination
+            cursor_key (str, optional): prefix of the boundaries keys, used to invalidate them
+
+        Returns:
+            dict: {'rows': [entity], 'recordsFiltered': int, 'recordsTotal': int}
+        """
+        start, length = params['start'], params['length']
+        order = self.get_order(params['order'])
+        keys = [expr for expr, _ in order] + [self.tiebreaker]
+        directions = {d for _, d in order}
+        descending = order[0][1] if order else False
+
+        filters = list(where)
+        search = self.get_search(params['search'])
+        if search is not None:
+            filters.append(search)
+
+        columns = [self.entity, func.count().over().label('filtered')]
+        if total is None:
+            columns.append(
+                select(func.count()).select_from(self.entity).where(*where).correlate(None).scalar_subquery().label('total')
+            )
+        columns.extend(k.label('_k{}'.format(i)) for i, k in enumerate(keys))
+        stmt = select(*columns).where(*filters)
+
+        # a row value comparison seeks in one direction only, mixed directions read by offset
+        boundary = None
+        cache_key = None
+        if cursors is not None and len(directions) <= 1:
+            cache_key = (cursor_key, tuple(params['order']), params['search'])
+            boundary = cursors.get(cache_key, start)
+        if boundary is not None:
+            seek = tuple_(*keys)
+            value = tuple_(*[bindparam(None, v, type_=k.type) for k, v in zip(keys, boundary)])
+            stmt = stmt.where(seek < value if descending else seek > value)
+        elif start:
+            stmt = stmt.offset(start)
+        stmt = stmt.order_by(
+            *[expr.desc() if d else expr.asc() for expr, d in order],
+            self.tiebreaker.desc() if descending else self.tiebreaker.asc(),
+        )
+        if length > 0:
+            stmt = stmt.limit(length)
+
+        rows = session.execute(stmt).all()
+        if rows:
+            # count(*) over() counts the rows after the keyset boundary, the rows before it are start
+            filtered = rows[0].filtered + (start if boundary is not None else 0)
+            records_total = total if total is not None else rows[0].total
+        else:
+            # page past the end, the window function has no row to report on
+            filtered = session.scalar(select(func.count()).select_from(self.entity).where(*filters))
+            records_total = total if total is not None else session.scalar(
+                select(func.count()).select_from(self.entity).where(*where)
+            )
+
+        if cache_key is not None and rows and len(rows) == length:
+            last = rows[-1]._mapping
+            cursors.set(cache_key, start + length, tuple(last['_k{}'.format(i)] for i in range(len(keys))))
+
+        return {
+            'rows': [row[0] for row in rows],
+            'recordsFiltered': filtered,
+            'recordsTotal': records_total,
+        }
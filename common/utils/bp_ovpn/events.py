@@ -0,0 +1,146 @@
+"""
+    Server-Sent Events fan-out of the dashboard metrics and the client connect/disconnect events.
+
+    Every process has one broker. The metrics come from the background system sampler of
+    the process, the client events are sent through a NOTIFY on the ovpn_client_events
+    channel so that all the uWSGI workers receive them, whichever process produced them
+    (management interface reader, status file sync command). The proxy reload results go the
+    same way on the ovpn_proxy_reload channel.
+"""
+import json
+import queue
+import threading
+
+from sqlalchemy import text
+
+from myproject.context import logger, engine
+from .metrics import system_sampler
+from .sysconfig import SystemConfig
+
+CLIENT_CHANNEL = "ovpn_client_events"
+PROXY_CHANNEL = "ovpn_proxy_reload"
+# pg_notify payloads must be shorter than 8000 bytes
+MAX_PAYLOAD = 7000
+
+
+class EventBroker(object):
+    """ In-process publisher, one bounded queue per subscribed browser.
+
+    Args:
+        maxsize (int, optional): events queued per subscriber, a slow subscriber loses the oldest
+    """
+
+    def __init__(self, maxsize=100):
+        self.maxsize = maxsize
+        self._subscribers = set()
+        self._lock = threading.Lock()
+
+    def __repr__(self) -> str:
+        return f"EventBroker(subscribers={len(self._subscribers)!r})"
+
+    def __len__(self) -> int:
+        return len(self._subscribers)
+
+    def subscribe(self, limit=None) -> queue.Queue:
+        """ A new subscriber queue, None if there are limit subscribers already. """
+        q = queue.Queue(maxsize=self.maxsize)
+        with self._lock:
+            if limit is not None and len(self._subscribers) >= limit:
+                return None
+            self._subscribers.add(q)
+        return q
+
+    def unsubscribe(self, q) -> None:
+        with self._lock:
+            self._subscribers.discard(q)
+
+    def publish(self, event, data) -> None:
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for q in subscribers:
+            while True:
+                try:
+                    q.put_nowait((event, data))
+                    break
+                except queue.Full:
+                    try:
+                        q.get_nowait()
+                    except queue.Empty:
+                        pass
+
+
+broker = EventBroker()
+
+
+def format_sse(event, data) -> str:
+    """ One text/event-stream message. """
+    return "event: {}\ndata: {}\n\n".format(event, json.dumps(data, default=str))
+
+
+def publish_client_events(events, session=None) -> None:
+    """ Send client events to the brokers of all the processes.
+
+    Args:
+        events (list): [{'server_id', 'cn', 'status', 'ip'}]
+        session (Session, optional): send when this session commits, immediately if None
+    """
+    if not events:
+        return
+    if engine.dialect.name != "postgresql":
+        broker.publish("clients", events)
+        return
+    chunks, chunk = [], []
+    for event in events:
+        chunk.append(event)
+        if len(json.dumps(chunk, default=str)) > MAX_PAYLOAD:
+            chunks.append(chunk[:-1])
+            chunk = chunk[-1:]
+    chunks.append(chunk)
+    stmt = text("SELECT pg_notify(:channel, :payload)")
+    params = [{"channel": CLIENT_CHANNEL, "payload": json.dumps(c, default=str)} for c in chunks if c]
+    try:
+        if session is not None:
+            for p in params:
+                session.execute(stmt, p)
+        else:
+            with engine.begin() as conn:
+                for p in params:
+                    conn.execute(stmt, p)
+    except Exception as e:
+        logger.error("Failed to publish {} client events: {}".format(len(events), str(e)))
+
+
+def publish_proxy_status(status) -> None:
+    """ Send the result of a proxy reload to the brokers of all the processes. """
+    if engine.dialect.name != "postgresql":
+        broker.publish("proxy", status)
+        return
+    payload = json.dumps(status, default=str)
+    if len(payload) > MAX_PAYLOAD:
+        payload = json.dumps(dict(status, output=""), default=str)
+    try:
+        with engine.begin() as conn:
+            conn.execute(text("SELECT pg_notify(:channel, :payload)"), {"channel": PROXY_CHANNEL, "payload": payload})
+    except Exception as e:
+        logger.error("Failed to publish the proxy reload status: {}".format(str(e)))
+
+
+def _on_client_notify(payload) -> None:
+    # the listener also calls the handlers with an empty payload after (re)connecting
+    if payload:
+        broker.publish("clients", json.loads(payload))
+
+
+def _on_proxy_notify(payload) -> None:
+    if payload:
+        broker.publish("proxy", json.loads(payload))
+
+
+def _on_sample(sample) -> None:
+    if len(broker):
+        broker.publish("metrics", sample)
+
+
+SystemConfig.on_notify(CLIENT_CHANNEL, _on_client_notify)
+SystemConfig.on_notify(PROXY_CHANNEL, _on_proxy_notify)
+system_sampler.add_listener(_on_sample)
@@ -0,0 +1,303 @@
+"""
+    Cached index of the certificate/req/zip directories.
+
+    A directory is scanned once and again only when it changed: by default the directory
+    inode and mtime are compared, on Linux an inotify watch also reports files rewritten
+    in place. All the watches of a process share one inotify instance, the per user
+    limit of instances is low. Sort, search and slice of the DataTables requests are answered from memory,
+    the file stats are only formatted for the rows of the requested page.
+"""
+import array
+import ctypes
+import ctypes.util
+import datetime
+import os
+import struct
+import sys
+import threading
+import time
+
+from config import ProductionConfig
+from myproject.context import logger
+
+# inotify(7)
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+# struct inotify_event without its name: wd, mask, cookie, len
+EVENT = struct.Struct("iIII")
+
+# a directory modified within this many seconds may change again in the same mtime tick
+RACY_SECONDS = 1.0
+
+_libc = None
+
+
+def _get_libc():
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    return _libc
+
+
+class Inotify(object):
+    """ The inotify instance of the process, the events are dispatched to the watches by wd. """
+
+    _lock = threading.Lock()
+    _fd = None
+    _pid = None
+    # wd -> set of DirWatch
+    _watches = {}
+
+    @classmethod
+    def _get_fd(cls) -> int:
+        if cls._pid != os.getpid():
+            # a forked worker must not share the instance of its parent
+            cls._fd, cls._pid, cls._watches = None, os.getpid(), {}
+        if cls._fd is None:
+            fd = _get_libc().inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+            if fd < 0:
+                raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+            cls._fd = fd
+        return cls._fd
+
+    @classmethod
+    def add(cls, watch, path) -> int:
+        """ Watch a directory for a DirWatch, the same wd for the same directory.
+
+        Raises:
+            OSError: inotify is not available or the directory can not be watched
+        """
+        with cls._lock:
+            fd = cls._get_fd()
+            wd = _get_libc().inotify_add_watch(fd, os.fsencode(path), DirWatch.MASK)
+            if wd < 0:
+                raise OSError(ctypes.get_errno(), "inotify_add_watch failed: {}".format(path))
+            cls._watches.setdefault(wd, set()).add(watch)
+            return wd
+
+    @classmethod
+    def remove(cls, watch) -> None:
+        """ Stop the watch of the directory when its last DirWatch is closed. """
+        with cls._lock:
+            if cls._pid != os.getpid():
+                return
+            watches = cls._watches.get(watch.wd)
+            if watches is None:
+                return
+            watches.discard(watch)
+            if not watches:
+                del cls._watches[watch.wd]
+                _get_libc().inotify_rm_watch(cls._fd, watch.wd)
+
+    @classmethod
+    def drain(cls) -> None:
+        """ Read the pending events and flag the watches of their directories. """
+        with cls._lock:
+            if cls._fd is None or cls._pid != os.getpid():
+                return
+            while True:
+                try:
+                    data = os.read(cls._fd, 65536)
+                except BlockingIOError:
+                    return
+                if not data:
+                    return
+                offset = 0
+                while offset + EVENT.size <= len(data):
+                    wd, mask, _, length = EVENT.unpack_from(data, offset)
+                    offset += EVENT.size + length
+                    if mask & IN_Q_OVERFLOW:
+                        # events were lost, every directory may have changed
+                        for watches in cls._watches.values():
+                            for watch in watches:
+                                watch.pending = True
+                        continue
+                    for watch in cls._watches.get(wd, ()):
+                        watch.pending = True
+                    if mask & IN_IGNORED:
+                        # the directory is gone, the kernel removed its watch
+                        cls._watches.pop(wd, None)
+
+
+class DirWatch(object):
+    """ Non-blocking inotify watch of one directory, Linux only.
+
+    Args:
+        path (str): directory path
+
+    Raises:
+        OSError: inotify is not available or the directory can not be watched
+    """
+
+    MASK = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+
+    def __init__(self, path):
+        if not sys.platform.startswith("linux"):
+            raise OSError("inotify is only available on linux")
+        self.pending = False
+        self.wd = Inotify.add(self, path)
+
+    def changed(self) -> bool:
+        """ Take the pending events of the directory, True if there was any. """
+        Inotify.drain()
+        changed, self.pending = self.pending, False
+        return changed
+
+    def close(self) -> None:
+        if self.wd is not None:
+            Inotify.remove(self)
+            self.wd = None
+
+
+class DirIndex(object):
+    """ Names, sizes and ctimes of the files of one directory with the given suffixes.
+
+    Args:
+        path (str|pathlib.Path): directory path
+        suffixes (tuple): file name suffixes to index, e.g. (".conf", ".ovpn")
+        watch (bool, optional): use an inotify watch if available
+    """
+
+    def __init__(self, path, suffixes, watch=True):
+        self.path = os.fspath(path)
+        self.suffixes = tuple(suffixes)
+        self.watch = watch
+        self.signature = None
+        self._watch = None
+        self._lock = threading.Lock()
+        # sorted by name, the same position in all arrays
+        self.names = []
+        self.keys = []
+        self.sizes = array.array("q")
+        self.ctimes = array.array("d")
+
+    def __repr__(self) -> str:
+        return f"DirIndex(path={self.path!r}, files={len(self.names)!r})"
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def _changed(self, signature) -> bool:
+        if self._watch is not None:
+            # drain first, the events are reported by the next refresh otherwise
+            changed = self._watch.changed()
+            return changed or signature != self.signature
+        return signature != self.signature or time.time() - signature[2] / 1e9 < RACY_SECONDS
+
+    def refresh(self) -> bool:
+        """ Scan the directory again if it changed.
+
+        Returns:
+            bool: True if the directory was scanned
+        """
+        with self._lock:
+            try:
+                st = os.stat(self.path)
+            except OSError:
+                self._close_watch()
+                self.signature, self.names, self.keys = None, [], []
+                self.sizes, self.ctimes = array.array("q"), array.array("d")
+                return False
+            signature = (st.st_dev, st.st_ino, st.st_mtime_ns)
+            if self.signature is not None and not self._changed(signature):
+                return False
+
+            if self.watch and (self._watch is None or signature[:2] != (self.signature or signature)[:2]):
+                self._close_watch()
+                try:
+                    self._watch = DirWatch(self.path)
+                except OSError as e:
+                    logger.debug("No inotify watch of {}, use the directory mtime: {}".format(self.path, e))
+                    self.watch = False
+
+            files = []
+            with os.scandir(self.path) as it:
+                for entry in it:
+                    if entry.name.endswith(self.suffixes) and entry.is_file():
+                        try:
+                            fst = entry.stat()
+                        except OSError:
+                            # deleted during the scan
+                            continue
+                        files.append((entry.name, fst.st_size, fst.st_ctime))
+            files.sort()
+            self.names = [f[0] for f in files]
+            self.keys = [f[0].upper() for f in files]
+            self.sizes = array.array("q", (f[1] for f in files))
+            self.ctimes = array.array("d", (f[2] for f in files))
+            self.signature = signature
+            logger.debug("Indexed {} files of {}".format(len(files), self.path))
+            return True
+
+    def _close_watch(self) -> None:
+        if self._watch is not None:
+            self._watch.close()
+            self._watch = None
+
+    def page(self, search=None, descending=False, start=0, length=-1) -> tuple:
+        """ One DataTables page of the files, ordered by name.
+
+        Args:
+            search (str, optional): case insensitive substring of the file name
+            descending (bool, optional): order by name descending
+            start (int, optional): first row
+            length (int, optional): rows, -1 for all
+
+        Returns:
+            tuple: (rows: [{'cert_name', 'cert_size', 'create_time'}], recordsFiltered, recordsTotal)
+        """
+        self.refresh()
+        with self._lock:
+            names, keys, sizes, ctimes = self.names, self.keys, self.sizes, self.ctimes
+        if search:
+            search = search.upper()
+            positions = [i for i, key in enumerate(keys) if search in key]
+        else:
+            positions = range(len(names))
+        filtered = len(positions)
+        if descending:
+            positions = positions[::-1]
+        positions = positions[start:] if length < 0 else positions[start:start + length]
+        rows = [
+            {
+                "cert_name": names[i],
+                "cert_size": round(sizes[i] / 1024, 1),
+                "create_time": datetime.datetime.fromtimestamp(ctimes[i]).strftime("%Y-%m-%d_%H:%M:%S"),
+            }
+            for i in positions
+        ]
+        return rows, filtered, len(names)
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def get_dir_index(path, suffixes) -> DirIndex:
+    """ Get the process wide index of a directory.
+
+    Args:
+        path (str|pathlib.Path): directory path
+        suffixes (tuple): file name suffixes to index
+
+    Returns:
+        DirIndex: the index
+    """
+    key = (os.fspath(path), tuple(suffixes))
+    with _indexes_lock:
+        index = _indexes.get(key)
+        if index is None:
+            index = DirIndex(path, suffixes, watch=ProductionConfig.OVPN_DIR_INDEX_INOTIFY)
+            _indexes[key] = index
+        return index
@@ -0,0 +1,317 @@
+"""
+    Opt-in per request SQL and timing instrumentation, enabled by OVPN_INSTRUMENTATION.
+
+    The statements of the SQLAlchemy engine (cursor execute events) and of the raw DBAPI
+    connections of myproject.db.get_db (a timed cursor class) are counted and timed into
+    the stats of the request of the current thread. Every response gets a Server-Timing
+    header with the db and total time, and the request is observed into per endpoint
+    histograms. Each process writes its histograms to OVPN_INSTRUMENTATION_DIR now and then,
+    /ovpn/metrics merges the files of all the processes into the Prometheus text format and
+    removes the files of the processes that are gone.
+"""
+import glob
+import json
+import os
+import threading
+import time
+import uuid
+
+import psycopg2.extensions
+from flask import request
+from sqlalchemy import event
+
+from config import ProductionConfig
+from myproject.context import logger, engine
+
+# statements per request
+QUERY_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+METRIC_PREFIX = "ovpn_flask_"
+_local = threading.local()
+
+
+class _RequestStats(object):
+    __slots__ = ("started", "queries", "db_seconds")
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.db_seconds = 0.0
+
+
+def _record(seconds) -> None:
+    stats = getattr(_local, "stats", None)
+    if stats is not None:
+        stats.queries += 1
+        stats.db_seconds += seconds
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if context is not None:
+        context._ovpn_started = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = getattr(context, "_ovpn_started", None)
+    if started is not None:
+        _record(time.perf_counter() - started)
+
+
+_timed_cursors = {}
+
+
+def _timed_cursor(base):
+    """ Subclass of the cursor class base whose statements are recorded. """
+    cls = _timed_cursors.get(base)
+    if cls is None:
+        class TimedCursor(base):
+            def execute(self, query, vars=None):
+                started = time.perf_counter()
+                try:
+                    return super().execute(query, vars)
+                finally:
+                    _record(time.perf_counter() - started)
+
+            def executemany(self, query, vars_list):
+                started = time.perf_counter()
+                try:
+                    return super().executemany(query, vars_list)
+                finally:
+                    _record(time.perf_counter() - started)
+
+        cls = _timed_cursors[base] = TimedCursor
+    return cls
+
+
+class InstrumentedConnection(object):
+    """ Proxy of a pooled DBAPI connection, the cursors of any cursor_factory are timed. """
+
+    def __init__(self, connection):
+        self._connection = connection
+
+    def cursor(self, *args, **kwargs):
+        kwargs["cursor_factory"] = _timed_cursor(kwargs.get("cursor_factory") or psycopg2.extensions.cursor)
+        return self._connection.cursor(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._connection, name)
+
+
+def _pid_alive(pid) -> bool:
+    try:
+        os.kill(int(pid), 0)
+    except (ValueError, ProcessLookupError):
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _remove(path) -> None:
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
+
+
+class _Histogram(object):
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value) -> None:
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.sum += value
+        self.count += 1
+
+
+class RequestMetrics(object):
+    """ Process wide request histograms and the hooks of the app. """
+
+    _enabled = False
+    _lock = threading.Lock()
+    # (endpoint, method) -> {metric: _Histogram}
+    _histograms = {}
+    # (endpoint, method, status) -> requests
+    _requests = {}
+    # one writer of the snapshot file at a time, _flushed is set under it
+    _flush_lock = threading.Lock()
+    _flushed = 0.0
+    _pid = None
+    _snapshot_file = None
+
+    @classmethod
+    def init_app(cls, app) -> None:
+        """ Register the request hooks and the engine events if OVPN_INSTRUMENTATION is on. """
+        if not app.config.get("OVPN_INSTRUMENTATION"):
+            return
+        cls._enabled = True
+        if not event.contains(engine, "before_cursor_execute", _before_cursor_execute):
+            event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+            event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+        # registered first: the timer starts before and stops after the other hooks
+        app.before_request(cls._start)
+        app.after_request(cls._finish)
+        app.teardown_request(cls._teardown)
+        logger.info("Request instrumentation enabled")
+
+    @classmethod
+    def wrap_connection(cls, connection):
+        """ The raw connection of myproject.db.get_db, with timed cursors if the instrumentation is on. """
+        return InstrumentedConnection(connection) if cls._enabled else connection
+
+    @classmethod
+    def _start(cls) -> None:
+        _local.stats = _RequestStats()
+
+    @classmethod
+    def _finish(cls, response):
+        stats = getattr(_local, "stats", None)
+        if stats is None:
+            return response
+        elapsed = time.perf_counter() - stats.started
+        response.headers.add(
+            "Server-Timing",
+            'db;dur={:.2f};desc="{} queries", app;dur={:.2f}'.format(stats.db_seconds * 1000, stats.queries, elapsed * 1000),
+        )
+        cls.observe(request.endpoint or "none", request.method, response.status_code, elapsed, stats.db_seconds, stats.queries)
+        return response
+
+    @classmethod
+    def _teardown(cls, exception=None) -> None:
+        _local.stats = None
+
+    @classmethod
+    def observe(cls, endpoint, method, status, seconds, db_seconds, queries) -> None:
+        key = (endpoint, method)
+        with cls._lock:
+            histograms = cls._histograms.get(key)
+            if histograms is None:
+                buckets = tuple(ProductionConfig.OVPN_INSTRUMENTATION_BUCKETS)
+                histograms = cls._histograms[key] = {
+                    "request_duration_seconds": _Histogram(buckets),
+                    "request_db_seconds": _Histogram(buckets),
+                    "request_queries": _Histogram(QUERY_BUCKETS),
+                }
+            histograms["request_duration_seconds"].observe(seconds)
+            histograms["request_db_seconds"].observe(db_seconds)
+            histograms["request_queries"].observe(queries)
+            status_key = (endpoint, method, str(status))
+            cls._requests[status_key] = cls._requests.get(status_key, 0) + 1
+        if time.monotonic() - cls._flushed >= ProductionConfig.OVPN_INSTRUMENTATION_FLUSH:
+            cls.flush(interval=ProductionConfig.OVPN_INSTRUMENTATION_FLUSH)
+
+    @classmethod
+    def _snapshot(cls) -> dict:
+        with cls._lock:
+            return {
+                "histograms": [
+                    [endpoint, method, name, list(h.buckets), list(h.counts), h.sum, h.count]
+                    for (endpoint, method), histograms in cls._histograms.items()
+                    for name, h in histograms.items()
+                ],
+                "requests": [[endpoint, method, status, n] for (endpoint, method, status), n in cls._requests.items()],
+            }
+
+    @classmethod
+    def flush(cls, interval=0) -> None:
+        """ Write the histograms of this process, one file per process lifetime so a reused pid does not overwrite.
+
+        Args:
+            interval (float, optional): skip the write if another thread flushed within this many seconds,
+                                        the request threads do not wait for a flush in progress then
+        """
+        if not cls._flush_lock.acquire(blocking=not interval):
+            return
+        try:
+            if interval and time.monotonic() - cls._flushed < interval:
+                return
+            cls._flushed = time.monotonic()
+            cls._write()
+        finally:
+            cls._flush_lock.release()
+
+    @classmethod
+    def _write(cls) -> None:
+        pid = os.getpid()
+        if cls._pid != pid:
+            # a forked worker starts with the counters of the parent, they are the parent's
+            with cls._lock:
+                if cls._pid is not None:
+                    cls._histograms.clear()
+                    cls._requests.clear()
+                cls._pid = pid
+                cls._snapshot_file = os.path.join(
+                    ProductionConfig.OVPN_INSTRUMENTATION_DIR, "{}-{}.json".format(pid, uuid.uuid4().hex[:8])
+                )
+                # the files of a previous process with the same pid
+                for path in glob.glob(os.path.join(ProductionConfig.OVPN_INSTRUMENTATION_DIR, "{}-*.json".format(pid))):
+                    _remove(path)
+        try:
+            os.makedirs(ProductionConfig.OVPN_INSTRUMENTATION_DIR, mode=0o750, exist_ok=True)
+            tmp = cls._snapshot_file + ".tmp"
+            with open(tmp, "w") as fp:
+                json.dump(cls._snapshot(), fp)
+            os.replace(tmp, cls._snapshot_file)
+        except OSError as e:
+            logger.error("Failed to write the request metrics: {}".format(str(e)))
+
+    @classmethod
+    def render(cls) -> str:
+        """ The merged histograms of all the processes in the Prometheus text format. """
+        cls.flush()
+        histograms = {}
+        requests = {}
+        try:
+            names = [n for n in os.listdir(ProductionConfig.OVPN_INSTRUMENTATION_DIR) if n.endswith(".json")]
+        except FileNotFoundError:
+            names = []
+        for name in names:
+            path = os.path.join(ProductionConfig.OVPN_INSTRUMENTATION_DIR, name)
+            if not _pid_alive(name.split("-", 1)[0]):
+                _remove(path)
+                continue
+            try:
+                with open(path, "r") as fp:
+                    snapshot = json.load(fp)
+            except (OSError, ValueError):
+                continue
+            for endpoint, method, metric, buckets, counts, total, count in snapshot.get("histograms", []):
+                key = (metric, endpoint, method, tuple(buckets))
+                merged = histograms.get(key)
+                if merged is None:
+                    merged = histograms[key] = [[0] * len(buckets), 0.0, 0]
+                merged[0] = [a + b for a, b in zip(merged[0], counts)]
+                merged[1] += total
+                merged[2] += count
+            for endpoint, method, status, n in snapshot.get("requests", []):
+                requests[(endpoint, method, status)] = requests.get((endpoint, method, status), 0) + n
+
+        lines = [
+            "# HELP {}requests_total Requests by endpoint, method and status.".format(METRIC_PREFIX),
+            "# TYPE {}requests_total counter".format(METRIC_PREFIX),
+        ]
+        for (endpoint, method, status), n in sorted(requests.items()):
+            lines.append('{}requests_total{{endpoint="{}",method="{}",status="{}"}} {}'.format(
+                METRIC_PREFIX, endpoint, method, status, n
+            ))
+        for metric in ("request_duration_seconds", "request_db_seconds", "request_queries"):
+            lines.append("# TYPE {}{} histogram".format(METRIC_PREFIX, metric))
+            for (name, endpoint, method, buckets), (counts, total, count) in sorted(histograms.items()):
+                if name != metric:
+                    continue
+                labels = 'endpoint="{}",method="{}"'.format(endpoint, method)
+                cumulative = 0
+                for bound, n in zip(buckets, counts):
+                    cumulative += n
+                    lines.append('{}{}_bucket{{{},le="{}"}} {}'.format(METRIC_PREFIX, metric, labels, bound, cumulative))
+                lines.append('{}{}_bucket{{{},le="+Inf"}} {}'.format(METRIC_PREFIX, metric, labels, count))
+                lines.append("{}{}_sum{{{}}} {}".format(METRIC_PREFIX, metric, labels, round(total, 6)))
+                lines.append("{}{}_count{{{}}} {}".format(METRIC_PREFIX, metric, labels, count))
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,120 @@
+"""
+    In-memory CN <-> IP index of the openvpn ifconfig-pool-persist file (ipp.txt).
+
+    The file is parsed once and parsed again only when its inode, mtime or size changed,
+    so a lookup costs one stat() instead of a scan of the whole pool.
+
+    Only the standard library is used here: the learn-address sink on the openvpn host
+    loads this file directly, without the flask app.
+"""
+import os
+import threading
+
+
+def get_ipp_filename(cfg_filename) -> str:
+    """ Get the ifconfig-pool-persist file from the openvpn server config.
+
+    Args:
+        cfg_filename (str): openvpn server config file
+
+    Returns:
+        str: ipp file path, relative paths are resolved from the config file dir. None if not configured.
+    """
+    try:
+        with open(cfg_filename, "rt") as f:
+            for line in f:
+                if 'ifconfig-pool-persist' in line:
+                    x = line.strip().split()
+                    if x and 'ifconfig-pool-persist' == x[0] and len(x) > 1:
+                        return os.path.join(os.path.dirname(os.path.abspath(cfg_filename)), x[1])
+    except OSError:
+        return None
+    return None
+
+
+class IppIndex(object):
+    """ CN -> IP and IP -> CN dicts of one ipp file.
+
+    Args:
+        path (str): ipp file path
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.signature = None
+        self.cn_ip = {}
+        self.ip_cn = {}
+        self._lock = threading.Lock()
+
+    def __repr__(self) -> str:
+        return f"IppIndex(path={self.path!r}, size={len(self.cn_ip)!r})"
+
+    def __len__(self) -> int:
+        return len(self.cn_ip)
+
+    def reload(self, force=False) -> bool:
+        """ Parse the file again if it changed.
+
+        Returns:
+            bool: True if the file was parsed
+        """
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            with self._lock:
+                self.signature, self.cn_ip, self.ip_cn = None, {}, {}
+            return False
+        signature = (st.st_dev, st.st_ino, st.st_mtime_ns, st.st_size)
+        if signature == self.signature and not force:
+            return False
+
+        cn_ip = {}
+        ip_cn = {}
+        with open(self.path, "rt", errors="replace") as f:
+            for line in f:
+                # cn,ipv4[,ipv6]
+                fields = line.strip().split(",")
+                if len(fields) < 2 or not fields[0]:
+                    continue
+                cn = fields[0]
+                for ip in fields[1:3]:
+                    if ip:
+                        cn_ip.setdefault(cn, ip)
+                        ip_cn[ip] = cn
+        with self._lock:
+            self.cn_ip, self.ip_cn, self.signature = cn_ip, ip_cn, signature
+        return True
+
+    def get_cn(self, ip) -> str:
+        self.reload()
+        return self.ip_cn.get(ip)
+
+    def get_ip(self, cn) -> str:
+        self.reload()
+        return self.cn_ip.get(cn)
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def get_ipp_index(ipp_filename=None, cfg_filename=None) -> IppIndex:
+    """ Get the process wide index of an ipp file.
+
+    Args:
+        ipp_filename (str, optional): ipp file path
+        cfg_filename (str, optional): openvpn server config, used if ipp_filename is not given
+
+    Returns:
+        IppIndex: the index, None if no ipp file is configured
+    """
+    if not ipp_filename and cfg_filename:
+        ipp_filename = get_ipp_filename(cfg_filename)
+    if not ipp_filename:
+        return None
+    with _indexes_lock:
+        index = _indexes.get(ipp_filename)
+        if index is None:
+            index = IppIndex(ipp_filename)
+            _indexes[ipp_filename] = index
+        return index
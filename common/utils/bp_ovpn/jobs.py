@@ -0,0 +1,263 @@
+"""
+    Background job queue of the certificate generation scripts.
+
+    The jobs are rows of ovpn_jobs. The views only insert a job and return, the worker
+    threads of every process claim the queued jobs by SELECT ... FOR UPDATE SKIP LOCKED,
+    woken by a NOTIFY on the ovpn_jobs channel. A job also takes one of the
+    OVPN_JOB_PKI_CONCURRENCY advisory locks of its easyrsa dir while it runs, so the
+    scripts never run more often at once on one PKI than allowed, whichever process
+    claimed them. The script output is appended to the job log while it runs.
+"""
+import datetime
+import os
+import subprocess
+import threading
+import time
+import uuid
+
+from sqlalchemy import insert, select, text, update
+from sqlalchemy.sql import func
+
+from config import ProductionConfig
+from myproject.context import logger, engine
+from orm.ovpn import OvpnJobs
+from .sysconfig import SystemConfig
+
+NOTIFY_CHANNEL = "ovpn_jobs"
+VPNTOOL_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))), "vpntool")
+# kind -> (script of vpntool, text printed by a successful run)
+JOB_SCRIPTS = {
+    "boss_cert": ("generate-boss-client-cert.sh", "SELFDEFINEDS"),
+    "generic_cert": ("generate-generic-client-cert.sh", "SELFDEFINEDS"),
+    "boss_cert_batch": ("generate-boss-client-cert.sh", "SELFDEFINEDS"),
+}
+JOB_QUEUED, JOB_RUNNING, JOB_DONE, JOB_FAILED = 0, 1, 2, 3
+# seconds between two writes of the output of a running job
+LOG_FLUSH_INTERVAL = 1
+
+
+class JobQueue(object):
+    """ Process wide worker pool of the ovpn_jobs queue. """
+
+    _lock = threading.Lock()
+    _wakeup = threading.Event()
+    _pid = None
+    # kind -> handlers called after a successful run
+    _done_handlers = {}
+
+    @classmethod
+    def submit(cls, kind, pki, args, created_by=None, meta=None) -> str:
+        """ Queue a job, it is run by the first free worker of any process, see ensure_started().
+
+        Args:
+            kind (str): one of JOB_SCRIPTS
+            pki (str): the files dir holding the easyrsa PKI the script writes to
+            args (list): script arguments
+            created_by (str, optional): user name, for the log
+            meta (dict, optional): job specific data for the done handlers
+
+        Returns:
+            str: job id
+        """
+        if kind not in JOB_SCRIPTS:
+            raise ValueError("Unknown job kind: {}".format(kind))
+        job_id = uuid.uuid4()
+        with engine.begin() as conn:
+            conn.execute(insert(OvpnJobs).values(
+                id=job_id, kind=kind, pki=pki, args=[str(a) for a in args], status=JOB_QUEUED, log='', created_by=created_by, meta=meta
+            ))
+            conn.execute(text("SELECT pg_notify(:channel, :payload)"), {"channel": NOTIFY_CHANNEL, "payload": str(job_id)})
+        logger.info("Job {} queued: {} {}".format(job_id, kind, pki))
+        cls._wakeup.set()
+        return str(job_id)
+
+    @classmethod
+    def get(cls, job_id, offset=0):
+        """ State of a job and its log from offset.
+
+        Returns:
+            dict: {'id', 'kind', 'status', 'state', 'returncode', 'log', 'offset', ...}, None if there is no such job
+        """
+        offset = max(int(offset or 0), 0)
+        with engine.connect() as conn:
+            row = conn.execute(
+                select(
+                    OvpnJobs.id, OvpnJobs.kind, OvpnJobs.pki, OvpnJobs.status, OvpnJobs.returncode, OvpnJobs.created_by,
+                    OvpnJobs.meta, OvpnJobs.create_time, OvpnJobs.start_time, OvpnJobs.finish_time,
+                    func.substr(OvpnJobs.log, offset + 1).label("log"), func.length(OvpnJobs.log).label("log_length"),
+                ).where(OvpnJobs.id == job_id)
+            ).mappings().first()
+        if row is None:
+            return None
+        job = dict(row)
+        job["id"] = str(job["id"])
+        job["state"] = OvpnJobs.STATUS_CHOICE.get(job["status"], "unknown")
+        job["offset"] = job.pop("log_length") or 0
+        return job
+
+    @classmethod
+    def ensure_started(cls) -> None:
+        """ Start the worker threads once per process, a forked worker starts its own. """
+        pid = os.getpid()
+        if cls._pid == pid:
+            return
+        with cls._lock:
+            if cls._pid == pid:
+                return
+            cls._pid = pid
+            for i in range(ProductionConfig.OVPN_JOB_WORKERS):
+                threading.Thread(target=cls._work, name="ovpn-job-{}".format(i), daemon=True).start()
+
+    @classmethod
+    def run_one(cls, job_id) -> None:
+        """ Run the job job_id in the calling thread, unless a worker of another process claims it first.
+
+        No other job is claimed: unlike ensure_started(), a short lived process like a CLI
+        command does not take jobs it may be killed in the middle of.
+        """
+        try:
+            with engine.connect() as conn:
+                while True:
+                    job = cls._claim(conn, job_id=job_id)
+                    if job is not None:
+                        cls._run(conn, job)
+                        return
+                    status = conn.execute(select(OvpnJobs.status).where(OvpnJobs.id == job_id)).scalar()
+                    conn.rollback()
+                    if status != JOB_QUEUED:
+                        return
+                    # the pki slots are taken by other jobs
+                    time.sleep(1)
+        except Exception as e:
+            logger.error("Job {} failed to run: {}".format(job_id, str(e)))
+
+    @classmethod
+    def on_done(cls, kind, handler) -> None:
+        """ Call handler(job) after a successful run of a job of kind, in the worker thread.
+
+        The job is {'id', 'kind', 'pki', 'args', 'meta'}, the dict returned by the handler is
+        merged into the job meta, an exception fails the job.
+        """
+        cls._done_handlers.setdefault(kind, []).append(handler)
+
+    @classmethod
+    def wake(cls, payload=None) -> None:
+        cls._wakeup.set()
+
+    @classmethod
+    def _work(cls) -> None:
+        while True:
+            cls._wakeup.wait(ProductionConfig.OVPN_JOB_POLL)
+            cls._wakeup.clear()
+            try:
+                # one connection per worker, it holds the pki advisory lock while the job runs
+                with engine.connect() as conn:
+                    while True:
+                        job = cls._claim(conn)
+                        if job is None:
+                            break
+                        cls._run(conn, job)
+            except Exception as e:
+                logger.error("Job worker failed: {}".format(str(e)))
+                time.sleep(ProductionConfig.OVPN_JOB_POLL)
+
+    @classmethod
+    def _claim(cls, conn, job_id=None):
+        """ Mark the oldest queued job whose pki has a free slot as running, only job_id if given. """
+        # the jobs of a killed process stay running, fail them once they are surely over
+        conn.execute(
+            update(OvpnJobs)
+            .where(OvpnJobs.status == JOB_RUNNING)
+            .where(OvpnJobs.start_time < func.now() - datetime.timedelta(seconds=ProductionConfig.OVPN_JOB_TIMEOUT * 2))
+            .values(status=JOB_FAILED, finish_time=func.now(), log=OvpnJobs.log + "\nFATAL ERROR: the worker of this job was lost\n")
+        )
+        conn.commit()
+        query = (
+            select(OvpnJobs.id, OvpnJobs.kind, OvpnJobs.pki, OvpnJobs.args, OvpnJobs.meta)
+            .where(OvpnJobs.status == JOB_QUEUED)
+            .order_by(OvpnJobs.create_time)
+            .limit(20)
+            .with_for_update(skip_locked=True)
+        )
+        if job_id is not None:
+            query = query.where(OvpnJobs.id == job_id)
+        rows = conn.execute(query).all()
+        for job_id, kind, pki, args, meta in rows:
+            for slot in range(ProductionConfig.OVPN_JOB_PKI_CONCURRENCY):
+                # session lock, kept after the commit until the job is done
+                if conn.execute(text("SELECT pg_try_advisory_lock(hashtext(:pki), :slot)"), {"pki": pki, "slot": slot}).scalar():
+                    conn.execute(
+                        update(OvpnJobs).where(OvpnJobs.id == job_id).values(status=JOB_RUNNING, start_time=func.now())
+                    )
+                    conn.commit()
+                    return {"id": job_id, "kind": kind, "pki": pki, "args": args, "meta": meta or {}, "slot": slot}
+        conn.rollback()
+        return None
+
+    @classmethod
+    def _run(cls, conn, job) -> None:
+        script, marker = JOB_SCRIPTS[job["kind"]]
+        cmd = ["bash", os.path.join(VPNTOOL_DIR, script)] + list(job["args"])
+        logger.info("Job {} started: {}".format(job["id"], " ".join(cmd)))
+        returncode = None
+        succeeded = False
+        try:
+            # meta env: extra environment of the script, e.g. the REQDIR of the job
+            env = dict(os.environ, **job["meta"].get("env", {}))
+            proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, errors="replace", env=env)
+            timer = threading.Timer(ProductionConfig.OVPN_JOB_TIMEOUT, proc.kill)
+            timer.start()
+            try:
+                buffered, flushed = [], time.monotonic()
+                for line in proc.stdout:
+                    succeeded = succeeded or marker in line
+                    buffered.append(line)
+                    if time.monotonic() - flushed >= LOG_FLUSH_INTERVAL:
+                        cls._append_log(conn, job["id"], buffered)
+                        buffered, flushed = [], time.monotonic()
+                returncode = proc.wait()
+                if not timer.is_alive():
+                    buffered.append("\nFATAL ERROR: killed after {}s\n".format(ProductionConfig.OVPN_JOB_TIMEOUT))
+                cls._append_log(conn, job["id"], buffered)
+            finally:
+                timer.cancel()
+            if returncode == 0 and succeeded:
+                meta = dict(job["meta"])
+                for handler in cls._done_handlers.get(job["kind"], []):
+                    meta.update(handler(dict(job, meta=meta)) or {})
+                if meta != job["meta"]:
+                    conn.execute(update(OvpnJobs).where(OvpnJobs.id == job["id"]).values(meta=meta))
+                    conn.commit()
+        except Exception as e:
+            logger.error("Job {} failed: {}".format(job["id"], str(e)))
+            succeeded = False
+            conn.rollback()
+            cls._append_log(conn, job["id"], ["\nFATAL ERROR: {}\n".format(str(e))])
+        finally:
+            ok = returncode == 0 and succeeded
+            conn.execute(
+                update(OvpnJobs).where(OvpnJobs.id == job["id"]).values(
+                    status=JOB_DONE if ok else JOB_FAILED, returncode=returncode, finish_time=func.now()
+                )
+            )
+            conn.commit()
+            conn.execute(text("SELECT pg_advisory_unlock(hashtext(:pki), :slot)"), {"pki": job["pki"], "slot": job["slot"]})
+            conn.commit()
+            req_dir = job["meta"].get("env", {}).get("REQDIR")
+            if req_dir:
+                # emptied by a successful run, the reqs of a failed one are kept for a look
+                try:
+                    os.rmdir(req_dir)
+                except OSError:
+                    pass
+        logger.info("Job {} {}: return code {}".format(job["id"], "done" if ok else "failed", returncode))
+
+    @classmethod
+    def _append_log(cls, conn, job_id, lines) -> None:
+        if not lines:
+            return
+        conn.execute(update(OvpnJobs).where(OvpnJobs.id == job_id).values(log=OvpnJobs.log + "".join(lines)))
+        conn.commit()
+
+
+SystemConfig.on_notify(NOTIFY_CHANNEL, JobQueue.wake)
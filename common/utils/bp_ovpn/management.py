@@ -0,0 +1,478 @@
+"""
+    OpenVPN management interface client and the per-server connection pool.
+
+    OpenVPN serves one management client at a time, so the connections are owned by one
+    process, the ``flask sync-status`` loop, and never opened by the uWSGI workers. The
+    live clients list is refreshed by ``status 3`` and kept up to date between refreshes
+    by the real-time ``>CLIENT:`` and ``>BYTECOUNT_CLI:`` notifications. The owner writes
+    the live clients of every server to OVPN_MANAGEMENT_STATE_DIR at each sync and sends
+    the connect/disconnect events by NOTIFY, the workers read the snapshots by
+    read_live_clients().
+"""
+import datetime
+import functools
+import json
+import os
+import queue
+import socket
+import threading
+import time
+
+from config import ProductionConfig
+from myproject.context import logger
+from .status import parse_status_lines
+from .events import publish_client_events
+from .proxy_config import write_atomic
+
+
+class OvpnManagementError(Exception):
+    """Management interface is not reachable or returned an error."""
+
+
+class OvpnManagementClient(object):
+    """ Long-lived client of one OpenVPN management interface.
+
+    Args:
+        host (str): management interface address
+        port (int): management interface port
+        password (str, optional): management password, the content of the pw-file
+        timeout (float, optional): socket/command timeout in seconds
+        status_ttl (float, optional): seconds before ``status 3`` is sent again
+        bytecount_interval (int, optional): seconds between ``>BYTECOUNT_CLI:`` notifications, 0 to disable
+        reconnect_interval (float, optional): minimum seconds between two reconnect attempts
+    """
+
+    def __init__(self, host, port, password=None, timeout=5, status_ttl=5, bytecount_interval=5, reconnect_interval=10):
+        self.host = host
+        self.port = int(port)
+        self.password = password or None
+        self.timeout = timeout
+        self.status_ttl = status_ttl
+        self.bytecount_interval = bytecount_interval
+        self.reconnect_interval = reconnect_interval
+
+        self._sock = None
+        self._reader = None
+        self._buffer = b""
+        self._responses = queue.Queue()
+        self._cmd_lock = threading.Lock()
+        self._state_lock = threading.Lock()
+        self._last_connect = 0.0
+        self._last_status = 0.0
+
+        # cn -> client info, client id -> cn
+        self._clients = {}
+        self._cids = {}
+        # pending >CLIENT: event waiting for its ENV block
+        self._event = None
+        # called with (event, client info) after a client connected or disconnected
+        self.on_event = None
+
+    def __repr__(self) -> str:
+        return f"OvpnManagementClient(host={self.host!r}, port={self.port!r}, connected={self.connected!r})"
+
+    @property
+    def connected(self) -> bool:
+        return self._sock is not None
+
+    """
+        Connection
+    """
+
+    def connect(self) -> None:
+        """ Connect and authenticate, then start the notification reader thread.
+
+        Raises:
+            OvpnManagementError: failed to connect or wrong password
+        """
+        self._last_connect = time.monotonic()
+        logger.debug("Connect to openvpn management interface {}:{}".format(self.host, self.port))
+        try:
+            sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        except OSError as e:
+            raise OvpnManagementError("Failed to connect to {}:{}: {}".format(self.host, self.port, e))
+
+        self._buffer = b""
+        self._responses = queue.Queue()
+        try:
+            if self.password:
+                self._read_until(sock, b"ENTER PASSWORD:")
+                sock.sendall(self.password.encode("utf-8") + b"\n")
+                line = self._read_line(sock)
+                while line.startswith(">"):
+                    line = self._read_line(sock)
+                if not line.startswith("SUCCESS"):
+                    raise OvpnManagementError("Management password rejected: {}".format(line))
+        except (OSError, OvpnManagementError) as e:
+            sock.close()
+            raise OvpnManagementError("Management handshake failed: {}".format(e))
+
+        # the reader thread blocks on recv, the command timeout is handled by the response queue
+        sock.settimeout(None)
+        self._sock = sock
+        self._reader = threading.Thread(
+            target=self._read_loop, args=(sock,), name="ovpn-mgmt-{}".format(self.port), daemon=True
+        )
+        self._reader.start()
+
+        if self.bytecount_interval:
+            self._send_command("bytecount {}".format(int(self.bytecount_interval)))
+
+    def close(self) -> None:
+        """ Close the connection, the next command will reconnect. """
+        sock, self._sock = self._sock, None
+        if sock is not None:
+            try:
+                sock.sendall(b"quit\n")
+            except OSError:
+                pass
+            try:
+                sock.close()
+            except OSError:
+                pass
+        # release a command waiting for its response
+        self._responses.put(None)
+
+    def _ensure_connected(self) -> None:
+        if self._sock is not None:
+            return
+        wait = self.reconnect_interval - (time.monotonic() - self._last_connect)
+        if self._last_connect and wait > 0:
+            raise OvpnManagementError("Management interface {}:{} unavailable, retry in {:.0f}s".format(self.host, self.port, wait))
+        self.connect()
+
+    def _read_until(self, sock, marker: bytes) -> None:
+        while marker not in self._buffer:
+            data = sock.recv(4096)
+            if not data:
+                raise OvpnManagementError("Connection closed by the management interface.")
+            self._buffer += data
+        self._buffer = self._buffer.split(marker, 1)[1]
+
+    def _read_line(self, sock) -> str:
+        while b"\n" not in self._buffer:
+            data = sock.recv(4096)
+            if not data:
+                raise OvpnManagementError("Connection closed by the management interface.")
+            self._buffer += data
+        line, self._buffer = self._buffer.split(b"\n", 1)
+        return line.decode("utf-8", errors="replace").rstrip("\r")
+
+    def _read_loop(self, sock) -> None:
+        try:
+            while True:
+                line = self._read_line(sock)
+                if line.startswith(">"):
+                    self._handle_notification(line[1:])
+                else:
+                    self._responses.put(line)
+        except (OSError, OvpnManagementError) as e:
+            if self._sock is sock:
+                logger.error("Openvpn management interface {}:{} disconnected: {}".format(self.host, self.port, e))
+                self._sock = None
+                self._responses.put(None)
+
+    """
+        Commands
+    """
+
+    def _send_command(self, cmd: str, multiline=False) -> list:
+        sock = self._sock
+        if sock is None:
+            raise OvpnManagementError("Not connected.")
+        # drop stale responses of a timed out command
+        while not self._responses.empty():
+            self._responses.get_nowait()
+        try:
+            sock.sendall(cmd.encode("utf-8") + b"\n")
+        except OSError as e:
+            self.close()
+            raise OvpnManagementError("Failed to send command {!r}: {}".format(cmd, e))
+
+        lines = []
+        deadline = time.monotonic() + self.timeout
+        while True:
+            try:
+                line = self._responses.get(timeout=max(deadline - time.monotonic(), 0.01))
+            except queue.Empty:
+                self.close()
+                raise OvpnManagementError("Command {!r} timed out.".format(cmd))
+            if line is None:
+                raise OvpnManagementError("Connection lost during command {!r}.".format(cmd))
+            if not multiline:
+                if line.startswith("ERROR"):
+                    raise OvpnManagementError(line)
+                return [line]
+            if line == "END":
+                return lines
+            lines.append(line)
+
+    def command(self, cmd: str, multiline=False) -> list:
+        """ Send one command, reconnect first if the connection was lost.
+
+        Args:
+            cmd (str): management command, e.g. ``status 3``
+            multiline (bool, optional): response is terminated by ``END``
+
+        Returns:
+            list: response lines
+        """
+        with self._cmd_lock:
+            self._ensure_connected()
+            return self._send_command(cmd, multiline=multiline)
+
+    def status(self, force=False) -> dict:
+        """ Refresh the live clients with ``status 3``, at most once per status_ttl.
+
+        Returns:
+            dict: cn -> client info, see ``parse_status_lines``
+        """
+        if force or time.monotonic() - self._last_status >= self.status_ttl:
+            lines = self.command("status 3", multiline=True)
+            parsed = parse_status_lines(lines)
+            with self._state_lock:
+                self._clients = parsed["clients"]
+                self._cids = {c["client_id"]: cn for cn, c in self._clients.items() if c["client_id"]}
+                self._last_status = time.monotonic()
+        return self.get_clients()
+
+    def get_clients(self) -> dict:
+        """ Current clients, without any management round trip.
+
+        Returns:
+            dict: cn -> client info (copy)
+        """
+        with self._state_lock:
+            return {cn: dict(c) for cn, c in self._clients.items()}
+
+    def kill(self, cn: str) -> str:
+        """ Disconnect a client by common name. """
+        return self.command("kill {}".format(cn))[0]
+
+    """
+        Real-time notifications
+    """
+
+    def _handle_notification(self, message: str) -> None:
+        source, _, payload = message.partition(":")
+        if source == "BYTECOUNT_CLI":
+            cid, bytes_in, bytes_out = (payload.split(",") + ["", "", ""])[:3]
+            try:
+                bytes_in, bytes_out = int(bytes_in or 0), int(bytes_out or 0)
+            except ValueError:
+                logger.warning("Invalid management notification skipped: {!r}".format(message))
+                return
+            with self._state_lock:
+                cn = self._cids.get(cid)
+                if cn in self._clients:
+                    # bytes in/out are seen from the server side
+                    self._clients[cn]["bytes_received"] = bytes_in
+                    self._clients[cn]["bytes_sent"] = bytes_out
+        elif source == "CLIENT":
+            self._handle_client_event(payload)
+
+    def _handle_client_event(self, payload: str) -> None:
+        fields = payload.split(",")
+        event = fields[0]
+        if event == "ENV":
+            if self._event is None:
+                return
+            if fields[1] == "END":
+                event, self._event = self._event, None
+                self._apply_client_event(event)
+            else:
+                name, _, value = ",".join(fields[1:]).partition("=")
+                self._event["env"][name] = value
+        elif event == "ADDRESS":
+            cid, address = fields[1], fields[2]
+            with self._state_lock:
+                cn = self._cids.get(cid)
+                if cn in self._clients:
+                    self._clients[cn]["virtual_address"] = address
+        else:
+            # CONNECT, REAUTH, ESTABLISHED, DISCONNECT, CR_RESPONSE, all followed by an ENV block
+            self._event = {"event": event, "cid": fields[1] if len(fields) > 1 else "", "env": {}}
+
+    def _apply_client_event(self, event: dict) -> None:
+        env = event["env"]
+        cn = env.get("common_name") or self._cids.get(event["cid"])
+        if not cn:
+            return
+        client = None
+        with self._state_lock:
+            if event["event"] == "DISCONNECT":
+                client = self._clients.pop(cn, None) or {"cn": cn, "virtual_address": env.get("ifconfig_pool_remote_ip", "")}
+                self._cids.pop(event["cid"], None)
+            elif event["event"] == "ESTABLISHED":
+                since = env.get("time_unix")
+                real_address = env.get("trusted_ip", "")
+                if real_address and env.get("trusted_port"):
+                    real_address = "{}:{}".format(real_address, env["trusted_port"])
+                self._clients[cn] = {
+                    "cn": cn,
+                    "real_address": real_address,
+                    "virtual_address": env.get("ifconfig_pool_remote_ip", ""),
+                    "bytes_received": 0,
+                    "bytes_sent": 0,
+                    "connected_since": datetime.datetime.fromtimestamp(int(since), tz=datetime.timezone.utc) if since else None,
+                    "client_id": event["cid"],
+                }
+                self._cids[event["cid"]] = cn
+                client = dict(self._clients[cn])
+        if client is not None and self.on_event is not None:
+            try:
+                self.on_event(event["event"], client)
+            except Exception as e:
+                logger.error("Management event handler failed: {}".format(e))
+
+
+def _state_file(server_id) -> str:
+    return os.path.join(ProductionConfig.OVPN_MANAGEMENT_STATE_DIR, "{}.json".format(server_id))
+
+
+# server id -> (mtime_ns, live clients) of the last snapshot read by this process
+_snapshots = {}
+
+
+def read_live_clients(server_id):
+    """ Live clients of a server written by the owner of the management connections.
+
+    Returns:
+        dict: cn -> client info, see ``parse_status_lines``, None if there is no recent snapshot
+    """
+    path = _state_file(server_id)
+    try:
+        mtime_ns = os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+    cached = _snapshots.get(str(server_id))
+    if cached is None or cached[0] != mtime_ns:
+        try:
+            with open(path, "r") as fp:
+                snapshot = json.load(fp)
+        except (OSError, ValueError):
+            return None
+        clients = snapshot.get("clients", {})
+        for client in clients.values():
+            if client.get("connected_since"):
+                client["connected_since"] = datetime.datetime.fromisoformat(client["connected_since"])
+        cached = _snapshots[str(server_id)] = (mtime_ns, snapshot.get("updated", 0), clients)
+    # the owner is gone or can not reach the management interface
+    if time.time() - cached[1] > ProductionConfig.OVPN_MANAGEMENT_STATE_MAX_AGE:
+        return None
+    return {cn: dict(c) for cn, c in cached[2].items()}
+
+
+class OvpnManagementPool(object):
+    """ Pool of the owner process, one management client per openvpn server id. """
+
+    _clients = {}
+    _lock = threading.Lock()
+    # (server id, cn) -> last event not sent yet, sent together by _flush_events
+    _events = {}
+    _events_timer = None
+
+    @classmethod
+    def get(cls, server) -> OvpnManagementClient:
+        """ Get the management client of a server, create it on first use.
+
+        Args:
+            server (OvpnServers): openvpn server with management_port/management_password
+
+        Returns:
+            OvpnManagementClient: client or None if the server has no management port
+        """
+        if server is None or not server.management_port:
+            return None
+        key = str(server.id)
+        with cls._lock:
+            client = cls._clients.get(key)
+            if client is not None and (client.port != int(server.management_port)
+                                       or client.password != (server.management_password or None)):
+                logger.info("Management settings of openvpn server {} changed, reconnect.".format(server.server_name))
+                client.close()
+                client = None
+            if client is None:
+                client = OvpnManagementClient(
+                    ProductionConfig.OVPN_MANAGEMENT_HOST,
+                    server.management_port,
+                    password=server.management_password,
+                    timeout=ProductionConfig.OVPN_MANAGEMENT_TIMEOUT,
+                    status_ttl=ProductionConfig.OVPN_MANAGEMENT_STATUS_TTL,
+                    bytecount_interval=ProductionConfig.OVPN_MANAGEMENT_BYTECOUNT,
+                )
+                client.on_event = functools.partial(cls._publish_event, key)
+                cls._clients[key] = client
+            return client
+
+    @classmethod
+    def _publish_event(cls, server_id, event, client) -> None:
+        # a restart of openvpn reconnects all the clients at once: one NOTIFY per burst, not per client
+        with cls._lock:
+            cls._events[(server_id, client["cn"])] = {
+                "server_id": server_id,
+                "cn": client["cn"],
+                "status": 1 if event == "ESTABLISHED" else 0,
+                "ip": client.get("virtual_address", ""),
+            }
+            if cls._events_timer is None:
+                cls._events_timer = threading.Timer(ProductionConfig.OVPN_MANAGEMENT_EVENTS_DELAY, cls._flush_events)
+                cls._events_timer.daemon = True
+                cls._events_timer.start()
+
+    @classmethod
+    def _flush_events(cls) -> None:
+        with cls._lock:
+            events, cls._events, cls._events_timer = list(cls._events.values()), {}, None
+        publish_client_events(events)
+
+    @classmethod
+    def sync(cls, server) -> bool:
+        """ Refresh the live clients of a server and write them for the uWSGI workers.
+
+        Returns:
+            bool: False if the server has no management port or the interface failed
+        """
+        client = cls.get(server)
+        if client is None:
+            return False
+        try:
+            clients = client.status()
+        except OvpnManagementError as e:
+            logger.error("Failed to get live clients of {}: {}".format(server.server_name, str(e)))
+            return False
+        try:
+            os.makedirs(ProductionConfig.OVPN_MANAGEMENT_STATE_DIR, mode=0o750, exist_ok=True)
+            write_atomic(_state_file(server.id), json.dumps({"updated": time.time(), "clients": clients}, default=str))
+        except OSError as e:
+            logger.error("Failed to write the live clients of {}: {}".format(server.server_name, str(e)))
+            return False
+        return True
+
+    @classmethod
+    def retain(cls, server_ids) -> None:
+        """ Close the clients and remove the snapshots of the servers not in server_ids, e.g. deleted ones. """
+        keep = {str(i) for i in server_ids}
+        with cls._lock:
+            gone = [key for key in cls._clients if key not in keep]
+        for key in gone:
+            cls.discard(key)
+            try:
+                os.unlink(_state_file(key))
+            except OSError:
+                pass
+
+    @classmethod
+    def discard(cls, server_id) -> None:
+        """ Close and drop the client of a server. """
+        with cls._lock:
+            client = cls._clients.pop(str(server_id), None)
+        if client is not None:
+            client.close()
+
+    @classmethod
+    def close_all(cls) -> None:
+        with cls._lock:
+            clients, cls._clients = list(cls._clients.values()), {}
+        for client in clients:
+            client.close()
@@ -0,0 +1,130 @@
+"""
+    Background sampler of the system metrics shown by the dashboard.
+
+    A daemon thread samples CPU, memory, swap, load and the traffic of every network
+    interface at a fixed interval into a ring buffer, the dashboard requests only copy
+    the latest sample and the history instead of calling psutil themselves.
+"""
+import collections
+import os
+import threading
+import time
+
+import psutil
+
+from config import ProductionConfig
+from myproject.context import logger
+
+
+class SystemSampler(object):
+    """ Ring buffer of the system metrics samples.
+
+    Args:
+        interval (float, optional): seconds between two samples
+        size (int, optional): samples kept in the buffer
+    """
+
+    def __init__(self, interval=5, size=120):
+        self.interval = interval
+        self.samples = collections.deque(maxlen=size)
+        self._lock = threading.Lock()
+        self._pid = None
+        self._thread = None
+        self._net = None
+        # called with every new sample, e.g. to push it to the dashboard
+        self._listeners = []
+
+    def __repr__(self) -> str:
+        return f"SystemSampler(interval={self.interval!r}, samples={len(self.samples)!r})"
+
+    def ensure_started(self) -> None:
+        """ Start the sampler thread once per process, a forked worker starts its own. """
+        pid = os.getpid()
+        if self._pid == pid:
+            return
+        with self._lock:
+            if self._pid == pid:
+                return
+            self._pid = pid
+            self.samples.clear()
+            self._net = None
+            # the first cpu_percent(None) has nothing to compare to
+            psutil.cpu_percent(interval=None)
+            self.samples.append(self.sample())
+            self._thread = threading.Thread(target=self._run, name="system-sampler", daemon=True)
+            self._thread.start()
+
+    def _run(self) -> None:
+        while True:
+            time.sleep(self.interval)
+            try:
+                sample = self.sample()
+            except Exception as e:
+                logger.error("Failed to sample the system metrics: {}".format(str(e)))
+                continue
+            with self._lock:
+                self.samples.append(sample)
+            for listener in self._listeners:
+                try:
+                    listener(sample)
+                except Exception as e:
+                    logger.error("System sample listener failed: {}".format(str(e)))
+
+    def add_listener(self, listener) -> None:
+        self._listeners.append(listener)
+
+    def sample(self) -> dict:
+        """ One sample, the traffic is the rate since the previous sample. """
+        now = time.time()
+        vm = psutil.virtual_memory()
+        sw = psutil.swap_memory()
+        counters = psutil.net_io_counters(pernic=True)
+        net = {}
+        if self._net is not None:
+            previous, previous_time = self._net
+            elapsed = max(now - previous_time, 0.001)
+            for nic, c in counters.items():
+                p = previous.get(nic)
+                if p is None:
+                    continue
+                net[nic] = {
+                    "rx_bps": round(max(c.bytes_recv - p.bytes_recv, 0) / elapsed, 1),
+                    "tx_bps": round(max(c.bytes_sent - p.bytes_sent, 0) / elapsed, 1),
+                }
+        self._net = (counters, now)
+        return {
+            "time": now,
+            "cpu_percent": psutil.cpu_percent(interval=None),
+            "load_avg": psutil.getloadavg(),
+            "memory_total": round(vm.total/1024/1024, 1),
+            "memory_used": round(vm.used/1024/1024, 1),
+            "memory_percent": vm.percent,
+            "swap_total": round(sw.total/1024/1024, 1),
+            "swap_used": round(sw.used/1024/1024, 1),
+            "swap_percent": round(sw.percent, 1),
+            "net": net,
+        }
+
+    def latest(self) -> dict:
+        """ Copy of the latest sample. """
+        self.ensure_started()
+        with self._lock:
+            return dict(self.samples[-1])
+
+    def history(self, keys=("time", "cpu_percent", "memory_percent", "swap_percent", "load_avg")) -> dict:
+        """ Series of the buffered samples, key -> [values], for the dashboard sparklines. """
+        self.ensure_started()
+        with self._lock:
+            samples = list(self.samples)
+        history = {key: [s[key] for s in samples] for key in keys}
+        history["net"] = {}
+        for s in samples:
+            for nic, rates in s["net"].items():
+                series = history["net"].setdefault(nic, {"rx_bps": [], "tx_bps": []})
+                series["rx_bps"].append(rates["rx_bps"])
+                series["tx_bps"].append(rates["tx_bps"])
+        return history
+
+
+# process wide sampler of the dashboard
+system_sampler = SystemSampler(interval=ProductionConfig.OVPN_METRICS_INTERVAL, size=ProductionConfig.OVPN_METRICS_HISTORY)
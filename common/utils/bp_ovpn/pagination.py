@@ -0,0 +1,108 @@
+"""
+    Keyset (seek) pagination state and cached totals for the server side DataTables lists.
+
+    DataTables only posts start/length, so the sort key of the last row of every page served
+    is remembered here. When the next request asks for a start we have seen, the page is
+    read with ``WHERE (sort_col, id) > (last_value, last_id)`` instead of ``OFFSET start``.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+
+class KeysetCursorCache(object):
+    """ LRU cache of page boundaries: (list key, start) -> (sort value, id) of the row before start.
+
+    Args:
+        max_size (int, optional): max boundaries kept
+        ttl (float, optional): seconds a boundary is used, the rows may move after inserts/deletes
+    """
+
+    def __init__(self, max_size=5000, ttl=300):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._boundaries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, start):
+        if not start:
+            return None
+        with self._lock:
+            item = self._boundaries.get((key, start))
+            if item is None:
+                return None
+            if time.monotonic() - item[1] > self.ttl:
+                del self._boundaries[(key, start)]
+                return None
+            self._boundaries.move_to_end((key, start))
+            return item[0]
+
+    def set(self, key, start, boundary) -> None:
+        with self._lock:
+            self._boundaries[(key, start)] = (boundary, time.monotonic())
+            self._boundaries.move_to_end((key, start))
+            while len(self._boundaries) > self.max_size:
+                self._boundaries.popitem(last=False)
+
+    def invalidate(self, prefix=None) -> None:
+        """ Drop the boundaries whose list key starts with prefix, all if prefix is None. """
+        with self._lock:
+            if prefix is None:
+                self._boundaries.clear()
+                return
+            for k in [k for k in self._boundaries if k[0][0] == prefix]:
+                del self._boundaries[k]
+
+
+class CountCache(object):
+    """ Cached row counts, e.g. the DataTables recordsTotal of one server.
+
+    The clients are also written by processes outside the app (learn-address sink),
+    so the counts expire after ttl seconds in addition to the explicit invalidation.
+
+    Args:
+        ttl (float, optional): seconds a count is used
+    """
+
+    def __init__(self, ttl=30):
+        self.ttl = ttl
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def peek(self, key):
+        """ Get the count, None if missing or expired. """
+        with self._lock:
+            item = self._counts.get(key)
+        if item is not None and time.monotonic() - item[1] <= self.ttl:
+            return item[0]
+        return None
+
+    def set(self, key, count) -> None:
+        with self._lock:
+            self._counts[key] = (count, time.monotonic())
+
+    def get(self, key, loader):
+        """ Get the count, call loader() to count again if missing or expired. """
+        count = self.peek(key)
+        if count is None:
+            count = loader()
+            self.set(key, count)
+        return count
+
+    def invalidate(self, key=None) -> None:
+        with self._lock:
+            if key is None:
+                self._counts.clear()
+            else:
+                self._counts.pop(key, None)
+
+
+# ovpn_clients list of each server
+clients_cursors = KeysetCursorCache()
+clients_totals = CountCache()
+
+
+def invalidate_clients_cache(server_id=None) -> None:
+    """ Call after clients of a server were inserted or deleted. """
+    clients_totals.invalidate(None if server_id is None else str(server_id))
+    clients_cursors.invalidate(None if server_id is None else str(server_id))
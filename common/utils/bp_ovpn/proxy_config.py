@@ -0,0 +1,437 @@
+"""
+    Reverse proxy config of the BOSS clients, Apache or nginx by the PROXY_SERVER system config.
+
+    boss.template is compiled once (per file change) into literal parts and placeholders,
+    all the vhost blocks are rendered into one buffer and written to a temp file that
+    replaces reverse_proxy_local.conf by an atomic rename, so Apache never reads a half
+    written file. The missing client urls are stored by one UPDATE ... FROM (VALUES ...)
+    per table. For nginx only the map file of the clients' backends is generated.
+
+    <config>.idx is a sidecar index of the blocks by client ip -> (byte offset,
+    length), written by the builder and by every appended block, so that checking or showing
+    the config of one client is a seek instead of parsing the whole file.
+"""
+import contextlib
+import fcntl
+import hashlib
+import json
+import os
+import pathlib
+import re
+import tempfile
+import threading
+from random import randint
+
+import psycopg2.extras
+
+from myproject.context import logger
+
+PROXY_CONFIG_FILE = "reverse_proxy_local.conf"
+PROXY_TEMPLATE_FILE = "boss.template"
+NGINX_MAP_FILE = "boss_backends.map"
+PROXY_TABLES = ("tunovpnclients", "ovpnclients")
+PLACEHOLDERS = ("__IP_LOCALE__", "__PROXY_PREFIX__", "__IP_CODED__", "__IP_REMOTE__", "__IP_PORT__")
+_PLACEHOLDER_RE = re.compile("|".join(re.escape(p) for p in PLACEHOLDERS))
+PROXY_INDEX_SUFFIX = ".idx"
+# whole ipv4 addresses only, 10.1.1.1 does not match 10.1.1.10
+_IPV4_RE = re.compile(rb"(?<![\d.])\d{1,3}(?:\.\d{1,3}){3}(?!\.?\d)")
+# runs of non empty lines, the blocks are separated by empty lines
+_BLOCK_RE = re.compile(rb"(?:[^\n]+(?:\n|$))+")
+
+
+def ip2hex(ip):
+    """
+        @summary: turn ip to hex
+        @param ip: ip address
+        @return: hex ip prefixed '0x' like: 0x115ff0861
+    """
+    l = ip.split('.')
+    return '0x{:02x}{:02x}{:02x}{:02x}'.format(*map(int, l))
+
+
+def generate_url(proxy_prefix, ip):
+    """
+        @summary: generate BOSS URL
+        @param proxy_prefix: PROXY_PREFIX from db
+        @param ip: ip address
+        @return: boss url like: 9801456451909-0xc0a8788a
+    """
+    hexIp = ip2hex(ip)
+    n = 13
+    randomIntAddress = ''.join(["{}".format(randint(0, 9)) for num in range(0, n)])
+    return '{}-{}'.format(randomIntAddress, hexIp)
+
+
+class ProxyConfigTemplate(object):
+    """ boss.template split into literal parts and placeholders.
+
+    Args:
+        text (str): template text, the first block (up to the first empty line) is used
+    """
+
+    def __init__(self, text):
+        self.text = [p.strip() for p in text.split('\n\n')][0]
+        # literal, placeholder, literal, ..., literal
+        self.parts = []
+        pos = 0
+        for m in _PLACEHOLDER_RE.finditer(self.text):
+            self.parts.append(self.text[pos:m.start()])
+            self.parts.append(m.group(0))
+            pos = m.end()
+        self.parts.append(self.text[pos:])
+
+    def __repr__(self) -> str:
+        return f"ProxyConfigTemplate(parts={len(self.parts)!r})"
+
+    def render(self, values: dict) -> str:
+        """ Render one vhost block, values: placeholder -> value. """
+        parts = self.parts[:]
+        for i in range(1, len(parts), 2):
+            parts[i] = values[parts[i]]
+        return "".join(parts)
+
+
+_templates = {}
+_templates_lock = threading.Lock()
+
+
+def get_proxy_template(path) -> ProxyConfigTemplate:
+    """ Compiled template of a file, compiled again only if the file changed. """
+    path = os.fspath(path)
+    st = os.stat(path)
+    signature = (st.st_ino, st.st_mtime_ns, st.st_size)
+    with _templates_lock:
+        cached = _templates.get(path)
+        if cached is not None and cached[0] == signature:
+            return cached[1]
+    with open(path, "r") as fp:
+        template = ProxyConfigTemplate(fp.read())
+    with _templates_lock:
+        _templates[path] = (signature, template)
+    return template
+
+
+def write_atomic(path, content: str) -> bool:
+    """ Replace a file by rename of a temp file of the same directory.
+
+    Returns:
+        bool: False if the file already had this content and was not written
+    """
+    path = pathlib.Path(path)
+    data = content.encode("utf-8")
+    try:
+        with open(path, "rb") as fp:
+            if hashlib.sha256(fp.read()).digest() == hashlib.sha256(data).digest():
+                return False
+        mode = path.stat().st_mode & 0o777
+    except FileNotFoundError:
+        mode = 0o644
+    fd, tmp = tempfile.mkstemp(dir=path.parent, prefix="." + path.name + ".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as fp:
+            fp.write(data)
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.chmod(tmp, mode)
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+        raise
+    return True
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def _signature(st) -> list:
+    return [st.st_ino, st.st_mtime_ns, st.st_size]
+
+
+class ProxyConfigIndex(object):
+    """ Sidecar index of a proxy config file: client ip -> (offset, length) of its block.
+
+    The index keeps the signature of the config file it was made for, a missing or stale
+    index is made again by parsing the config file once.
+
+    Args:
+        config_file (str): reverse_proxy_local.conf or boss_backends.map
+        exclude (tuple, optional): ips found in every block (IP_REMOTE), not indexed when parsing
+    """
+
+    def __init__(self, config_file, exclude=()):
+        self.config_file = pathlib.Path(config_file)
+        self.index_file = self.config_file.with_name(self.config_file.name + PROXY_INDEX_SUFFIX)
+        self.lock_file = self.config_file.with_name("." + self.config_file.name + ".lock")
+        self.exclude = {ip.encode() for ip in exclude if ip}
+
+    def __repr__(self) -> str:
+        return f"ProxyConfigIndex(index_file={self.index_file.as_posix()!r})"
+
+    @contextlib.contextmanager
+    def locked(self):
+        """ Exclusive lock of the config file against the other writers, threads and processes. """
+        with open(self.lock_file, "a") as fp:
+            fcntl.flock(fp, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(fp, fcntl.LOCK_UN)
+
+    def entries(self) -> dict:
+        """ ip -> (offset, length), cached until the config file changes. """
+        entries = self._cached(_signature(os.stat(self.config_file)))
+        if entries is not None:
+            return entries
+        with self.locked():
+            return self._load()
+
+    def find(self, ip):
+        """ Config block of a client ip.
+
+        Returns:
+            str: the block, None if the ip has no block
+        """
+        for retry in (False, True):
+            entry = (self._load_locked() if retry else self.entries()).get(ip)
+            if entry is None:
+                return None
+            offset, length = entry
+            with open(self.config_file, "rb") as fp:
+                fp.seek(offset)
+                data = fp.read(length)
+            # the file may have been replaced between the stat and the open
+            if ip.encode() in _IPV4_RE.findall(data):
+                return data.decode("utf-8")
+            self.invalidate()
+        return None
+
+    def append(self, ip, block) -> None:
+        """ Append the block of a client to the config file and to the index. """
+        with self.locked():
+            entries = dict(self._load())
+            data = ("\n" + block + "\n").encode("utf-8")
+            with open(self.config_file, "ab") as fp:
+                offset = fp.seek(0, os.SEEK_END) + 1
+                fp.write(data)
+                fp.flush()
+                os.fsync(fp.fileno())
+                signature = _signature(os.fstat(fp.fileno()))
+            entries.setdefault(ip, (offset, len(data) - 2))
+            self.store(signature, entries)
+
+    def store(self, signature, entries) -> None:
+        """ Write the index of the config file with this signature, the caller holds the lock. """
+        write_atomic(self.index_file, json.dumps({"signature": signature, "ip": entries}, separators=(",", ":")))
+        with _indexes_lock:
+            _indexes[os.fspath(self.config_file)] = (signature, entries)
+
+    def invalidate(self) -> None:
+        with _indexes_lock:
+            _indexes.pop(os.fspath(self.config_file), None)
+
+    def _cached(self, signature):
+        with _indexes_lock:
+            cached = _indexes.get(os.fspath(self.config_file))
+        if cached is not None and cached[0] == signature:
+            return cached[1]
+        return None
+
+    def _load_locked(self) -> dict:
+        with self.locked():
+            return self._load()
+
+    def _load(self) -> dict:
+        """ Cached index, else the sidecar, else parse the config file, the caller holds the lock. """
+        signature = _signature(os.stat(self.config_file))
+        entries = self._cached(signature)
+        if entries is not None:
+            return entries
+        try:
+            with open(self.index_file, "r") as fp:
+                data = json.load(fp)
+            if data.get("signature") == signature:
+                entries = {ip: tuple(entry) for ip, entry in data["ip"].items()}
+                with _indexes_lock:
+                    _indexes[os.fspath(self.config_file)] = (signature, entries)
+                return entries
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+        with open(self.config_file, "rb") as fp:
+            content = fp.read()
+            signature = _signature(os.fstat(fp.fileno()))
+        entries = {}
+        for m in _BLOCK_RE.finditer(content):
+            block = m.group(0)
+            stripped = block.strip()
+            if not stripped:
+                continue
+            offset = m.start() + len(block) - len(block.lstrip())
+            for ip in _IPV4_RE.findall(stripped):
+                if ip not in self.exclude:
+                    entries.setdefault(ip.decode(), (offset, len(stripped)))
+        logger.info("Proxy config index {} made from the config file: {} ips".format(self.index_file, len(entries)))
+        self.store(signature, entries)
+        return entries
+
+
+class ProxyConfigBuilder(object):
+    """ Build the Apache reverse_proxy_local.conf from the clients tables, one <Location> per client.
+
+    Args:
+        apache_root (str): DIR_APACHE_ROOT
+        apache_sub (str): DIR_APACHE_SUB
+        proxy_prefix (str): PROXY_PREFIX
+        ip_remote (str): IP_REMOTE
+        ip_port (str): IP_PORT
+    """
+
+    server = "apache"
+
+    def __init__(self, apache_root, apache_sub, proxy_prefix, ip_remote, ip_port):
+        self.config_dir = pathlib.Path(apache_root, apache_sub)
+        self.config_file = self.config_dir / PROXY_CONFIG_FILE
+        self.template_file = self.config_dir / PROXY_TEMPLATE_FILE
+        self.proxy_prefix = proxy_prefix
+        self.ip_remote = ip_remote
+        self.ip_port = ip_port
+        self.index = ProxyConfigIndex(self.config_file, exclude=(ip_remote,))
+
+    def __repr__(self) -> str:
+        return f"{self.__class__.__name__}(config_file={self.config_file.as_posix()!r})"
+
+    def prepare(self) -> bool:
+        """ False if the config can not be written, the config and the template files must exist. """
+        return self.config_file.exists() and self.template_file.exists()
+
+    def renderer(self):
+        """ Function (ip, url) -> config block of a client. """
+        template = get_proxy_template(self.template_file)
+        values = {
+            "__PROXY_PREFIX__": self.proxy_prefix,
+            "__IP_REMOTE__": self.ip_remote,
+            "__IP_PORT__": self.ip_port,
+        }
+
+        def render(ip, url):
+            values["__IP_LOCALE__"] = ip
+            values["__IP_CODED__"] = url
+            return template.render(values)
+
+        return render
+
+    def append(self, ip, url) -> None:
+        """ Add the block of one client to the config file and its index. """
+        self.index.append(ip, self.renderer()(ip, url))
+
+    def build(self, conn, tables=PROXY_TABLES) -> dict:
+        """ Render all the clients and replace the config file if it changed.
+
+        Args:
+            conn (psycopg2.connection): db connection, committed by this call
+            tables (tuple, optional): clients tables with cn, ip and url columns
+
+        Returns:
+            dict: {'clients': int, 'backfilled': int, 'changed': bool}
+        """
+        render = self.renderer()
+        blocks = []
+        # ip -> (byte offset, length) of the block in the written file
+        entries = {}
+        pos = 0
+        backfilled = 0
+        try:
+            with conn.cursor() as cur:
+                for table in tables:
+                    cur.execute("select cn, ip, url from {table} order by cn".format(table=table))
+                    backfills = []
+                    for cn, ip, url in cur.fetchall():
+                        # need to setup proxyConfig, set url to: len("RVRP@9801456451909-0xc0a8788a@") - 30 // len(9801456451909) - 13
+                        if len(url or '') < 10:
+                            url = generate_url(self.proxy_prefix, ip)
+                            backfills.append((cn, url))
+                        block = render(ip, url)
+                        blocks.append(block)
+                        length = len(block.encode("utf-8"))
+                        entries.setdefault(ip, (pos + 1, length))
+                        pos += length + 2
+                    if backfills:
+                        psycopg2.extras.execute_values(
+                            cur,
+                            "update {table} as c set url = v.url from (values %s) as v(cn, url) where c.cn = v.cn".format(table=table),
+                            backfills,
+                            page_size=1000,
+                        )
+                        backfilled += len(backfills)
+            content = "".join("\n" + block + "\n" for block in blocks)
+            # the urls are only kept if the config that uses them is written
+            with self.index.locked():
+                changed = write_atomic(self.config_file, content)
+                self.index.store(_signature(os.stat(self.config_file)), entries)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        logger.info("Proxy config {}: {} clients, {} new urls, changed: {}".format(self.config_file, len(blocks), backfilled, changed))
+        return {"clients": len(blocks), "backfilled": backfilled, "changed": changed}
+
+
+class NginxMapBuilder(ProxyConfigBuilder):
+    """ Build the nginx boss_backends.map from the clients tables, one map entry per client.
+
+    The entries are included by the map of etc/nginx/boss-map.conf, nginx routes the
+    requests by one hash lookup of the first path segment instead of matching locations.
+
+    Args:
+        nginx_root (str): DIR_NGINX_ROOT
+        nginx_sub (str): DIR_NGINX_SUB
+        proxy_prefix (str): PROXY_PREFIX
+        ip_remote (str): IP_REMOTE
+        ip_port (str): IP_PORT, added to the backend address if set
+    """
+
+    server = "nginx"
+
+    def __init__(self, nginx_root, nginx_sub, proxy_prefix, ip_remote, ip_port):
+        super().__init__(nginx_root, nginx_sub, proxy_prefix, ip_remote, ip_port)
+        self.config_file = self.config_dir / NGINX_MAP_FILE
+        self.template_file = None
+        self.index = ProxyConfigIndex(self.config_file)
+
+    def prepare(self) -> bool:
+        """ False if the config dir does not exist, an empty map is created if there is none. """
+        if not self.config_dir.is_dir():
+            return False
+        if not self.config_file.exists():
+            write_atomic(self.config_file, "")
+        return True
+
+    def renderer(self):
+        """ Function (ip, url) -> map entry of a client: "PROXY_PREFIX@url@" backend; """
+        port = ":" + self.ip_port if self.ip_port else ""
+
+        def render(ip, url):
+            return '"{}@{}@" {}{};'.format(self.proxy_prefix, url, ip, port)
+
+        return render
+
+
+def get_proxy_builder(values) -> ProxyConfigBuilder:
+    """ Builder of the proxy server selected by PROXY_SERVER, apache by default.
+
+    Args:
+        values (dict): the system config, app.config
+
+    Raises:
+        KeyError: a system config item of the proxy is missing
+    """
+    if (values.get("PROXY_SERVER") or "apache").strip().lower() == "nginx":
+        return NginxMapBuilder(
+            values["DIR_NGINX_ROOT"], values["DIR_NGINX_SUB"], values["PROXY_PREFIX"], values["IP_REMOTE"], values["IP_PORT"]
+        )
+    return ProxyConfigBuilder(
+        values["DIR_APACHE_ROOT"], values["DIR_APACHE_SUB"], values["PROXY_PREFIX"], values["IP_REMOTE"], values["IP_PORT"]
+    )
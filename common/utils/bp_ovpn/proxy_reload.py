@@ -0,0 +1,197 @@
+"""
+    Debounced graceful reload of the reverse proxy after its config changed.
+
+    The views only request a reload. A daemon thread of the process waits until no other
+    request came for OVPN_PROXY_RELOAD_DELAY seconds (OVPN_PROXY_RELOAD_MAX_DELAY at most),
+    tests the config and reloads the proxy gracefully, the proxied sessions are kept.
+    All the processes share one state file: a reload started after a request covers it,
+    so a burst of changes from any of the workers ends in one reload.
+"""
+import contextlib
+import fcntl
+import json
+import os
+import subprocess
+import threading
+import time
+
+from config import ProductionConfig
+from myproject.context import logger
+from .events import publish_proxy_status
+from .proxy_config import write_atomic
+from .sysconfig import SystemConfig
+
+# command output kept in the state
+MAX_OUTPUT = 2000
+
+
+@contextlib.contextmanager
+def _flock(path):
+    # the state dir is a private runtime dir, not a world writable one, the reload runs as root
+    os.makedirs(os.path.dirname(path), mode=0o750, exist_ok=True)
+    with open(path, "a") as fp:
+        fcntl.flock(fp, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(fp, fcntl.LOCK_UN)
+
+
+class ProxyReloader(object):
+    """ Process wide coordinator of the proxy reloads. """
+
+    _lock = threading.Lock()
+    _wakeup = threading.Event()
+    _pid = None
+    # oldest and latest pending request of this process
+    _first = None
+    _last = None
+    _reasons = []
+
+    @classmethod
+    def request(cls, reason="") -> dict:
+        """ Ask for a reload, it runs in the background a few seconds later.
+
+        Args:
+            reason (str, optional): kept in the state, e.g. the cn whose config changed
+
+        Returns:
+            dict: the current status, see status()
+        """
+        now = time.time()
+        with cls._lock:
+            if cls._first is None:
+                cls._first = now
+            cls._last = now
+            cls._reasons.append(reason)
+        cls._ensure_started()
+        with _flock(cls._state_lock_file()):
+            state = cls._read_state()
+            state["requested"] = max(state.get("requested", 0), now)
+            cls._write_state(state)
+        cls._wakeup.set()
+        return cls.status()
+
+    @classmethod
+    def status(cls) -> dict:
+        """ State of the last reload of any process.
+
+        Returns:
+            dict: {'requested', 'started', 'finished', 'ok', 'output', 'reasons', 'pending', 'running'}
+        """
+        state = cls._read_state()
+        state.setdefault("requested", 0)
+        state.setdefault("started", 0)
+        state.setdefault("finished", 0)
+        state["pending"] = state["requested"] > state["started"]
+        state["running"] = state["started"] > state["finished"]
+        return state
+
+    @classmethod
+    def _ensure_started(cls) -> None:
+        """ Start the reload thread once per process, a forked worker starts its own. """
+        pid = os.getpid()
+        if cls._pid == pid:
+            return
+        with cls._lock:
+            if cls._pid == pid:
+                return
+            cls._pid = pid
+            threading.Thread(target=cls._run, name="proxy-reload", daemon=True).start()
+
+    @classmethod
+    def _run(cls) -> None:
+        while True:
+            cls._wakeup.wait()
+            # wait until the requests stop coming, or for the max delay since the first one
+            while True:
+                with cls._lock:
+                    first, last = cls._first, cls._last
+                if first is None:
+                    break
+                due = min(last + ProductionConfig.OVPN_PROXY_RELOAD_DELAY, first + ProductionConfig.OVPN_PROXY_RELOAD_MAX_DELAY)
+                now = time.time()
+                if now >= due:
+                    break
+                cls._wakeup.clear()
+                cls._wakeup.wait(due - now)
+            with cls._lock:
+                last, reasons = cls._last, cls._reasons
+                cls._first = cls._last = None
+                cls._reasons = []
+                cls._wakeup.clear()
+            if last is None:
+                continue
+            try:
+                cls._reload(last, reasons)
+            except Exception as e:
+                logger.error("Failed to reload the proxy: {}".format(str(e)))
+
+    @classmethod
+    def _reload(cls, last, reasons) -> None:
+        """ Reload unless another process started a reload after the latest change of this one.
+
+        A reload started between the first and the latest pending change only covers the
+        changes before it, the latest ones still need a reload.
+        """
+        # one reload at a time over all the processes, the waiting ones are usually covered by it
+        with _flock(cls._state_file() + ".reload.lock"):
+            state = cls.status()
+            if state["started"] >= last:
+                logger.debug("Proxy reload requested at {} is covered by the reload started at {}".format(last, state["started"]))
+                return
+            started = time.time()
+            with _flock(cls._state_lock_file()):
+                state = cls._read_state()
+                state.update(started=started, reasons=reasons[-10:])
+                cls._write_state(state)
+
+            ok, output = cls._run_commands()
+
+            with _flock(cls._state_lock_file()):
+                state = cls._read_state()
+                state.update(finished=time.time(), ok=ok, output=output[-MAX_OUTPUT:])
+                cls._write_state(state)
+        if ok:
+            logger.info("Proxy reloaded for {} changes in {:.1f}s".format(len(reasons), state["finished"] - started))
+        else:
+            logger.error("Proxy reload failed: {}".format(output))
+        publish_proxy_status(cls.status())
+
+    @classmethod
+    def _run_commands(cls) -> tuple:
+        """ Config test, then the graceful reload if the test passed. """
+        server = (SystemConfig.get("PROXY_SERVER") or "apache").strip().lower()
+        commands = ProductionConfig.OVPN_PROXY_RELOAD_COMMANDS.get(server)
+        if commands is None:
+            return False, "Unknown PROXY_SERVER: {}".format(server)
+        output = ""
+        for cmd in commands:
+            try:
+                res = subprocess.run(cmd, capture_output=True, text=True, timeout=ProductionConfig.OVPN_PROXY_RELOAD_TIMEOUT)
+            except (OSError, subprocess.TimeoutExpired) as e:
+                return False, output + "{}: {}".format(" ".join(cmd), str(e))
+            output += res.stdout + res.stderr
+            if res.returncode != 0:
+                return False, output
+        return True, output
+
+    @classmethod
+    def _state_file(cls) -> str:
+        return ProductionConfig.OVPN_PROXY_RELOAD_STATE
+
+    @classmethod
+    def _state_lock_file(cls) -> str:
+        return cls._state_file() + ".lock"
+
+    @classmethod
+    def _read_state(cls) -> dict:
+        try:
+            with open(cls._state_file(), "r") as fp:
+                return json.load(fp)
+        except (OSError, ValueError):
+            return {}
+
+    @classmethod
+    def _write_state(cls, state) -> None:
+        write_atomic(cls._state_file(), json.dumps(state))
@@ -0,0 +1,253 @@
+"""
+    Bulk generator and teardown of the load test data of flask prepare-data.
+
+    The TEST group and the servers are upserted once and their ids resolved by one query,
+    the users and the clients are streamed by COPY FROM STDIN in chunks into a temp table
+    and moved by INSERT ... SELECT ... ON CONFLICT DO NOTHING, so a rerun only adds the
+    missing rows. 100k clients take seconds instead of one round trip and commit per row.
+    The teardown is one DELETE per table on the exact names the seeder adds, never on a
+    pattern, and the cert trees are removed by a thread pool, one subtree per task.
+"""
+import io
+import ipaddress
+import os
+import shutil
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import psycopg2.extras
+from werkzeug.security import generate_password_hash
+
+from myproject.context import logger, engine
+from .pagination import invalidate_clients_cache
+
+TEST_GROUP = "TEST"
+# first client ip, the clients of all the servers take the following ones
+TEST_START_IP = "10.168.0.0"
+# rows per COPY
+CHUNK_SIZE = 10000
+# the test users log in with their username as password, a cheap hash keeps seeding fast
+TEST_PASSWORD_METHOD = "pbkdf2:sha256:1000"
+# the test clients' cn is test-<uuid>
+TEST_CN_PREFIX = "test-"
+# threads removing the cert trees
+REMOVE_WORKERS = 8
+
+
+def _copy_rows(cur, table, columns, rows) -> int:
+    """ COPY rows into table by chunks of CHUNK_SIZE, tab separated text format. """
+    count = 0
+    buf = io.StringIO()
+    for row in rows:
+        buf.write("\t".join(row))
+        buf.write("\n")
+        count += 1
+        if count % CHUNK_SIZE == 0:
+            buf.seek(0)
+            cur.copy_expert("COPY {} ({}) FROM STDIN".format(table, ", ".join(columns)), buf)
+            buf = io.StringIO()
+    if buf.tell():
+        buf.seek(0)
+        cur.copy_expert("COPY {} ({}) FROM STDIN".format(table, ", ".join(columns)), buf)
+    return count
+
+
+def remove_tree(path, workers=REMOVE_WORKERS) -> None:
+    """ shutil.rmtree with the subtrees two levels down removed concurrently.
+
+    The cert root holds a dir per server and a dir per file kind in each, the unlinks
+    of the thousands of files of one kind are the bulk of the work.
+    """
+    subtrees = []
+    for child in os.scandir(path):
+        if child.is_dir(follow_symlinks=False):
+            subtrees.extend(c.path for c in os.scandir(child.path) if c.is_dir(follow_symlinks=False))
+    if subtrees:
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="rmtree") as executor:
+            list(executor.map(shutil.rmtree, subtrees))
+    shutil.rmtree(path)
+
+
+def _upsert_rows(cur, table, columns, conflict, rows) -> int:
+    """ Stage rows in a temp copy of table, then insert the ones that do not exist yet.
+
+    Args:
+        conflict (str): conflict target like "(username)", None for any unique constraint
+    """
+    staging = "seed_{}".format(table)
+    cur.execute("CREATE TEMP TABLE {} (LIKE {} INCLUDING DEFAULTS) ON COMMIT DROP".format(staging, table))
+    _copy_rows(cur, staging, columns, rows)
+    cur.execute(
+        "INSERT INTO {table} ({cols}) SELECT {cols} FROM {staging} ON CONFLICT {conflict}DO NOTHING".format(
+            table=table, cols=", ".join(columns), staging=staging, conflict=conflict + " " if conflict else ""
+        )
+    )
+    return cur.rowcount
+
+
+class TestDataSeeder(object):
+    """ Test users, servers and clients of prepare-data at any scale.
+
+    Args:
+        users (int): users test1..testN of the TEST group
+        servers (int): servers test1..testN
+        clients (int): clients over all the servers, spread evenly, site names test1..testM per server
+    """
+
+    def __init__(self, users, servers, clients):
+        self.users = users
+        self.servers = servers
+        self.clients = clients
+
+    def __repr__(self) -> str:
+        return f"TestDataSeeder(users={self.users!r}, servers={self.servers!r}, clients={self.clients!r})"
+
+    def server_names(self) -> list:
+        """ Names of the test servers, test1..testN. """
+        return ["test{}".format(i) for i in range(1, self.servers + 1)]
+
+    def user_names(self) -> list:
+        """ Names of the test users, test1..testN. """
+        return ["test{}".format(i) for i in range(1, self.users + 1)]
+
+    def add(self) -> dict:
+        """ Insert the missing test data in one transaction.
+
+        Returns:
+            dict: {'users', 'servers', 'clients'} rows inserted
+        """
+        conn = engine.raw_connection()
+        try:
+            with conn.cursor() as cur:
+                group_id = self._group(cur)
+                users = self._add_users(cur, group_id)
+                servers, server_ids = self._add_servers(cur)
+                clients = self._add_clients(cur, server_ids)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+        if clients:
+            invalidate_clients_cache()
+        result = {"users": users, "servers": servers, "clients": clients}
+        logger.info("Test data added: {}".format(result))
+        return result
+
+    def delete(self) -> dict:
+        """ Delete the test data of this scale in one transaction.
+
+        Only the users and servers of the exact seeded names are deleted, the clients only
+        on those servers, the TEST group and a server only once nothing else refers to them.
+
+        Returns:
+            dict: {'users', 'servers', 'clients'} rows deleted
+        """
+        result = {}
+        servers = self.server_names()
+        conn = engine.raw_connection()
+        try:
+            with conn.cursor() as cur:
+                cur.execute(
+                    "DELETE FROM ovpn_clients WHERE cn LIKE %s AND server_id IN "
+                    "(SELECT id FROM ovpn_servers WHERE server_name = ANY(%s))",
+                    (TEST_CN_PREFIX + "%", servers),
+                )
+                result["clients"] = cur.rowcount
+                cur.execute(
+                    "DELETE FROM om_users WHERE username = ANY(%s) AND group_id IN (SELECT id FROM om_group WHERE name = %s)",
+                    (self.user_names(), TEST_GROUP),
+                )
+                result["users"] = cur.rowcount
+                cur.execute(
+                    "DELETE FROM om_group g WHERE name = %s AND NOT EXISTS (SELECT 1 FROM om_users u WHERE u.group_id = g.id)",
+                    (TEST_GROUP,),
+                )
+                cur.execute(
+                    "DELETE FROM ovpn_servers s WHERE server_name = ANY(%s) "
+                    "AND NOT EXISTS (SELECT 1 FROM ovpn_clients c WHERE c.server_id = s.id)",
+                    (servers,),
+                )
+                result["servers"] = cur.rowcount
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+        if result["clients"]:
+            invalidate_clients_cache()
+        logger.info("Test data deleted: {}".format(result))
+        return result
+
+    def _group(self, cur) -> str:
+        cur.execute(
+            "INSERT INTO om_group (id, name) VALUES (%s, %s) ON CONFLICT (name) DO NOTHING",
+            (str(uuid.uuid4()), TEST_GROUP),
+        )
+        cur.execute("SELECT id FROM om_group WHERE name = %s", (TEST_GROUP,))
+        return str(cur.fetchone()[0])
+
+    def _add_users(self, cur, group_id) -> int:
+        cur.execute("SELECT username FROM om_users WHERE username LIKE %s", ("test%",))
+        existing = {r[0] for r in cur.fetchall()}
+
+        def rows():
+            for i in range(1, self.users + 1):
+                username = "test{}".format(i)
+                # skip the hash of the existing users, it is the expensive part
+                if username in existing:
+                    continue
+                yield (
+                    str(uuid.uuid4()), username, generate_password_hash(username, method=TEST_PASSWORD_METHOD),
+                    username, "{}@example.com".format(username), group_id, "300", "50", "1",
+                )
+
+        return _upsert_rows(
+            cur, "om_users",
+            ("id", "username", "password", "name", "email", "group_id", "line_size", "page_size", "status"),
+            "(username)", rows(),
+        )
+
+    def _add_servers(self, cur) -> tuple:
+        names = self.server_names()
+        added = psycopg2.extras.execute_values(
+            cur,
+            "INSERT INTO ovpn_servers (id, server_name, configuration_dir, configuration_file, status_file, log_file_dir, "
+            "log_file, startup_type, startup_service, certs_dir, learn_address_script, managed, management_port, "
+            "management_password) VALUES %s ON CONFLICT (server_name) DO NOTHING RETURNING id",
+            [
+                (
+                    str(uuid.uuid4()), name, "/etc/openvpn/{}".format(name), "{}.conf".format(name), "{}-status.log".format(name),
+                    "/var/log/", "{}.log".format(name), 1, "{}-ovpn.service".format(name), "certs-{}".format(name), 1, 1,
+                    33000 + i, "123456789",
+                )
+                for i, name in enumerate(names, 1)
+            ],
+            page_size=1000,
+            fetch=True,
+        )
+        cur.execute("SELECT server_name, id FROM ovpn_servers WHERE server_name = ANY(%s)", (names,))
+        ids = dict(cur.fetchall())
+        return len(added), [str(ids[name]) for name in names]
+
+    def _add_clients(self, cur, server_ids) -> int:
+        if not server_ids:
+            return 0
+        per_server, extra = divmod(self.clients, len(server_ids))
+
+        def rows():
+            ip = ipaddress.ip_address(TEST_START_IP)
+            for s, server_id in enumerate(server_ids):
+                for i in range(1, per_server + (1 if s < extra else 0) + 1):
+                    ip += 1
+                    yield (
+                        str(uuid.uuid4()), server_id, "test{}".format(i), "test-{}".format(uuid.uuid4()), ip.exploded, "1", "1",
+                    )
+
+        return _upsert_rows(
+            cur, "ovpn_clients",
+            ("id", "server_id", "site_name", "cn", "ip", "enabled", "status"),
+            None, rows(),
+        )
@@ -0,0 +1,70 @@
+"""
+    Cached list of the managed openvpn servers for the navigation of every page.
+
+    The list is read once and kept until it expires or a server is added, updated or deleted.
+    The change is sent to the other processes by a NOTIFY on the ovpn_servers channel.
+"""
+import threading
+import time
+
+from sqlalchemy import select
+
+from config import ProductionConfig
+from myproject.context import logger, engine
+from orm.ovpn import OvpnServers
+from .sysconfig import SystemConfig
+
+NOTIFY_CHANNEL = "ovpn_servers"
+
+
+class OvpnServerList(object):
+    """ Process wide {server_name: id} of the managed servers. """
+
+    _servers = None
+    _loaded = 0.0
+    # bumped by every invalidation, a load started before it is not kept
+    _version = 0
+    _lock = threading.Lock()
+
+    @classmethod
+    def get(cls) -> dict:
+        """ Managed servers ordered by name, without a DB query while cached.
+
+        Returns:
+            dict: server_name -> str(id), do not modify it
+        """
+        servers = cls._servers
+        if servers is not None and time.monotonic() - cls._loaded <= ProductionConfig.OVPN_SERVER_LIST_TTL:
+            return servers
+        return cls.reload()
+
+    @classmethod
+    def reload(cls) -> dict:
+        version = cls._version
+        # own connection, a failed query must not break the transaction of the request
+        with engine.connect() as conn:
+            rows = conn.execute(
+                select(OvpnServers.server_name, OvpnServers.id).where(OvpnServers.managed == 1).order_by(OvpnServers.server_name)
+            ).all()
+        servers = {server_name: str(server_id) for server_name, server_id in rows}
+        with cls._lock:
+            if version == cls._version:
+                cls._servers = servers
+                cls._loaded = time.monotonic()
+        logger.debug("Openvpn server list loaded: {} servers".format(len(servers)))
+        return servers
+
+    @classmethod
+    def invalidate(cls, payload=None) -> None:
+        """ Drop the list of this process. """
+        with cls._lock:
+            cls._version += 1
+            cls._servers = None
+
+    @classmethod
+    def notify(cls, session, server_id) -> None:
+        """ Drop the list of all the processes when session commits. """
+        SystemConfig.notify(session, [str(server_id)], channel=NOTIFY_CHANNEL)
+
+
+SystemConfig.on_notify(NOTIFY_CHANNEL, OvpnServerList.invalidate)
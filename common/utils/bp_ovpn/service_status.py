@@ -0,0 +1,114 @@
+"""
+    Running status of the openvpn services, probed in batch and cached for a few seconds.
+
+    The systemd units of all the servers are queried by one ``systemctl show`` call,
+    the sysv init scripts are run concurrently in a thread pool.
+"""
+import platform
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from config import ProductionConfig
+from myproject.context import logger
+
+SYSTEMCTL = "/usr/bin/systemctl"
+# states reported as running, "systemctl is-active" returns 0 for them too
+ACTIVE_STATES = ("active", "reloading")
+
+
+class OvpnServiceProber(object):
+    """ Process wide service status cache: (startup_type, startup_service) -> (status, probe time). """
+
+    _cache = {}
+    _lock = threading.Lock()
+    _executor = None
+
+    @classmethod
+    def _key(cls, server) -> tuple:
+        return ("systemd" if str(server.startup_type) == "1" else "sysv", (server.startup_service or "").strip())
+
+    @classmethod
+    def _get_executor(cls) -> ThreadPoolExecutor:
+        with cls._lock:
+            if cls._executor is None:
+                cls._executor = ThreadPoolExecutor(
+                    max_workers=ProductionConfig.OVPN_SERVICE_STATUS_WORKERS, thread_name_prefix="ovpn-status"
+                )
+            return cls._executor
+
+    @classmethod
+    def probe(cls, servers, force=False) -> dict:
+        """ Get the running status of the servers.
+
+        Args:
+            servers (list): OvpnServers
+            force (bool, optional): skip the cached status. Defaults to False.
+
+        Returns:
+            dict: str(server id) -> 1 running, 0 not running or unknown
+        """
+        servers = list(servers)
+        if not platform.system().startswith("Linux"):
+            return {str(server.id): 0 for server in servers}
+
+        now = time.monotonic()
+        ttl = ProductionConfig.OVPN_SERVICE_STATUS_TTL
+        with cls._lock:
+            cached = dict(cls._cache)
+        keys = {cls._key(server) for server in servers if server.startup_service}
+        missing = [k for k in keys if force or k not in cached or now - cached[k][1] > ttl]
+
+        if missing:
+            statuses = {}
+            units = [name for kind, name in missing if kind == "systemd"]
+            scripts = [name for kind, name in missing if kind == "sysv"]
+            if units:
+                statuses.update({("systemd", name): status for name, status in cls._probe_units(units).items()})
+            if scripts:
+                futures = {name: cls._get_executor().submit(cls._probe_script, name) for name in scripts}
+                for name, future in futures.items():
+                    statuses[("sysv", name)] = future.result()
+            now = time.monotonic()
+            with cls._lock:
+                for key, status in statuses.items():
+                    cls._cache[key] = (status, now)
+            cached.update({key: (status, now) for key, status in statuses.items()})
+
+        return {str(server.id): cached.get(cls._key(server), (0, 0))[0] for server in servers}
+
+    @classmethod
+    def invalidate(cls, server=None) -> None:
+        """ Drop the cached status of a server, all if server is None. """
+        with cls._lock:
+            if server is None:
+                cls._cache.clear()
+            else:
+                cls._cache.pop(cls._key(server), None)
+
+    @classmethod
+    def _probe_units(cls, units) -> dict:
+        """ ActiveState of the systemd units by one systemctl call, the blocks follow the order of the units. """
+        try:
+            res = subprocess.run(
+                [SYSTEMCTL, "show", "--no-pager", "--property=ActiveState", "--"] + list(units),
+                capture_output=True, text=True, timeout=ProductionConfig.OVPN_SERVICE_STATUS_TIMEOUT,
+            )
+        except (OSError, subprocess.TimeoutExpired) as e:
+            logger.error("Failed to get openvpn running status: {}".format(str(e)))
+            return {unit: 0 for unit in units}
+        states = [line.partition("=")[2].strip() for line in res.stdout.splitlines() if line.startswith("ActiveState=")]
+        if len(states) != len(units):
+            logger.error("Unexpected systemctl show output for {} units: {}".format(len(units), res.stderr.strip()))
+            return {unit: 0 for unit in units}
+        return {unit: 1 if state in ACTIVE_STATES else 0 for unit, state in zip(units, states)}
+
+    @classmethod
+    def _probe_script(cls, script) -> int:
+        try:
+            res = subprocess.run([script, "status"], capture_output=True, timeout=ProductionConfig.OVPN_SERVICE_STATUS_TIMEOUT)
+            return 1 if res.returncode == 0 else 0
+        except (OSError, subprocess.TimeoutExpired) as e:
+            logger.error("Failed to get openvpn running status of {}: {}".format(script, str(e)))
+            return 0
@@ -0,0 +1,257 @@
+"""
+    In-process certificate signing engine, the Python counterpart of easyrsa build-client-full.
+
+    The CA of a files dir (easyrsa/pki/ca.crt and ca.key) is loaded once per process and
+    kept until the files change, a client cert is signed without spawning openssl or
+    copying the easyrsa tree. The issued files are stored like the vpntool scripts do, in
+    easyrsa-all/pki, and the client profile is rendered from easyrsa/clienttemplates.
+"""
+import contextlib
+import datetime
+import fcntl
+import os
+import re
+import tempfile
+import threading
+import zipfile
+
+try:
+    from cryptography import x509
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa
+    from cryptography.x509.oid import ExtendedKeyUsageOID, NameOID
+except ImportError:  # pragma: no cover - optional, the vpntool scripts are used without it
+    x509 = None
+
+from myproject.context import logger
+
+# dirs of the files dir, as used by the vpntool scripts
+TOOL_DIR = "easyrsa"
+BACKUP_DIR = "easyrsa-all"
+GENERIC_DIR = "generic-ovpn"
+# easyrsa defaults if the vars file does not set them
+DEFAULT_CERT_EXPIRE = 825
+DEFAULT_KEY_SIZE = 2048
+_VAR_RE = re.compile(r'^\s*set_var\s+(EASYRSA_\w+)\s+"?([^"\s]+)"?', re.MULTILINE)
+
+
+class SignerError(Exception):
+    """ The cert can not be issued, e.g. the CN exists or the CA is missing. """
+
+
+class CertSigner(object):
+    """ Client cert issuer of the easyrsa PKI of one files dir.
+
+    Args:
+        files_dir (str): tun or tap files dir, see the vpntool scripts
+    """
+
+    def __init__(self, files_dir):
+        if x509 is None:
+            raise SignerError("The python package cryptography is not installed")
+        self.files_dir = files_dir
+        self.tool_dir = os.path.join(files_dir, TOOL_DIR)
+        self.backup_pki = os.path.join(files_dir, BACKUP_DIR, "pki")
+        self.ca_cert_file = os.path.join(self.tool_dir, "pki", "ca.crt")
+        self.ca_key_file = os.path.join(self.tool_dir, "pki", "private", "ca.key")
+        self.ta_file = os.path.join(self.tool_dir, "ta.key")
+
+        with open(self.ca_cert_file, "rb") as fp:
+            self.ca_cert_pem = fp.read()
+        self.ca_cert = x509.load_pem_x509_certificate(self.ca_cert_pem)
+        with open(self.ca_key_file, "rb") as fp:
+            self.ca_key = serialization.load_pem_private_key(fp.read(), password=None)
+        with open(self.ta_file, "r") as fp:
+            self.ta_key = fp.read()
+        try:
+            with open(os.path.join(self.tool_dir, "vars"), "r") as fp:
+                easyrsa_vars = dict(_VAR_RE.findall(fp.read()))
+        except OSError:
+            easyrsa_vars = {}
+        self.cert_expire = int(easyrsa_vars.get("EASYRSA_CERT_EXPIRE", DEFAULT_CERT_EXPIRE))
+        self.key_size = int(easyrsa_vars.get("EASYRSA_KEY_SIZE", DEFAULT_KEY_SIZE))
+        self.templates = {}
+        for proto in ("udp", "tcp"):
+            parts = []
+            for part in ("header", "footer"):
+                with open(os.path.join(self.tool_dir, "clienttemplates", "template-{}.{}".format(proto, part)), "r") as fp:
+                    parts.append(fp.read())
+            self.templates[proto] = tuple(parts)
+
+    def __repr__(self) -> str:
+        return f"CertSigner(files_dir={self.files_dir!r})"
+
+    def sign_csr(self, csr, days=None):
+        """ Sign a client CSR with the CA, the x509-types/client extensions of easyrsa.
+
+        Args:
+            csr (x509.CertificateSigningRequest or bytes): the request, PEM if bytes
+            days (int, optional): validity, EASYRSA_CERT_EXPIRE by default
+
+        Returns:
+            x509.Certificate: the signed cert
+        """
+        if isinstance(csr, bytes):
+            csr = x509.load_pem_x509_csr(csr)
+        if not csr.is_signature_valid:
+            raise SignerError("The signature of the request is not valid")
+        now = datetime.datetime.now(datetime.timezone.utc)
+        public_key = csr.public_key()
+        builder = (
+            x509.CertificateBuilder()
+            .subject_name(csr.subject)
+            .issuer_name(self.ca_cert.subject)
+            .public_key(public_key)
+            .serial_number(x509.random_serial_number())
+            .not_valid_before(now - datetime.timedelta(minutes=5))
+            .not_valid_after(now + datetime.timedelta(days=days or self.cert_expire))
+            .add_extension(x509.BasicConstraints(ca=False, path_length=None), critical=False)
+            .add_extension(x509.SubjectKeyIdentifier.from_public_key(public_key), critical=False)
+            .add_extension(x509.AuthorityKeyIdentifier.from_issuer_public_key(self.ca_key.public_key()), critical=False)
+            .add_extension(x509.ExtendedKeyUsage([ExtendedKeyUsageOID.CLIENT_AUTH]), critical=False)
+            .add_extension(
+                x509.KeyUsage(
+                    digital_signature=True, content_commitment=False, key_encipherment=False, data_encipherment=False,
+                    key_agreement=False, key_cert_sign=False, crl_sign=False, encipher_only=False, decipher_only=False,
+                ),
+                critical=False,
+            )
+        )
+        return builder.sign(self.ca_key, hashes.SHA256())
+
+    def issue(self, cn, days=None) -> tuple:
+        """ New key and signed cert of a CN, as build-client-full nopass.
+
+        Returns:
+            tuple: (cert, key, csr)
+        """
+        key = rsa.generate_private_key(public_exponent=65537, key_size=self.key_size)
+        csr = (
+            x509.CertificateSigningRequestBuilder()
+            .subject_name(x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, cn)]))
+            .sign(key, hashes.SHA256())
+        )
+        return self.sign_csr(csr, days), key, csr
+
+    def render_profile(self, cert, key, proto="tcp") -> str:
+        """ The client .conf/.ovpn with the inline ca, cert, key and tls-auth. """
+        header, footer = self.templates[proto]
+        key_pem = key.private_bytes(
+            serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption()
+        ).decode()
+        return "".join([
+            header, "\n",
+            "<ca>\n", self.ca_cert_pem.decode(), "</ca>\n",
+            "<cert>\n", cert.public_bytes(serialization.Encoding.PEM).decode(), "</cert>\n",
+            "<key>\n", key_pem, "</key>\n",
+            "key-direction 1\n",
+            "<tls-auth>\n", self.ta_key, "</tls-auth>\n",
+            "\n", footer,
+        ])
+
+    @contextlib.contextmanager
+    def locked(self):
+        """ Exclusive lock of easyrsa-all/pki against the other issuers, threads and processes. """
+        os.makedirs(self.backup_pki, exist_ok=True)
+        with open(os.path.join(self.backup_pki, ".signer.lock"), "a") as fp:
+            fcntl.flock(fp, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(fp, fcntl.LOCK_UN)
+
+    def exists(self, cn) -> bool:
+        return os.path.exists(os.path.join(self.backup_pki, "issued", cn + ".crt")) and \
+            os.path.exists(os.path.join(self.backup_pki, "private", cn + ".key"))
+
+    def store(self, cn, cert, key, csr=None) -> None:
+        """ Save the files of a new cert to easyrsa-all/pki, as the vpntool scripts backup them. """
+        cert_pem = cert.public_bytes(serialization.Encoding.PEM)
+        files = [
+            (os.path.join(self.backup_pki, "issued", cn + ".crt"), cert_pem, 0o644),
+            (os.path.join(self.backup_pki, "certs_by_serial", "{:X}.pem".format(cert.serial_number)), cert_pem, 0o644),
+            (os.path.join(self.backup_pki, "private", cn + ".key"), key.private_bytes(
+                serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption()
+            ), 0o600),
+        ]
+        if csr is not None:
+            files.append((os.path.join(self.backup_pki, "reqs", cn + ".req"), csr.public_bytes(serialization.Encoding.PEM), 0o644))
+        for path, data, mode in files:
+            _write_file(path, data, mode)
+
+    def issue_generic(self, cn) -> str:
+        """ generate-generic-client-cert.sh in-process: new cert, profile and zip of a CN.
+
+        Returns:
+            str: path of generic-ovpn/<cn>.zip
+        """
+        with self.locked():
+            if self.exists(cn):
+                raise SignerError("Certificate for {} already exists!".format(cn))
+            cert, key, csr = self.issue(cn)
+            self.store(cn, cert, key, csr)
+        profile = self.render_profile(cert, key, "tcp")
+        target = os.path.join(self.files_dir, GENERIC_DIR, cn + ".zip")
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(target), prefix=".", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as fp, zipfile.ZipFile(fp, "w", zipfile.ZIP_DEFLATED) as zf:
+                zf.writestr("{}/ta.key".format(cn), self.ta_key)
+                zf.writestr("{}/ca.crt".format(cn), self.ca_cert_pem)
+                zf.writestr("{}/{}.key".format(cn, cn), key.private_bytes(
+                    serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption()
+                ))
+                zf.writestr("{}/{}.crt".format(cn, cn), cert.public_bytes(serialization.Encoding.PEM))
+                zf.writestr("{}/{}.conf".format(cn, cn), profile)
+            os.chmod(tmp, 0o644)
+            os.replace(tmp, target)
+        except BaseException:
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+            raise
+        logger.info("Certificate of {} issued in-process, serial {:X}".format(cn, cert.serial_number))
+        return target
+
+
+def _write_file(path, data, mode) -> None:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as fp:
+            fp.write(data)
+        os.chmod(tmp, mode)
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+        raise
+
+
+_signers = {}
+_signers_lock = threading.Lock()
+
+
+def get_signer(files_dir) -> CertSigner:
+    """ Signer of a files dir, loaded again only if the CA, ta.key or the templates changed. """
+    tool_dir = os.path.join(files_dir, TOOL_DIR)
+    signature = []
+    for path in (("pki", "ca.crt"), ("pki", "private", "ca.key"), ("ta.key",), ("vars",), ("clienttemplates",)):
+        try:
+            st = os.stat(os.path.join(tool_dir, *path))
+            signature.append((st.st_ino, st.st_mtime_ns, st.st_size))
+        except FileNotFoundError:
+            signature.append(None)
+    with _signers_lock:
+        cached = _signers.get(files_dir)
+        if cached is not None and cached[0] == signature:
+            return cached[1]
+    try:
+        signer = CertSigner(files_dir)
+    except (OSError, ValueError) as e:
+        raise SignerError("Failed to load the CA of {}: {}".format(files_dir, str(e)))
+    with _signers_lock:
+        _signers[files_dir] = (signature, signer)
+    return signer
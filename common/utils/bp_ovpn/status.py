@@ -0,0 +1,109 @@
+"""
+    Parse the OpenVPN status output.
+
+    The same format is printed by the management interface (``status 2`` / ``status 3``)
+    and written to the status file (``--status-version 2|3``), so both use these helpers.
+"""
+import datetime
+
+
+STATUS_CLIENT_LIST = "CLIENT_LIST"
+STATUS_ROUTING_TABLE = "ROUTING_TABLE"
+
+# default headers of status version 2/3, used when the HEADER lines are missing
+DEFAULT_STATUS_HEADERS = {
+    STATUS_CLIENT_LIST: [
+        "Common Name", "Real Address", "Virtual Address", "Virtual IPv6 Address", "Bytes Received",
+        "Bytes Sent", "Connected Since", "Connected Since (time_t)", "Username", "Client ID", "Peer ID",
+        "Data Channel Cipher"
+    ],
+    STATUS_ROUTING_TABLE: [
+        "Virtual Address", "Common Name", "Real Address", "Last Ref", "Last Ref (time_t)"
+    ],
+}
+
+
+def _to_int(value, default=0) -> int:
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return default
+
+
+def _from_time_t(value):
+    ts = _to_int(value, None)
+    if ts is None:
+        return None
+    return datetime.datetime.fromtimestamp(ts, tz=datetime.timezone.utc)
+
+
+def split_status_line(line: str) -> list:
+    """ Split one status line, status version 3 uses tab, version 2 uses comma.
+
+    Args:
+        line (str): one line of the status output
+
+    Returns:
+        list: fields of the line
+    """
+    if "\t" in line:
+        return line.split("\t")
+    return line.split(",")
+
+
+def parse_status_lines(lines) -> dict:
+    """ Parse the OpenVPN status output (version 2 or 3).
+
+    Args:
+        lines (iterable): status lines, str, without or with the line ending
+
+    Returns:
+        dict: {
+            'clients': {cn: {'cn', 'real_address', 'virtual_address', 'bytes_received',
+                             'bytes_sent', 'connected_since', 'client_id'}},
+            'routes': {virtual_address: {'virtual_address', 'cn', 'real_address', 'last_ref'}},
+            'updated': datetime or None
+        }
+    """
+    headers = {k: list(v) for k, v in DEFAULT_STATUS_HEADERS.items()}
+    clients = {}
+    routes = {}
+    updated = None
+    for line in lines:
+        line = line.rstrip("\r\n")
+        if not line:
+            continue
+        fields = split_status_line(line)
+        kind = fields[0]
+        if kind == "END":
+            break
+        if kind == "HEADER" and len(fields) > 2:
+            headers[fields[1]] = fields[2:]
+        elif kind == "TIME":
+            updated = _from_time_t(fields[-1])
+        elif kind == STATUS_CLIENT_LIST:
+            row = dict(zip(headers[STATUS_CLIENT_LIST], fields[1:]))
+            cn = row.get("Common Name")
+            if not cn or cn == "UNDEF":
+                continue
+            clients[cn] = {
+                "cn": cn,
+                "real_address": row.get("Real Address", ""),
+                "virtual_address": row.get("Virtual Address", ""),
+                "bytes_received": _to_int(row.get("Bytes Received")),
+                "bytes_sent": _to_int(row.get("Bytes Sent")),
+                "connected_since": _from_time_t(row.get("Connected Since (time_t)")),
+                "client_id": row.get("Client ID", ""),
+            }
+        elif kind == STATUS_ROUTING_TABLE:
+            row = dict(zip(headers[STATUS_ROUTING_TABLE], fields[1:]))
+            vaddr = row.get("Virtual Address")
+            if not vaddr:
+                continue
+            routes[vaddr] = {
+                "virtual_address": vaddr,
+                "cn": row.get("Common Name", ""),
+                "real_address": row.get("Real Address", ""),
+                "last_ref": _from_time_t(row.get("Last Ref (time_t)")),
+            }
+    return {"clients": clients, "routes": routes, "updated": updated}
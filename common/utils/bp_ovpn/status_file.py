@@ -0,0 +1,228 @@
+"""
+    Incremental ingestion of the OpenVPN status file (--status-version 2 or 3).
+
+    The file is parsed again only when its inode, mtime or size changed. OpenVPN rewrites
+    it in place, so a read is only accepted if it ends with the END line and the file did
+    not change while it was read, a partial list would disconnect the missing clients.
+    The parsed clients are compared with the previous snapshot so that only the connected,
+    disconnected and changed clients are written to ovpn_clients.
+"""
+import datetime
+import ipaddress
+import os
+import pathlib
+import threading
+
+from sqlalchemy import update, func
+from sqlalchemy.dialects.postgresql import insert
+
+from myproject.context import logger
+from myproject.context import DBSession as dbs
+from orm.ovpn import OvpnClients
+from .status import parse_status_lines
+from .pagination import invalidate_clients_cache
+from .events import publish_client_events
+
+
+def _is_ip(value) -> bool:
+    try:
+        ipaddress.ip_address(value)
+        return True
+    except ValueError:
+        return False
+
+
+def resolve_status_file(server) -> pathlib.Path:
+    """ Status file path of a server, openvpn resolves a relative path from its configuration dir.
+
+    Args:
+        server (OvpnServers): openvpn server
+
+    Returns:
+        pathlib.Path: status file path or None if not configured
+    """
+    if not server or not server.status_file:
+        return None
+    path = pathlib.Path(server.status_file.strip())
+    if not path.is_absolute() and server.configuration_dir:
+        path = pathlib.Path(server.configuration_dir.strip(), path)
+    return path
+
+
+class OvpnStatusFile(object):
+    """ One status file and the snapshot of its last parse.
+
+    Args:
+        path (str|pathlib.Path): status file path
+    """
+
+    def __init__(self, path):
+        self.path = pathlib.Path(path)
+        self.signature = None
+        # cn -> (ip, connected_since, real_address)
+        self.snapshot = None
+
+    def __repr__(self) -> str:
+        return f"OvpnStatusFile(path={self.path.as_posix()!r})"
+
+    @staticmethod
+    def _signature(st) -> tuple:
+        return st.st_dev, st.st_ino, st.st_mtime_ns, st.st_size
+
+    def stat_signature(self) -> tuple:
+        return self._signature(os.stat(self.path))
+
+    def read(self) -> dict:
+        """ Parse the status file if it changed since the last read and is completely written.
+
+        Returns:
+            dict: cn -> (ip, connected_since, real_address), None if the file did not change
+                  or was being rewritten, it is read again next time
+        """
+        if self.stat_signature() == self.signature:
+            return None
+        with open(self.path, "rb") as f:
+            signature = self._signature(os.fstat(f.fileno()))
+            data = f.read()
+        # openvpn seeks to 0, writes and truncates: a read during the rewrite is partial
+        if self.stat_signature() != signature:
+            return None
+        if data.rstrip(b"\r\n").rsplit(b"\n", 1)[-1].strip() != b"END":
+            return None
+        parsed = parse_status_lines(data.decode("utf-8", errors="replace").splitlines())
+        self.signature = signature
+
+        # tap mode lists the MAC address in CLIENT_LIST, take the IP from ROUTING_TABLE then
+        route_ips = {}
+        for vaddr, route in parsed["routes"].items():
+            if _is_ip(vaddr.split("/")[0]):
+                route_ips.setdefault(route["cn"], vaddr.split("/")[0])
+
+        clients = {}
+        for cn, client in parsed["clients"].items():
+            ip = client["virtual_address"] if _is_ip(client["virtual_address"]) else route_ips.get(cn, "")
+            clients[cn] = (ip, client["connected_since"], client["real_address"])
+        return clients
+
+    def diff(self, clients: dict) -> tuple:
+        """ Compare the new clients with the snapshot and keep them as the new snapshot.
+
+        Args:
+            clients (dict): result of read()
+
+        Returns:
+            tuple: (upserts: dict cn -> (ip, connected_since, real_address), disconnected: list cn)
+        """
+        previous = self.snapshot or {}
+        upserts = {cn: v for cn, v in clients.items() if previous.get(cn) != v}
+        disconnected = [cn for cn in previous if cn not in clients]
+        self.snapshot = clients
+        return upserts, disconnected
+
+
+class OvpnStatusIngestor(object):
+    """ Process wide status files, one per openvpn server id. """
+
+    _files = {}
+    _lock = threading.Lock()
+
+    @classmethod
+    def get_status_file(cls, server) -> OvpnStatusFile:
+        path = resolve_status_file(server)
+        if path is None:
+            return None
+        key = str(server.id)
+        with cls._lock:
+            status_file = cls._files.get(key)
+            if status_file is None or status_file.path != path:
+                status_file = OvpnStatusFile(path)
+                cls._files[key] = status_file
+            return status_file
+
+    @classmethod
+    def discard(cls, server_id) -> None:
+        with cls._lock:
+            cls._files.pop(str(server_id), None)
+
+    @classmethod
+    def sync(cls, server) -> dict:
+        """ Write the status file changes of a server to ovpn_clients.
+
+        Args:
+            server (OvpnServers): openvpn server
+
+        Returns:
+            dict: {'changed': bool, 'upserted': int, 'disconnected': int}
+        """
+        result = {"changed": False, "upserted": 0, "disconnected": 0}
+        status_file = cls.get_status_file(server)
+        if status_file is None:
+            return result
+        try:
+            clients = status_file.read()
+        except (OSError, ValueError) as e:
+            logger.error("Failed to read status file {}: {}".format(status_file.path, str(e)))
+            return result
+        if clients is None:
+            return result
+
+        first_run = status_file.snapshot is None
+        upserts, disconnected = status_file.diff(clients)
+        result.update(changed=True, upserted=len(upserts), disconnected=len(disconnected))
+        if not upserts and not disconnected and not first_run:
+            return result
+
+        now = datetime.datetime.now(tz=datetime.timezone.utc)
+        try:
+            if upserts:
+                stmt = insert(OvpnClients).values([
+                    {
+                        "server_id": server.id,
+                        "cn": cn,
+                        "ip": ip,
+                        "status": 1,
+                        "toggle_time": since or now,
+                        "expire_date": datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc),
+                        "update_time": now,
+                    }
+                    for cn, (ip, since, _) in upserts.items()
+                ])
+                stmt = stmt.on_conflict_do_update(
+                    index_elements=[OvpnClients.cn],
+                    set_={
+                        "ip": stmt.excluded.ip,
+                        "status": 1,
+                        "toggle_time": stmt.excluded.toggle_time,
+                        "update_time": stmt.excluded.update_time,
+                    },
+                )
+                dbs.execute(stmt)
+            if first_run:
+                # nothing to diff against yet, mark the clients missing from the file offline in one statement
+                stmt = update(OvpnClients).where(
+                    OvpnClients.server_id == server.id,
+                    OvpnClients.status == 1,
+                    OvpnClients.cn.not_in(list(clients.keys())),
+                )
+            else:
+                stmt = update(OvpnClients).where(OvpnClients.cn.in_(disconnected)) if disconnected else None
+            if stmt is not None:
+                dbs.execute(stmt.values(status=0, toggle_time=now, update_time=func.now()))
+            # delivered to the dashboards on commit
+            publish_client_events(
+                [{"server_id": str(server.id), "cn": cn, "status": 1, "ip": ip} for cn, (ip, _, _) in upserts.items()]
+                + [{"server_id": str(server.id), "cn": cn, "status": 0, "ip": ""} for cn in disconnected],
+                session=dbs,
+            )
+            dbs.commit()
+            if upserts:
+                invalidate_clients_cache(server.id)
+        except Exception as e:
+            dbs.rollback()
+            # parse again next time so that the lost changes are written
+            status_file.signature = None
+            status_file.snapshot = None
+            logger.error("Failed to sync status file of {}: {}".format(server.server_name, str(e)))
+            return result
+        logger.debug("Status file {} synced: {}".format(status_file.path, str(result)))
+        return result
@@ -0,0 +1,180 @@
+"""
+    Process wide cache of the om_system_config table.
+
+    The table is read once per process and copied to app.config. When system_config()
+    updates values it sends a NOTIFY on the om_system_config channel within the same
+    transaction, every process (uWSGI worker) LISTENs on the channel and reloads the
+    table and its app.config copy, so the workers do not keep a stale config.
+"""
+import os
+import select as select_io
+import threading
+import time
+
+from sqlalchemy import select, text
+
+from config import ProductionConfig
+from myproject.context import logger, engine
+from orm.ovpn import OfSystemConfig
+
+NOTIFY_CHANNEL = "om_system_config"
+
+
+class SystemConfig(object):
+    """ Cached om_system_config items: item -> stripped ivalue. """
+
+    _values = None
+    _loaded = 0.0
+    _apps = []
+    _lock = threading.RLock()
+    _listener = None
+    _listener_pid = None
+    # channel -> handlers of the notifications, om_system_config reloads this cache
+    _handlers = {}
+
+    @classmethod
+    def init_app(cls, app) -> None:
+        """ Keep app.config in sync with the table, the listener is started per worker process. """
+        if app not in cls._apps:
+            cls._apps.append(app)
+        app.before_request(cls.ensure_listener)
+        cls.reload()
+
+    @classmethod
+    def reload(cls) -> dict:
+        """ Read the whole table again and update the app.config of the registered apps. """
+        with engine.connect() as conn:
+            rows = conn.execute(select(OfSystemConfig.item, OfSystemConfig.ivalue)).all()
+        values = {item: (ivalue or '').strip() for item, ivalue in rows}
+        with cls._lock:
+            cls._values = values
+            cls._loaded = time.monotonic()
+            for app in cls._apps:
+                app.config.update(values)
+        logger.debug("System config loaded: {} items".format(len(values)))
+        return values
+
+    @classmethod
+    def invalidate(cls) -> None:
+        cls._values = None
+
+    @classmethod
+    def _get_values(cls) -> dict:
+        cls.ensure_listener()
+        values = cls._values
+        # without a listener (e.g. not postgresql) the changes of the other processes are seen after the ttl
+        if values is None or (cls._listener is None and time.monotonic() - cls._loaded > ProductionConfig.OVPN_SYSTEM_CONFIG_TTL):
+            values = cls.reload()
+        return values
+
+    """
+        Typed getters
+    """
+
+    @classmethod
+    def all(cls) -> dict:
+        return dict(cls._get_values())
+
+    @classmethod
+    def get(cls, item, default=None) -> str:
+        value = cls._get_values().get(item)
+        return default if value is None else value
+
+    @classmethod
+    def get_int(cls, item, default=0) -> int:
+        try:
+            return int(cls._get_values().get(item))
+        except (TypeError, ValueError):
+            return default
+
+    @classmethod
+    def get_bool(cls, item, default=False) -> bool:
+        value = cls._get_values().get(item)
+        if not value:
+            return default
+        return value.lower() in ("1", "true", "yes", "on", "enabled")
+
+    """
+        Change notification
+    """
+
+    @classmethod
+    def notify(cls, session, items=(), channel=NOTIFY_CHANNEL) -> None:
+        """ Tell all the processes to reload, the notification is delivered when session commits.
+
+        Args:
+            session (Session): session of the transaction that updates the table
+            items (list, optional): changed items, for the log only
+            channel (str, optional): notification channel, see on_notify()
+        """
+        if engine.dialect.name != "postgresql":
+            return
+        session.execute(text("SELECT pg_notify(:channel, :payload)"), {"channel": channel, "payload": ",".join(items)})
+
+    @classmethod
+    def on_notify(cls, channel, handler) -> None:
+        """ Call handler(payload) in every process when channel is notified, e.g. to drop another cache.
+
+        Register before the first request, the channels are listened when the listener starts.
+        """
+        cls._handlers.setdefault(channel, []).append(handler)
+
+    @classmethod
+    def ensure_listener(cls) -> None:
+        """ Start the LISTEN thread once per process, a forked worker starts its own. """
+        pid = os.getpid()
+        if cls._listener_pid == pid:
+            return
+        with cls._lock:
+            if cls._listener_pid == pid:
+                return
+            cls._listener_pid = pid
+            cls._listener = None
+            if engine.dialect.name != "postgresql":
+                return
+            cls._listener = threading.Thread(target=cls._listen, name="sysconfig-listen", daemon=True)
+            cls._listener.start()
+
+    @classmethod
+    def _dispatch(cls, channel, payload) -> None:
+        if channel == NOTIFY_CHANNEL:
+            cls.reload()
+        for handler in cls._handlers.get(channel, []):
+            try:
+                handler(payload)
+            except Exception as e:
+                logger.error("Handler of notification {} failed: {}".format(channel, str(e)))
+
+    @classmethod
+    def _listen(cls) -> None:
+        # a dedicated DBAPI connection, not one of the pool
+        cargs, cparams = engine.dialect.create_connect_args(engine.url)
+        while True:
+            conn = None
+            try:
+                conn = engine.dialect.connect(*cargs, **cparams)
+                conn.autocommit = True
+                channels = [NOTIFY_CHANNEL] + [c for c in cls._handlers if c != NOTIFY_CHANNEL]
+                with conn.cursor() as cur:
+                    for channel in channels:
+                        cur.execute("LISTEN {}".format(channel))
+                # the notifications sent before LISTEN (fork, reconnect) are lost, read the table again
+                cls._dispatch(NOTIFY_CHANNEL, "")
+                for channel in channels[1:]:
+                    cls._dispatch(channel, "")
+                while True:
+                    select_io.select([conn], [], [], 60)
+                    conn.poll()
+                    while conn.notifies:
+                        n = conn.notifies.pop(0)
+                        logger.info("Notification on {}: {}".format(n.channel, n.payload))
+                        cls._dispatch(n.channel, n.payload)
+            except Exception as e:
+                logger.error("System config listener failed, retry in 10s: {}".format(str(e)))
+                time.sleep(10)
+            finally:
+                if conn is not None:
+                    try:
+                        conn.close()
+                    except Exception:
+                        pass
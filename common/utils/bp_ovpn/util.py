@@ -8,10 +8,21 @@ from werkzeug.security import generate_password_hash
 from myproject.context import logger
 from orm.ovpn import OvpnServers, OfUser, OfGroup, OvpnClients, OfSystemConfig
 from myproject.context import DBSession as dbs
-from sqlalchemy import select, update, delete, or_, desc, asc
+from sqlalchemy import select, update, delete, func
 from uuid import UUID
 import pathlib
 
+from .management import read_live_clients
+from .status_file import OvpnStatusIngestor
+from .ipp import get_ipp_index
+from .pagination import clients_cursors, clients_totals
+from .datatables import DataTablesQuery, parse_datatables_args
+from .fsindex import get_dir_index
+from .sysconfig import SystemConfig
+from .server_list import OvpnServerList
+from .service_status import OvpnServiceProber
+from .metrics import system_sampler
+
 
 class OvpnUtils(object):
     """Ovpn utils
@@ -22,6 +33,10 @@ class OvpnUtils(object):
     USER_ADD_INT_COL = ['line_size', 'page_size']
     USER_UPDATE_INT_COL = ['line_size', 'page_size', 'status']
     FAKE_PASSWORD = '_PASSWORD_'
+    
+    # cached for the process lifetime
+    _static_system_info = None
+    _openvpn_version = None
 
     """
         Common methods
@@ -34,51 +49,40 @@ class OvpnUtils(object):
         Returns:
             dict: system information
         """
-        system_type = platform.system()
-        system_info = {
-            "system_type": system_type,
-            "system_version": platform.release(),
-            "system_time": datetime.datetime.now().strftime("%Y-%m-%d_%H:%M:%S"),
-            "cpu_cores": psutil.cpu_count(),
-        }
-        boot_time_timestamp = psutil.boot_time()
-        current_time_timestamp = time.time()
-        uptime_seconds = current_time_timestamp - boot_time_timestamp
+        # the static part is read once per process, the metrics come from the background sampler
+        if cls._static_system_info is None:
+            system_type = platform.system()
+            cls._static_system_info = {
+                "system_type": system_type,
+                "system_version": platform.release(),
+                "cpu_cores": psutil.cpu_count(),
+                "boot_time": psutil.boot_time(),
+                "openvpn_version": cls.get_openvpn_version() if system_type.startswith("Linux") else "NA",
+                "system_information": platform.platform(),
+            }
+        system_info = dict(cls._static_system_info)
+        system_info["system_time"] = datetime.datetime.now().strftime("%Y-%m-%d_%H:%M:%S")
+
+        uptime_seconds = time.time() - system_info.pop("boot_time")
         uptime_minutes = uptime_seconds // 60
         uptime_hours = uptime_minutes // 60
         uptime_days = uptime_hours // 24
-        uptime_str = f"{int(uptime_days)} days,{int(uptime_hours % 24)}:{int(uptime_minutes % 60)}:{int(uptime_seconds % 60)}"
-
-        load_avg = psutil.getloadavg()
-        memory_total = round(psutil.virtual_memory().total/1024/1024, 1)
-        memory_used = round(psutil.virtual_memory().used/1024/1024, 1)
-        memory_percent = psutil.virtual_memory().percent
-        swap_total = round(psutil.swap_memory().total/1024/1024, 1)
-        swap_used = round(psutil.swap_memory().used/1024/1024, 1)
-        swap_percent = round(psutil.swap_memory().percent, 1)
-
-        if system_type.startswith("Linux"):
-            openvpn_version = cls.get_openvpn_version()
-        else:
-            openvpn_version = "NA"
-        system_information = platform.platform()
+        system_info["system_uptime"] = f"{int(uptime_days)} days,{int(uptime_hours % 24)}:{int(uptime_minutes % 60)}:{int(uptime_seconds % 60)}"
 
-        system_info.update(
-            {
-                "system_uptime": uptime_str,
-                "load_avg": load_avg,
-                "memory_total": memory_total,
-                "memory_used": memory_used,
-                "memory_percent": memory_percent,
-                "swap_total": swap_total,
-                "swap_used": swap_used,
-                "swap_percent": swap_percent,
-                "openvpn_version": openvpn_version,
-                "system_information": system_information
-            }
-        )
-        # print(system_info)
+        sample = system_sampler.latest()
+        for key in ("cpu_percent", "load_avg", "memory_total", "memory_used", "memory_percent",
+                    "swap_total", "swap_used", "swap_percent", "net"):
+            system_info[key] = sample[key]
         return system_info
+
+    @classmethod
+    def get_system_history(cls) -> dict:
+        """Get the buffered system metrics for the dashboard sparklines
+
+        Returns:
+            dict: key -> [values], oldest first
+        """
+        return system_sampler.history()
     
     
     """
@@ -96,6 +100,8 @@ class OvpnUtils(object):
             str: OpenVPN version string
         """
         logger.debug("Trying to get the openvpn software version.")
+        if not executor and cls._openvpn_version:
+            return cls._openvpn_version
         if not platform.system().startswith("Linux"):
             # logger.info("This app is not running on linux platform now. Skip get openvpn version.")
             return ""
@@ -109,6 +115,7 @@ class OvpnUtils(object):
                 lout = output.split("\n")[0]
                 version = "-".join(str(x) for x in lout.split()[0:3])
                 if version:
+                    cls._openvpn_version = version
                     return version
                 else:
                     return ""
@@ -143,8 +150,12 @@ class OvpnUtils(object):
         try:
             logger.info("Try to write new ovpn service to db.")
             
-            dbs.add(OvpnServers(**new_ovpn_server))
+            new_server = OvpnServers(**new_ovpn_server)
+            dbs.add(new_server)
+            dbs.flush()
+            OvpnServerList.notify(dbs, new_server.id)
             dbs.commit()
+            OvpnServerList.invalidate()
             logger.error("Failed to save the openvpn to database.")
             category = 'success'
             return "New openvpn service has beed added successfully.", category
@@ -185,7 +196,10 @@ class OvpnUtils(object):
         try:
             logger.info("Try to delete ovpn service uuid: {}".format(uuid))
             dbs.delete(ovpn_service)
+            OvpnServerList.notify(dbs, uuid)
             dbs.commit()
+            OvpnServerList.invalidate()
+            OvpnStatusIngestor.discard(uuid)
             logger.error("Successfully delete ovpn service: {}".format(uuid))
             category = 'success'
             return "New openvpn service has been deleted successfully.", category
@@ -227,7 +241,10 @@ class OvpnUtils(object):
             # dbs.execute(stmt)
             service_query.update(updated_ovpn_server)
             logger.info("###############################################$$$$$$$$$$$$$$$$$$$$")
+            OvpnServerList.notify(dbs, target_id)
             dbs.commit()
+            OvpnServerList.invalidate()
+            OvpnStatusIngestor.discard(target_id)
             logger.info("Successfully update the ovpn service config, id: " + str(target_id))
             category = 'success'
             return ("Openvpn service has beed updated successfully.", category)
@@ -251,6 +268,17 @@ class OvpnUtils(object):
             logger.error(e)
             return e
 
+    @classmethod
+    def get_openvpn_server_list(cls) -> dict:
+        """
+        Get the cached {server_name: id} of the managed OpenVPN services, for the navigation
+        """
+        try:
+            return OvpnServerList.get()
+        except Exception as e:
+            logger.error("Failed to get the openvpn server list: {}".format(str(e)))
+            return {}
+
     @classmethod
     def search_openvpn_services(cls, q=None) -> str:
         """
@@ -297,38 +325,25 @@ class OvpnUtils(object):
         if not platform.system().startswith("Linux"):
             logger.info("This app is NOT running on linux platform now. Skip get openvpn running status.")
             return results
-        if not server:
+        if not server or not server.startup_service:
             return results
-        startup_service = server.startup_service
-        if not startup_service:
-            return results       
-        if str(server.startup_type) == "1":
-            try:
-                res = subprocess.run(["/usr/bin/systemctl", "is-active", "--quiet", startup_service], shell=False, capture_output = True)
-                if res.returncode == 0:
-                    logger.debug("returned code: {}, service: {}".format(res.returncode, startup_service))
-                    results.update({"status": 1})
-                    return results
-                else:
-                    logger.debug("returned code: {}".format(res.returncode))
-                    logger.error("Openvpn service is NOT running.")
-                    results.update ({"status": 0})
-            except Exception as e:
-                logger.error("Failed to get openvpn running status: {}".format(str(e)))
-                results.update({"status": 0})
-                return results
-            
-        else:
-            try:
-                res = subprocess.run([startup_service, "status"], shell=True, capture_output = True)
-                if res.returncode == 0:
-                    results.update({"status": 1})
-                    return results
-                else:
-                    results.update ({"status": 0})
-            except:
-                results.update({"status": 0})
-                return results
+        results.update({"status": OvpnServiceProber.probe([server])[str(server.id)]})
+        return results
+
+    @classmethod
+    def get_openvpn_running_statuses(cls, servers=None, force=False) -> dict:
+        """ Get the running status of several OpenVPN services at once
+
+        Args:
+            servers (list, optional): servers, all the services if None
+            force (bool, optional): skip the status cached for a few seconds. Defaults to False.
+
+        Returns:
+            dict: str(server id) -> 1 running, 0 not running
+        """
+        if servers is None:
+            servers = cls.get_all_openvpn_services()
+        return OvpnServiceProber.probe(servers, force=force)
 
     @classmethod
     def change_openvpn_running_status(cls, server=None, op=None) -> bool:
@@ -351,6 +366,7 @@ class OvpnUtils(object):
             return False
         if op not in ['start', 'stop', 'restart']:
             return False   
+        OvpnServiceProber.invalidate(server)
         if str(server.startup_type) == "1":
             try:
                 res = subprocess.run(["/usr/bin/systemctl", op, startup_service], capture_output=True)
@@ -376,6 +392,50 @@ class OvpnUtils(object):
                 return False
 
 
+    @classmethod
+    def get_openvpn_live_clients(cls, server=None) -> dict:
+        """ Get the connected clients from the openvpn management interface, as last synced by flask sync-status
+
+        Args:
+            server (OvpnServers): openvpn server
+
+        Returns:
+            dict: cn -> {'real_address', 'virtual_address', 'bytes_received', 'bytes_sent', 'connected_since'},
+                  None if the management interface is not available.
+        """
+        if server is None or not server.management_port:
+            return None
+        return read_live_clients(server.id)
+
+    @classmethod
+    def get_openvpn_ipp_index(cls, server=None):
+        """ Get the CN <-> IP index of the server ifconfig-pool-persist file
+
+        Args:
+            server (OvpnServers): openvpn server
+
+        Returns:
+            IppIndex: index with get_cn(ip)/get_ip(cn), None if the server has no ipp file
+        """
+        if not server or not server.configuration_file:
+            return None
+        cfg_file = pathlib.Path(server.configuration_file.strip())
+        if not cfg_file.is_absolute() and server.configuration_dir:
+            cfg_file = pathlib.Path(server.configuration_dir.strip(), cfg_file)
+        return get_ipp_index(cfg_filename=cfg_file.as_posix())
+
+    @classmethod
+    def sync_openvpn_status_file(cls, server=None) -> dict:
+        """ Write the changed clients of the server status file to ovpn_clients
+
+        Args:
+            server (OvpnServers): openvpn server
+
+        Returns:
+            dict: {'changed': bool, 'upserted': int, 'disconnected': int}
+        """
+        return OvpnStatusIngestor.sync(server)
+
     """
         OpenVPN service detail methods
     """
@@ -420,43 +480,61 @@ class OvpnUtils(object):
         logger.debug("Get post args: {}".format(str(args)))
         if not args:
             return {}
-        draw = args.get('draw')
-        start = args.get('start')
-        length = args.get('length')
-        searchValue = args.get('search[value]')
-        order_col = args.get("order[0][column]")
-        order_direction = args.get("order[0][dir]")
+        params = parse_datatables_args(args)
         ovpn_service = args.get('ovpn_service')
         group = args.get('group')
+        server_key = str(ovpn_service.id)
         
-        all_clients = dbs.query(OvpnClients).filter_by(server_id=ovpn_service.id)
-        
-        # order by 
-        # https://stackoverflow.com/questions/5874579/dynamic-order-by-clause-using-sqlalchemys-sql-expression-language
-        sort_columns = ("site_name", "cn", "ip", "toggle_time", "expire_date", "status")
-        sort_column = sort_columns[int(order_col)]
-        sort_dir = order_direction  # or "asc"
-        sort = asc(sort_column) if sort_dir == "desc" else desc(sort_column)
+        # order by, site_name is nullable, coalesce it to keep the keyset comparison valid.
+        # The clients table sorts the opposite of the posted direction.
+        clients_table = DataTablesQuery(
+            OvpnClients,
+            columns=(
+                func.coalesce(OvpnClients.site_name, ''),
+                OvpnClients.cn,
+                OvpnClients.ip,
+                OvpnClients.toggle_time,
+                OvpnClients.expire_date,
+                OvpnClients.status,
+            ),
+            # served by the trigram indexes, see check_db_indexes
+            search_columns=(OvpnClients.site_name, OvpnClients.cn, OvpnClients.ip),
+            reverse=True,
+        )
+        # rows, recordsFiltered and recordsTotal in one query, keyset pagination if the previous page was served
+        total = clients_totals.peek(server_key)
+        result = clients_table.fetch(
+            dbs,
+            params,
+            where=(OvpnClients.server_id == ovpn_service.id,),
+            total=total,
+            cursors=clients_cursors,
+            cursor_key=server_key,
+        )
+        if total is None:
+            clients_totals.set(server_key, result['recordsTotal'])
         
-        if searchValue and searchValue.strip():
-            searchVar = f'%{searchValue.strip()}%'
-            f_clients = dbs.query(OvpnClients).filter(OvpnClients.server_id==args.get("ovpn_server_uuid")).filter(
-                or_(
-                    OvpnClients.site_name.ilike(searchVar),
-                    OvpnClients.cn.ilike(searchVar),
-                    OvpnClients.ip.ilike(searchVar)
+        target_clients = [z.toDict() for z in result['rows']]
+
+        # overwrite the status by the live clients from the management interface if available
+        live_clients = cls.get_openvpn_live_clients(ovpn_service)
+        if live_clients is not None:
+            for client in target_clients:
+                live = live_clients.get(client['cn'])
+                client['status'] = 1 if live else 0
+                if live:
+                    client.update(
+                        real_address=live['real_address'],
+                        bytes_received=live['bytes_received'],
+                        bytes_sent=live['bytes_sent'],
+                        connected_since=live['connected_since'],
                     )
-            ).order_by(sort)
-        else:
-            f_clients = dbs.query(OvpnClients).filter(OvpnClients.server_id==args.get("ovpn_server_uuid")).order_by(sort)
-        
-        target_clients = f_clients.limit(length).offset(start)
     
         data = {
-            'recordsFiltered': f_clients.count(),
-            'recordsTotal': all_clients.count(),
-            'draw': draw,
-            'data': [z.toDict() for z in target_clients], #[ d for d in results.values() ],
+            'recordsFiltered': result['recordsFiltered'],
+            'recordsTotal': result['recordsTotal'],
+            'draw': params['draw'],
+            'data': target_clients, #[ d for d in results.values() ],
             "privs_group": group,
             # 'pageLength': user.page_size
         }
@@ -471,7 +549,7 @@ class OvpnUtils(object):
         start = int(args.get('start'))
         length = int(args.get('length'))   
              
-        cert_root = dbs.scalar(select(OfSystemConfig).where(OfSystemConfig.item == "DIR_CERT_ROOT")).ivalue.strip()
+        cert_root = SystemConfig.get("DIR_CERT_ROOT")
         logger.debug(f"Certs root: {cert_root}")
         system_type = platform.system()
         logger.debug(f"System: {system_type}")
@@ -486,42 +564,22 @@ class OvpnUtils(object):
         
         # extension: .conf
         suffix = ".conf"
-        sub_dir = dbs.scalar(select(OfSystemConfig).where(OfSystemConfig.item == "DIR_PLAIN_CERTS")).ivalue.strip()
+        sub_dir = SystemConfig.get("DIR_PLAIN_CERTS")
         
         t_path = pathlib.Path(cert_root, certs_dir, sub_dir)
         logger.debug( "Check system path: " + t_path.absolute().as_posix())
-        plain_certs = []
-        if t_path.exists():
-            for f in list(t_path.iterdir()):
-                if f.is_file() and (f.name.endswith((".conf", ".ovpn"))):
-                    plain_certs.append(
-                            {
-                            "cert_name": f.name, 
-                            "cert_size": round(f.stat().st_size/1024, 1),
-                            "create_time": datetime.datetime.fromtimestamp(f.stat().st_ctime).strftime("%Y-%m-%d_%H:%M:%S")
-                            }
-                        )
-        if order_direction == "asc":
-            plain_certs = sorted(plain_certs, key=lambda x: x['cert_name'])
-        else:
-            plain_certs = (sorted(plain_certs, key=lambda x: x['cert_name'], reverse=True))  
-        if searchValue and searchValue.strip():
-            f_plain_certs = []
-            for plain_cert in plain_certs:
-                if plain_cert["cert_name"].upper().find(searchValue.upper()) >= 0:
-                    f_plain_certs.append(plain_cert)
-        else:
-            f_plain_certs = plain_certs
-            
-        t_plain_certs = f_plain_certs[start: start+length]  
-        if not plain_certs:
+        # sort, search and slice from the cached listing, the directory is scanned again only if it changed
+        t_plain_certs, records_filtered, records_total = get_dir_index(t_path, (".conf", ".ovpn")).page(
+            searchValue, order_direction != "asc", start, length
+        )
+        if not records_total:
             failed = 1
         else:
             failed = 0
            
         data = {
-            'recordsFiltered': len(f_plain_certs),
-            'recordsTotal': len(plain_certs),
+            'recordsFiltered': records_filtered,
+            'recordsTotal': records_total,
             'draw': draw,
             'data': t_plain_certs,
             "privs_group": group,
@@ -540,7 +598,7 @@ class OvpnUtils(object):
         start = int(args.get('start'))
         length = int(args.get('length'))   
              
-        cert_root = dbs.scalar(select(OfSystemConfig).where(OfSystemConfig.item == "DIR_CERT_ROOT")).ivalue.strip()
+        cert_root = SystemConfig.get("DIR_CERT_ROOT")
         logger.debug(f"Certs root: {cert_root}")
         system_type = platform.system()
         logger.debug(f"System: {system_type}")
@@ -555,42 +613,22 @@ class OvpnUtils(object):
         
         # extension: .conf
         suffix = ".p7mb64"
-        sub_dir = dbs.scalar(select(OfSystemConfig).where(OfSystemConfig.item == "DIR_ENCRYPT_CERTS")).ivalue.strip()
+        sub_dir = SystemConfig.get("DIR_ENCRYPT_CERTS")
         
         t_path = pathlib.Path(cert_root, certs_dir, sub_dir)
         logger.debug( "Check system path: " + t_path.absolute().as_posix())
-        plain_certs = []
-        if t_path.exists():
-            for f in list(t_path.iterdir()):
-                if f.is_file() and (f.name.endswith((".p7mb64", ))):
-                    plain_certs.append(
-                            {
-                            "cert_name": f.name, 
-                            "cert_size": round(f.stat().st_size/1024, 1),
-                            "create_time": datetime.datetime.fromtimestamp(f.stat().st_ctime).strftime("%Y-%m-%d_%H:%M:%S")
-                            }
-                        )
-        if order_direction == "asc":
-            plain_certs = sorted(plain_certs, key=lambda x: x['cert_name'])
-        else:
-            plain_certs = (sorted(plain_certs, key=lambda x: x['cert_name'], reverse=True))  
-        if searchValue and searchValue.strip():
-            f_plain_certs = []
-            for plain_cert in plain_certs:
-                if plain_cert["cert_name"].upper().find(searchValue.upper()) >= 0:
-                    f_plain_certs.append(plain_cert)
-        else:
-            f_plain_certs = plain_certs
-            
-        t_plain_certs = f_plain_certs[start: start+length]  
-        if not plain_certs:
+        # sort, search and slice from the cached listing, the directory is scanned again only if it changed
+        t_plain_certs, records_filtered, records_total = get_dir_index(t_path, (".p7mb64", )).page(
+            searchValue, order_direction != "asc", start, length
+        )
+        if not records_total:
             failed = 1
         else:
             failed = 0
            
         data = {
-            'recordsFiltered': len(f_plain_certs),
-            'recordsTotal': len(plain_certs),
+            'recordsFiltered': records_filtered,
+            'recordsTotal': records_total,
             'draw': draw,
             'data': t_plain_certs,
             "privs_group": group,
@@ -608,7 +646,7 @@ class OvpnUtils(object):
         start = int(args.get('start'))
         length = int(args.get('length'))   
              
-        cert_root = dbs.scalar(select(OfSystemConfig).where(OfSystemConfig.item == "DIR_CERT_ROOT")).ivalue.strip()
+        cert_root = SystemConfig.get("DIR_CERT_ROOT")
         logger.debug(f"reqs root: {cert_root}")
         system_type = platform.system()
         logger.debug(f"System: {system_type}")
@@ -623,42 +661,22 @@ class OvpnUtils(object):
         
         # extension: .req
         suffix = ".req"
-        sub_dir = dbs.scalar(select(OfSystemConfig).where(OfSystemConfig.item == "DIR_REQS")).ivalue.strip()
+        sub_dir = SystemConfig.get("DIR_REQS")
         
         t_path = pathlib.Path(cert_root, certs_dir, sub_dir)
         logger.debug( "Check system path: " + t_path.absolute().as_posix())
-        plain_certs = []
-        if t_path.exists():
-            for f in list(t_path.iterdir()):
-                if f.is_file() and (f.name.endswith((suffix, ))):
-                    plain_certs.append(
-                            {
-                            "cert_name": f.name, 
-                            "cert_size": round(f.stat().st_size/1024, 1),
-                            "create_time": datetime.datetime.fromtimestamp(f.stat().st_ctime).strftime("%Y-%m-%d_%H:%M:%S")
-                            }
-                        )
-        if order_direction == "asc":
-            plain_certs = sorted(plain_certs, key=lambda x: x['cert_name'])
-        else:
-            plain_certs = (sorted(plain_certs, key=lambda x: x['cert_name'], reverse=True))  
-        if searchValue and searchValue.strip():
-            f_plain_certs = []
-            for plain_cert in plain_certs:
-                if plain_cert["cert_name"].upper().find(searchValue.upper()) >= 0:
-                    f_plain_certs.append(plain_cert)
-        else:
-            f_plain_certs = plain_certs
-            
-        t_plain_certs = f_plain_certs[start: start+length]  
-        if not plain_certs:
+        # sort, search and slice from the cached listing, the directory is scanned again only if it changed
+        t_plain_certs, records_filtered, records_total = get_dir_index(t_path, (suffix, )).page(
+            searchValue, order_direction != "asc", start, length
+        )
+        if not records_total:
             failed = 1
         else:
             failed = 0
            
         data = {
-            'recordsFiltered': len(f_plain_certs),
-            'recordsTotal': len(plain_certs),
+            'recordsFiltered': records_filtered,
+            'recordsTotal': records_total,
             'draw': draw,
             'data': t_plain_certs,
             "privs_group": group,
@@ -677,7 +695,7 @@ class OvpnUtils(object):
         start = int(args.get('start'))
         length = int(args.get('length'))   
              
-        cert_root = dbs.scalar(select(OfSystemConfig).where(OfSystemConfig.item == "DIR_CERT_ROOT")).ivalue.strip()
+        cert_root = SystemConfig.get("DIR_CERT_ROOT")
         logger.debug(f"reqs root: {cert_root}")
         system_type = platform.system()
         logger.debug(f"System: {system_type}")
@@ -692,42 +710,22 @@ class OvpnUtils(object):
         
         # extension: .req
         suffix = ".zip"
-        sub_dir = dbs.scalar(select(OfSystemConfig).where(OfSystemConfig.item == "DIR_ZIP_CERTS")).ivalue.strip()
+        sub_dir = SystemConfig.get("DIR_ZIP_CERTS")
         
         t_path = pathlib.Path(cert_root, certs_dir, sub_dir)
         logger.debug( "Check system path: " + t_path.absolute().as_posix())
-        plain_certs = []
-        if t_path.exists():
-            for f in list(t_path.iterdir()):
-                if f.is_file() and (f.name.endswith((suffix, ))):
-                    plain_certs.append(
-                            {
-                            "cert_name": f.name, 
-                            "cert_size": round(f.stat().st_size/1024, 1),
-                            "create_time": datetime.datetime.fromtimestamp(f.stat().st_ctime).strftime("%Y-%m-%d_%H:%M:%S")
-                            }
-                        )
-        if order_direction == "asc":
-            plain_certs = sorted(plain_certs, key=lambda x: x['cert_name'])
-        else:
-            plain_certs = (sorted(plain_certs, key=lambda x: x['cert_name'], reverse=True))  
-        if searchValue and searchValue.strip():
-            f_plain_certs = []
-            for plain_cert in plain_certs:
-                if plain_cert["cert_name"].upper().find(searchValue.upper()) >= 0:
-                    f_plain_certs.append(plain_cert)
-        else:
-            f_plain_certs = plain_certs
-            
-        t_plain_certs = f_plain_certs[start: start+length]  
-        if not plain_certs:
+        # sort, search and slice from the cached listing, the directory is scanned again only if it changed
+        t_plain_certs, records_filtered, records_total = get_dir_index(t_path, (suffix, )).page(
+            searchValue, order_direction != "asc", start, length
+        )
+        if not records_total:
             failed = 1
         else:
             failed = 0
            
         data = {
-            'recordsFiltered': len(f_plain_certs),
-            'recordsTotal': len(plain_certs),
+            'recordsFiltered': records_filtered,
+            'recordsTotal': records_total,
             'draw': draw,
             'data': t_plain_certs,
             "privs_group": group,
@@ -0,0 +1,33 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8; py-indent-offset: 4 -*-
+""" Send one learn-address event to learn-address-sink.py
+
+Standard library only, run by learn-address-script-launcher-udp with python3 -S: it starts
+in a few milliseconds and does not load boto3 nor MySQLdb like learn-address-script.py.
+Parameter:
+    option, address, cn[only for op(add, update)]
+Returns:
+    exit code 0 if the sink received the event, 1 otherwise (the launcher falls back to at)
+"""
+
+import sys
+import json
+import socket
+import time
+
+SINK_SOCKET = "/run/openvpn/learn-address-sink-udp-tun-1194.sock"
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3 or sys.argv[1] not in ("add", "update", "delete"):
+        sys.exit(1)
+    # the sink resolves the cn of the delete events itself
+    event = {"op": sys.argv[1], "ip": sys.argv[2], "cn": sys.argv[3] if len(sys.argv) > 3 else "", "ts": time.time()}
+    try:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        try:
+            sock.sendto(json.dumps(event).encode("utf-8"), SINK_SOCKET)
+        finally:
+            sock.close()
+    except OSError:
+        sys.exit(1)
+    sys.exit(0)
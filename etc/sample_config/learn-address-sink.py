@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8; py-indent-offset: 4 -*-
+""" Learn-address event sink daemon
+
+Receive the learn-address events from learn-address-send.py on a unix datagram socket,
+coalesce them by cn and write them to DB in batches through one persistent connection.
+A restart of the openvpn service makes thousands of clients reconnect at once, with the
+sink the learn-address hook only sends a datagram instead of opening a DB connection.
+
+Event datagram (json):
+    {"op": "add|update|delete", "ip": "<ipaddress>", "cn": "<CertificateCN or empty>", "ts": <unix time>}
+"""
+
+from __future__ import print_function
+import sys
+import os
+import json
+import socket
+import signal
+import time
+import datetime
+import uuid
+import grp
+import importlib.util
+import MySQLdb
+
+config = {
+    "server_name": "openvpn-udp-tun-1194",
+    "server_config": "/etc/openvpn/openvpn-udp-tun-1194/openvpn-udp-tun-1194.conf",
+    "db_host": '127.0.0.1',
+    "db_port": 3306,
+    "db_name": "ovpnmgmt",
+    "db_user": "root",
+    "db_password": "rootroot",
+    "openvpn_service_table": "ovpn_servers",
+    "openvpn_client_table": "ovpn_clientlist",
+    # /tmp is private for the openvpn service (PrivateTmp=true), use /run
+    "sink_socket": "/run/openvpn/learn-address-sink-udp-tun-1194.sock",
+    # only root and this group may send events, the learn-address hook runs as the openvpn user
+    "sink_group": "openvpn",
+    # flush the pending events every N ms or when max batch events are pending
+    "flush_interval_ms": 500,
+    "flush_max_events": 2000,
+    # shared CN <-> IP index of the ovpn_flask app, the file is scanned per delete event if it is missing
+    "ipp_module": "/opt/ovpn_flask/common/utils/bp_ovpn/ipp.py",
+}
+
+
+def log(lines):
+    for line in lines.strip().split("\n"):
+        print(os.path.basename(__file__) + " " + line)
+    sys.stdout.flush()
+
+
+def openvpn_ipp_get_cn(ipp_filename, ip):
+    try:
+        with open(ipp_filename, "r") as f:
+            for line in f:
+                l = line.strip().split(',')[0:2]
+                cn = l[0]
+                ipp = l[1]
+                if ip == ipp:
+                    return cn
+    except:
+        return None
+
+
+def openvpn_get_ipp_filename(cfg_filename):
+    try:
+        with open(cfg_filename, "rt") as f:
+            for line in f:
+                if 'ifconfig-pool-persist' in line:
+                    x = line.strip().split()
+                    if 'ifconfig-pool-persist' == x[0]:
+                        return os.path.join(os.path.dirname(cfg_filename), x[1])
+    except:
+        return None
+
+
+def load_ipp_index(cfg_filename):
+    """ Load the ipp index module by path, it does not need the flask app. """
+    try:
+        spec = importlib.util.spec_from_file_location("ovpn_flask_ipp", config["ipp_module"])
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        return module.get_ipp_index(cfg_filename=cfg_filename)
+    except Exception as e:
+        log("Failed to load the ipp index module, fall back to scan ipp file: %s" % e)
+        return None
+
+
+class EventSink(object):
+    """ Coalesce the learn-address events and flush them in batches. """
+
+    def __init__(self):
+        self.conn = None
+        self.service_uuid = None
+        # cn -> (status, ip, toggle_time), the last event of a cn wins
+        self.pending = {}
+        # ip -> cn learned from add/update events, to resolve the delete events
+        self.ip_cn = {}
+        self.ipp_filename = openvpn_get_ipp_filename(config["server_config"])
+        self.ipp_index = load_ipp_index(config["server_config"])
+        self.running = True
+
+    def get_conn(self):
+        """ One persistent connection, reconnect if it was lost. """
+        if self.conn is not None:
+            try:
+                self.conn.ping()
+                return self.conn
+            except MySQLdb.Error:
+                self.conn = None
+        self.conn = MySQLdb.connect(
+            db=config["db_name"],
+            user=config["db_user"],
+            password=config["db_password"],
+            host=config["db_host"],
+            port=config["db_port"]
+            )
+        cur = self.conn.cursor(MySQLdb.cursors.DictCursor)
+        cur.execute("""select id from {} where server_name=%s""".format(config["openvpn_service_table"]), (config["server_name"],))
+        self.service_uuid = cur.fetchone()["id"]
+        cur.close()
+        return self.conn
+
+    def add_event(self, event):
+        op = event.get("op")
+        ip = event.get("ip")
+        cn = event.get("cn")
+        toggle_time = datetime.datetime.fromtimestamp(event.get("ts") or time.time())
+        if op in ("add", "update"):
+            if not cn:
+                return
+            self.ip_cn[ip] = cn
+            self.pending[cn] = (1, ip, toggle_time)
+        elif op == "delete":
+            cn = cn or self.ip_cn.pop(ip, None) or self.get_ipp_cn(ip)
+            if not cn:
+                log("CN of ip %s not found, skip the delete event." % ip)
+                return
+            self.pending[cn] = (0, ip, toggle_time)
+
+    def get_ipp_cn(self, ip):
+        if self.ipp_index is not None:
+            return self.ipp_index.get_cn(ip)
+        return openvpn_ipp_get_cn(self.ipp_filename, ip)
+
+    def flush(self):
+        if not self.pending:
+            return
+        pending, self.pending = self.pending, {}
+        now = datetime.datetime.now()
+        try:
+            conn = self.get_conn()
+            cur = conn.cursor()
+            upserts = [
+                (uuid.uuid4().hex, cn, ip, toggle_time, datetime.datetime(1970, 1, 1), status, now, now, self.service_uuid, 1)
+                for cn, (status, ip, toggle_time) in pending.items() if status
+            ]
+            deletes = [(toggle_time, now, cn) for cn, (status, ip, toggle_time) in pending.items() if not status]
+            if upserts:
+                sql = """INSERT INTO {} (id, cn, ip, toggle_time, expire_date, status, create_time, update_time, server_id, enabled)
+                    values (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+                    ON DUPLICATE KEY UPDATE ip = VALUES(ip), toggle_time = VALUES(toggle_time), status = VALUES(status), update_time = VALUES(update_time)""".format(config["openvpn_client_table"])
+                cur.executemany(sql, upserts)
+            if deletes:
+                sql = """UPDATE {} SET status = 0, toggle_time = %s, update_time = %s WHERE cn = %s""".format(config["openvpn_client_table"])
+                cur.executemany(sql, deletes)
+            conn.commit()
+            cur.close()
+            log("Flushed %d connected, %d disconnected clients." % (len(upserts), len(deletes)))
+        except Exception as e:
+            log("Failed to flush %d events: %s" % (len(pending), e))
+            # keep the events for the next flush, newer events of the same cn win
+            for cn, event in pending.items():
+                self.pending.setdefault(cn, event)
+            self.conn = None
+
+    def serve(self):
+        path = config["sink_socket"]
+        if os.path.exists(path):
+            os.unlink(path)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        # no other local user may forge events, not even between bind and chmod
+        umask = os.umask(0o177)
+        try:
+            sock.bind(path)
+        finally:
+            os.umask(umask)
+        try:
+            os.chown(path, -1, grp.getgrnam(config["sink_group"]).gr_gid)
+            os.chmod(path, 0o660)
+        except KeyError:
+            log("Group %s not found, only root can send events." % config["sink_group"])
+        interval = config["flush_interval_ms"] / 1000.0
+        log("Listening on %s, flush every %sms." % (path, config["flush_interval_ms"]))
+
+        next_flush = time.monotonic() + interval
+        try:
+            while self.running:
+                sock.settimeout(max(next_flush - time.monotonic(), 0.001))
+                try:
+                    data = sock.recv(4096)
+                    self.add_event(json.loads(data.decode("utf-8")))
+                except socket.timeout:
+                    pass
+                except ValueError as e:
+                    log("Invalid event: %s" % e)
+                if time.monotonic() >= next_flush or len(self.pending) >= config["flush_max_events"]:
+                    self.flush()
+                    next_flush = time.monotonic() + interval
+        finally:
+            self.flush()
+            sock.close()
+            os.unlink(path)
+
+    def stop(self, *args):
+        self.running = False
+
+
+if __name__ == "__main__":
+    sink = EventSink()
+    signal.signal(signal.SIGTERM, sink.stop)
+    signal.signal(signal.SIGINT, sink.stop)
+    sink.serve()
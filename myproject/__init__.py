@@ -68,6 +68,10 @@ def create_app(test_config=None):
     else:
         # load the test config if passed in
         app.config.update(test_config)
+
+    # opt-in per request SQL and timing instrumentation, registered first to time the other hooks too
+    from common.utils.bp_ovpn.instrumentation import RequestMetrics
+    RequestMetrics.init_app(app)
         
     # i18n config   
     def get_locale():
@@ -220,9 +224,13 @@ def create_app(test_config=None):
     from .flask_command import check_db_integrity
     check_db_integrity()   
     
-    # update config CUSTOMER_SITE from db
-    cs = dbs.scalar(select(OfSystemConfig).where(OfSystemConfig.item == 'CUSTOMER_SITE'))
-    app.config.update(CUSTOMER_SITE = cs.ivalue.strip(),)
+    # update config CUSTOMER_SITE etc. from db, kept in sync across the workers by LISTEN/NOTIFY
+    from common.utils.bp_ovpn.sysconfig import SystemConfig
+    SystemConfig.init_app(app)
+    
+    # cert generation job workers, started per worker process as the listener, the queued jobs survive a restart
+    from common.utils.bp_ovpn.jobs import JobQueue
+    app.before_request(JobQueue.ensure_started)
     
     # context processors
     @app.context_processor
@@ -244,6 +252,10 @@ def create_app(test_config=None):
     # from myproject import db
     # db.init_app(app)
 
+    # return the pooled connections of get_db at the end of every request, init-db stays unregistered
+    from myproject.db import close_db
+    app.teardown_appcontext(close_db)
+
     # register the flask command: initialize-db
     from myproject import flask_command
     flask_command.init_app(app)
@@ -13,11 +13,14 @@ from flask import session
 from flask import current_app as app
 from flask import jsonify
 from flask import send_file
+from flask import Response
 from flask import jsonify
 
 import datetime
+import queue
 import re
 import os
+import hmac
 import subprocess
 import platform
 import pathlib
@@ -34,6 +37,15 @@ from myproject.db import get_cur, get_db
 
 from myproject.context import logger
 from common.utils.bp_ovpn import OvpnUtils
+from common.utils.bp_ovpn.sysconfig import SystemConfig
+from common.utils.bp_ovpn.metrics import system_sampler
+from common.utils.bp_ovpn.events import broker, format_sse
+from common.utils.bp_ovpn.proxy_reload import ProxyReloader
+from common.utils.bp_ovpn.jobs import JobQueue
+from common.utils.bp_ovpn.cert_batch import CertBatch, make_req_dir, read_reqs
+from common.utils.bp_ovpn.signer import SignerError, get_signer
+from common.utils.bp_ovpn.proxy_config import get_proxy_builder, generate_url as generateUrl
+from common.utils.bp_ovpn.instrumentation import RequestMetrics
 from myproject.context import DBSession as dbs
 from sqlalchemy import select
 from sqlalchemy import update
@@ -53,13 +65,8 @@ def cp_ovpn_services():
     Returns:
         dict: k, v for variable and value
     """
-    servers = OvpnUtils.get_all_openvpn_services(managed=1)
-    openvpn_server_list = {}
-    if servers:
-        for server in servers:
-            openvpn_server_list.update({server.server_name: str(server.id)})
-    print(servers)
-    return dict(OPENVPN_SERVER_LIST=openvpn_server_list)
+    # cached, dropped when a service is added, updated or deleted
+    return dict(OPENVPN_SERVER_LIST=OvpnUtils.get_openvpn_server_list())
 
 ####################################################################################
 # Main dashboard
@@ -76,6 +83,8 @@ def index():
     context = {'system_info': sys_info}
     if request.method == "POST":
         if request.form.get('action', '') == "db_refresh":
+            # short history of the background sampler for the sparklines
+            context['history'] = OvpnUtils.get_system_history()
             return jsonify(context)
     else:
         return render_template("ovpn/dashboard.html", system_info=sys_info)
@@ -127,6 +136,45 @@ def index1():
     
     return render_template("ovpn/dashboard.html", topOnline=topOnline)
 
+####################################################################################
+# Server-Sent Events of the dashboard and the clients pages
+####################################################################################
+@ovpn_bp.route("/events")
+@login_required
+def events():
+    """
+    @summary: text/event-stream of the system metrics ("metrics") and the client connect/disconnect events ("clients")
+    @return: streamed response, one worker thread per open page,
+             503 over OVPN_EVENTS_MAX_STREAMS streams of this process: the pages poll instead
+    """
+    system_sampler.ensure_started()
+    SystemConfig.ensure_listener()
+    subscriber = broker.subscribe(limit=app.config['OVPN_EVENTS_MAX_STREAMS'])
+    if subscriber is None:
+        logger.warning("Too many event streams in this process, the page falls back to polling")
+        return Response("Too many event streams", status=503, headers={"Retry-After": "60"})
+    
+    def stream():
+        try:
+            yield "retry: 5000\n\n"
+            yield format_sse("metrics", system_sampler.latest())
+            while True:
+                try:
+                    event, data = subscriber.get(timeout=15)
+                except queue.Empty:
+                    # keep the proxies from closing the idle connection, a closed browser is seen here too
+                    yield ": keepalive\n\n"
+                    continue
+                yield format_sse(event, data)
+        finally:
+            broker.unsubscribe(subscriber)
+    
+    return Response(
+        stream(),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
 ####################################################################################
 # introduction view
 ####################################################################################
@@ -209,28 +257,34 @@ def servers(page):
         # else:
         #     ss = OvpnUtils.get_all_openvpn_services()
         ss = OvpnUtils.get_all_openvpn_services()
-        total = len(ss.all())
-        print(total)
-        servers = ss.limit(page_size).offset((page-1)*page_size)
-        return_servers = []
-        
+        total = ss.count()
+        if page_size > 0:
+            ss = ss.limit(page_size).offset((page-1)*page_size)
+        else:
+            # 'All' (-1) page size: one page of every server
+            page_size = max(total, 1)
+        servers = ss.all()
         
+        # one batch probe of the page, cached for a few seconds
+        statuses = OvpnUtils.get_openvpn_running_statuses(servers)
         return_servers = []
-        if not platform.system().startswith("Linux"):
-            for server in servers:
-                server.running_status = 0
-                return_servers.append(server)
-        else:
-            for server in servers:            
-                status = OvpnUtils.get_openvpn_running_status(server)
-                if status:
-                    server.running_status = status["status"]
-                else:
-                    server.running_status = 0
-                return_servers.append(server)
+        for server in servers:
+            server.running_status = statuses.get(str(server.id), 0)
+            return_servers.append(server)
         pagination = Pagination(page=page, total=total, per_page=page_size)
         return render_template("ovpn/servers.html", servers=return_servers, pagination=pagination)
 
+@ovpn_bp.route("/servers/status", methods=("GET", "POST"))
+@login_required
+def servers_status():
+    """
+    @summary: running status of all the ovpn services, polled by the servers page
+    @return: json: {server id: 1 running | 0 not running}
+    """
+    force = request.values.get('force', '') in ('1', 'true')
+    return jsonify(OvpnUtils.get_openvpn_running_statuses(force=force))
+
+
 @ovpn_bp.route("/server/<server_id>/update", methods=("POST", "GET"))
 @login_required
 def server_update(server_id):
@@ -453,103 +507,35 @@ def refreshProxyConfig():
     @summary: refresh all proxy config and restart Apache
     @return: refreshed page
     """
-    # db cursor
-    conn = get_db()    
-    cur = conn.cursor(cursor_factory = psycopg2.extras.RealDictCursor)
-
     previousUrl = request.referrer
-    
-    # system configs
-    sql = "select * from sysconfig"
-    
-    try:
-        cur.execute(sql)    
-        # js console result
-        result = "success"
-        message = "All good"
-    except Exception as e:
-        result = "danger"
-        message = "Error: " + str(e)
-        flash(message, result)
-        return redirect(previousUrl)          
-    urls = []
 
     try:
-        IP_REMOTE = app.config['IP_REMOTE']
-        IP_PORT = app.config['IP_PORT']    
-        PROXY_PREFIX = app.config['PROXY_PREFIX']
-        APACHE_ROOT = app.config['DIR_APACHE_ROOT']
-        APACHE_SUB = app.config['DIR_APACHE_SUB']
+        builder = get_proxy_builder(app.config)
     except Exception as e:
         flash("Error: KeyError " + str(e), "danger")
         return redirect(previousUrl)
-    
-    # previous URL
-    previousUrl = request.referrer
          
-    # Apache config files
-    proxyConfigFile = pathlib.Path(APACHE_ROOT, APACHE_SUB, 'reverse_proxy_local.conf')
-    proxyConfigTemplate = pathlib.Path(APACHE_ROOT, APACHE_SUB, 'boss.template')
-    
-    if not proxyConfigFile.exists() or not proxyConfigTemplate.exists():
-        flash("Error: Apache config directory does not exist!!", "danger")
+    # Apache config files or nginx map
+    if not builder.prepare():
+        flash("Error: {} config directory does not exist!!".format(builder.server), "danger")
         return redirect(previousUrl)
 
-    # erease config file
-    with open(proxyConfigFile, 'w') as fp:
-        fp.truncate()
-    # read the proxy config template 
-       
-    with open(proxyConfigTemplate, 'r') as fp:
-        targetConfig = [p.strip() for p in fp.read().split('\n\n')][0]
-           
-    for table in ['tunovpnclients', 'ovpnclients']:
-        sql = "select * from {table}".format(table=table)
-        cur.execute(sql)
-        count = cur.rowcount
-    
-        ovpnClients = cur.fetchall()
-        
-        for ovpnClient in ovpnClients:
-            url = ''
-            ip = ovpnClient['ip']
-            # config proxy if not
-            if len(ovpnClient['url']) < 10:
-                # need to setup proxyConfig, set url to: len("RVRP@9801456451909-0xc0a8788a@") - 30 // len(9801456451909) - 13
-                sql = "update {table} set url=%s where cn=%s".format(table=table)
-                IP_CODED = generateUrl(PROXY_PREFIX, ip)
-                url = PROXY_PREFIX + '@' + IP_CODED + '@'
-                try:
-                    cur.execute(sql, (IP_CODED, ovpnClient['cn']))
-                    conn.commit()
-                    result = 'success'
-                    update = 'yes'
-                except Exception as e:
-                    message=str(e)
-                    result = "danger"   
-            else:
-                IP_CODED = ovpnClient['url']
-                update = 'no'
-                url = PROXY_PREFIX + '@' + IP_CODED +'@'
-            
-            urls.append(url)
-            flag = 0          
-
-            newConfig = targetConfig 
-            newConfig = newConfig.replace("__IP_LOCALE__", ip)
-            newConfig = newConfig.replace("__PROXY_PREFIX__", PROXY_PREFIX)
-            newConfig = newConfig.replace("__IP_CODED__", IP_CODED)
-            newConfig = newConfig.replace("__IP_REMOTE__", IP_REMOTE)
-            newConfig = newConfig.replace("__IP_PORT__", IP_PORT)
-                
-            with open(proxyConfigFile, 'a') as fp:
-                fp.write("\n")
-                fp.write(newConfig)
-                fp.write("\n")
+    # render all the clients in one write, the config file is replaced atomically
+    try:
+        res = builder.build(get_db())
+        result = "success"
+        if res["changed"]:
+            ProxyReloader.request("refresh")
+            message = "Proxy config refreshed: {} clients, {} new urls, the proxy reloads in a few seconds.".format(res["clients"], res["backfilled"])
+        else:
+            message = "Proxy config is up to date: {} clients.".format(res["clients"])
+    except Exception as e:
+        logger.error("Failed to refresh the proxy config: {}".format(str(e)))
+        result = "danger"
+        message = "Error: " + str(e)
             
     flash(message, result)
     return redirect(previousUrl)     
-    # return {"result": result, 'urls': urls, 'message': message}
 
 
 ####################################################################################
@@ -626,28 +612,6 @@ def updateStoreName(mode):
     return {"result": result}
 
 
-def ip2hex(ip):
-    """
-        @summary: turn ip to hex
-        @param ip: ip address
-        @return: hex ip prefixed '0x' like: 0x115ff0861
-    """
-    l = ip.split('.')
-    return '0x{:02x}{:02x}{:02x}{:02x}'.format(*map(int, l))
-
-
-def generateUrl(PROXY_PREFIX, ip):
-    """
-        @summary: generate BOSS URL
-        @param PROXY_PREFIX: PROXY_PREFIX from db
-        @param ip: ip address
-        @return: boss url like: RVRP@9801456451909-0xc0a8788a@
-    """
-    hexIp = ip2hex(ip)
-    n = 13
-    randomIntAddress = ''.join(["{}".format(randint(0, 9)) for num in range(0, n)])    
-    return '{}-{}'.format(randomIntAddress, hexIp)
-
 @ovpn_bp.route("/check<any(Tun,Tap):mode>ProxyConfig", methods=("POST",))
 @login_required
 def checkProxyConfig(mode):
@@ -720,37 +684,17 @@ def checkProxyConfig(mode):
         update = 'no'
         url = PROXY_PREFIX + '@' + IP_CODED +'@'
     
-    proxyConfigFile = pathlib.Path(APACHE_ROOT, APACHE_SUB, 'reverse_proxy_local.conf')
-    proxyConfigTemplate = pathlib.Path(APACHE_ROOT, APACHE_SUB, 'boss.template')
+    builder = get_proxy_builder(app.config)
     
-    if not proxyConfigFile.exists() or not proxyConfigTemplate.exists():
-        message = "Apache config file does not exited!!"
+    if not builder.prepare():
+        message = "{} config file does not exited!!".format(builder.server)
         result = "danger"
         return {"result": result, 'message': message}
     
-    flag = 0
-    
-    with open(proxyConfigFile, 'r') as fp:
-        lst = [p.strip() for p in fp.read().split('\n\n')]
-    
-    for lc in lst:
-        if re.findall(ip, lc):
-            flag = 1
-            break
-    
-    if not flag:
-        with open(proxyConfigTemplate, 'r') as fp:
-            newConfig = [p.strip() for p in fp.read().split('\n\n')]
-            newConfig = newConfig[0].replace("__IP_LOCALE__", ip)
-            newConfig = newConfig.replace("__PROXY_PREFIX__", PROXY_PREFIX)
-            newConfig = newConfig.replace("__IP_CODED__", IP_CODED)
-            newConfig = newConfig.replace("__IP_REMOTE__", IP_REMOTE)
-            newConfig = newConfig.replace("__IP_PORT__", IP_PORT)
-        
-        with open(proxyConfigFile, 'a') as fp:
-            fp.write("\n")
-            fp.write(newConfig)
-            fp.write("\n")
+    # exact ip lookup by the sidecar index, the new block is appended to the index too
+    if builder.index.find(ip) is None:
+        builder.append(ip, IP_CODED)
+        ProxyReloader.request(cn)
     return {"result": result, 'url': url, 'message': message, 'update': update}
 
 
@@ -787,41 +731,43 @@ def showProxyConfig(mode,cn):
     cur.execute(sql)
     
     try:
-        IP_REMOTE = app.config['IP_REMOTE']
-        IP_PORT = app.config['IP_PORT']    
-        PROXY_PREFIX = app.config['PROXY_PREFIX']
-        APACHE_ROOT = app.config['DIR_APACHE_ROOT']
-        APACHE_SUB = app.config['DIR_APACHE_SUB']
+        builder = get_proxy_builder(app.config)
     except Exception as e:
         return "Error: KeyError " + str(e) 
     
-    proxyConfigFile = pathlib.Path(APACHE_ROOT, APACHE_SUB, 'reverse_proxy_local.conf')
+    if not builder.prepare():
+        return "Error: {} config file does not exist!!".format(builder.server)
 
-    flag = 0
-    
-    with open(proxyConfigFile, 'r') as fp:
-        lst = [p.strip() for p in fp.read().split('\n\n')]
-    
-    for lc in lst:
-        if re.findall(ip, lc):
-            flag = 1
-            targetConfig = lc
-            break
+    targetConfig = builder.index.find(ip)
     
-    if not flag:
-        result = "something wrong"
+    if targetConfig is None:
+        configResult = "something wrong"
     else:
         configResult = targetConfig
         
-    # restart Apache2
-    result = subprocess.run('systemctl restart apache2', capture_output=True, shell=True)
-    if result.returncode != 0:
-        apacheResult = "Something wrong when restart Apache:<br>" + result.stdout.decode("utf-8") + '<br>'
+    # the config change requested a graceful reload already, only report its state
+    status = ProxyReloader.status()
+    if status["pending"] or status["running"]:
+        apacheResult = "Proxy reload in progress, the config is active in a few seconds.<br>"
+    elif status["finished"] and not status.get("ok"):
+        apacheResult = "Something wrong when reload the proxy:<br>" + status.get("output", "").replace("\n", "<br>") + '<br>'
     else:
-        apacheResult = "Apache restarted successfully!<br>"
+        apacheResult = "Proxy config is active.<br>"
     return apacheResult + configResult.replace("\n", "<br>")
 
 
+@ovpn_bp.route("/proxy/reload", methods=("POST","GET"))
+@login_required
+def proxyReload():
+    """
+    @summary: GET the state of the last proxy reload, POST to request a graceful reload
+    @return: json state, see ProxyReloader.status
+    """
+    if request.method == "POST":
+        return jsonify(ProxyReloader.request("manual"))
+    return jsonify(ProxyReloader.status())
+
+
 @ovpn_bp.route("/showAllProxyConfig", methods=("POST","GET"))
 @login_required
 def showAllProxyConfigs():
@@ -839,12 +785,14 @@ def showAllProxyConfigs():
     except Exception as e:
         return "FATAL ERROR: " + str(e) 
     
-    APACHE_ROOT = app.config['DIR_APACHE_ROOT']
-    APACHE_SUB = app.config['DIR_APACHE_SUB']
+    try:
+        builder = get_proxy_builder(app.config)
+    except Exception as e:
+        return "Error: KeyError " + str(e) 
     
     previousUrl = request.referrer
 
-    proxyConfigFile = pathlib.Path(APACHE_ROOT, APACHE_SUB, 'reverse_proxy_local.conf')
+    proxyConfigFile = builder.config_file
     if not proxyConfigFile.exists():
         # print(previousUrl)
         # flash('Apache config directory does not exist!!', 'danger')
@@ -964,24 +912,99 @@ def uploadIssueCert(mode):
                    
         if allowed_file(file.filename):
             filename = secure_filename(file.filename)            
-            file.save(os.path.join(files_dir, app.config['DIR_REQ'] ,filename))
             # bash /opt/ovpn_flask/vpntool/generate-boss-client-cert.sh  carel tun-ovpn-files
-            generate_script = os.path.join(app.config["BASE_DIR"], 'vpntool', 'generate-boss-client-cert.sh')    
-            result = subprocess.run(["bash", generate_script, files_dir, app.config['SITE_NAME'], subdir], capture_output=True, shell=False)
-            # print ("--------------: " + generate_script)
-            # print ("--------------: " + files_dir)
-            # print ("--------------: " + app.config['SITE_NAME'])
-            # print ("--------------: " + files_dir)
-            if result.returncode == 0 and re.findall('SELFDEFINEDS', result.stdout.decode('utf-8'), re.MULTILINE):
-                flash('Successfully generate cert file!', 'success')
+            # queued, the job workers run the script, at most OVPN_JOB_PKI_CONCURRENCY at once per files dir
+            try:
+                # a req dir of the job's own, a running script empties the shared reqs dir when it ends
+                req_dir = make_req_dir(files_dir)
+                file.save(os.path.join(req_dir, filename))
+                job_id = JobQueue.submit(
+                    "boss_cert", files_dir, [files_dir, app.config['SITE_NAME'], subdir], created_by=session.get("username"),
+                    meta={"env": {"REQDIR": req_dir}},
+                )
+            except Exception as e:
+                flash("Failed to queue the cert generation: " + str(e), 'danger')
                 return redirect (url_for("ovpn.generateBossClient", mode=mode))
-            else:
-                flash(result.stdout.decode('utf-8'), 'danger')
-                return redirect (url_for("ovpn.generateBossClient", mode=mode))   
+            flash('Cert generation queued, check the result at: ' + url_for("ovpn.job", job_id=job_id), 'success')
+            return redirect (url_for("ovpn.generateBossClient", mode=mode))
         else:
             flash('Filename length is not correct, please check!', 'danger')
             return redirect (url_for("ovpn.generateBossClient", mode=mode))
 
+@ovpn_bp.route("/generate/<any(tun,tap):mode>Issue/batch", methods=("POST",))
+@login_required
+def uploadIssueCertBatch(mode):
+    """
+    Generate boss cert files of many uploaded req files, .req or .zip of .req files, in one job
+
+    Returns:
+        json: {'result', 'message', 'job_id', 'accepted', 'rejected'}
+    """
+    if mode.lower() == 'tun':
+        files_dir = app.config['TUN_FILES_DIR']
+        subdir = "tun-ovpn-files"
+    else:
+        files_dir = app.config['TAP_FILES_DIR']
+        subdir = "tap-ovpn-files"
+
+    if platform.system().startswith("Windows"):
+        return jsonify({"result": "danger", "message": "Probably runs on windows in dev env, not allowed."})
+    files = [f for f in request.files.getlist('upload_reqs') if f.filename]
+    if not files:
+        return jsonify({"result": "danger", "message": "No selected file"})
+
+    reqs = []
+    try:
+        for file in files:
+            reqs.extend(read_reqs(secure_filename(file.filename), file.stream))
+        data = CertBatch.submit(files_dir, app.config['SITE_NAME'], subdir, reqs, created_by=session.get("username"))
+    except Exception as e:
+        logger.error("Failed to queue the cert batch: {}".format(str(e)))
+        return jsonify({"result": "danger", "message": str(e)})
+
+    if data["job_id"] is None:
+        data.update(result="danger", message="No valid req file")
+    else:
+        data.update(
+            result="success",
+            message="{} req files queued, {} rejected, check the result at: {}".format(
+                len(data["accepted"]), len(data["rejected"]), url_for("ovpn.job", job_id=data["job_id"])
+            ),
+        )
+    return jsonify(data)
+
+
+####################################################################################
+# OVPN background jobs
+####################################################################################
+
+@ovpn_bp.route("/jobs/<uuid:job_id>", methods=("GET",))
+@login_required
+def job(job_id):
+    """
+    @summary: state of a background job, poll it with ?offset=<offset of the previous answer> to get only the new log
+    @return: json job, 404 if there is no such job
+    """
+    data = JobQueue.get(job_id, request.args.get("offset", 0, type=int))
+    if data is None:
+        return jsonify({"result": "danger", "message": "No such job"}), 404
+    return jsonify(data)
+
+
+@ovpn_bp.route("/jobs/<uuid:job_id>/package", methods=("GET",))
+@login_required
+def jobPackage(job_id):
+    """
+    @summary: download the files packaged by a job, e.g. the profiles of a cert batch
+    @return: zip file, 404 if the job has no package
+    """
+    data = JobQueue.get(job_id)
+    package = ((data or {}).get("meta") or {}).get("package")
+    if not package or not os.path.exists(package):
+        return render_template('404.html'), 404
+    return send_file(package, as_attachment=True)
+
+
 ####################################################################################
 # OVPN tun generate generic certifications
 ####################################################################################
@@ -1033,20 +1056,22 @@ def generateGenericClientCert(mode):
     
     if re.match(pattern, new_cn):
         # bash /opt/ovpn_flask/vpntool/generate-generic-client-cert.sh /opt/tun-ovpn-files cn dev tun-ovpn-files
-        generate_script = os.path.join(app.config["BASE_DIR"], 'vpntool', 'generate-generic-client-cert.sh')    
-        result = subprocess.run(["bash", generate_script, files_dir, new_cn, app.config['SITE_NAME'], subdir], capture_output=True, shell=False)
-        print ("--------------: " + generate_script)
-        print ("--------------: " + new_cn)
-        print ("--------------: " + files_dir)
-        print ("--------------: " + app.config['SITE_NAME'])
-        print ("--------------: " + subdir)
-        if result.returncode == 0 and re.findall('SELFDEFINEDS', result.stdout.decode('utf-8'), re.MULTILINE):
+        if app.config.get('OVPN_CERT_SIGNER') == 'python':
+            # signed in-process by the CA loaded once per worker, no easyrsa tree copy
+            try:
+                get_signer(files_dir).issue_generic(new_cn)
+            except SignerError as e:
+                flash(str(e), 'danger')
+                return redirect (url_for("ovpn.generateBossClient", mode=mode))
             flash('Successfully generate cert file for cn: ' + new_cn, 'success')
             return redirect (url_for("ovpn.generateBossClient", mode=mode))
-        else:
-            flash(result.stdout.decode('utf-8'), 'danger')
-            return redirect (url_for("ovpn.generateBossClient", mode=mode))  
-        return render_template("ovpn/tunGenericIssueCert.html")
+        try:
+            job_id = JobQueue.submit("generic_cert", files_dir, [files_dir, new_cn, app.config['SITE_NAME'], subdir], created_by=session.get("username"))
+        except Exception as e:
+            flash("Failed to queue the cert generation: " + str(e), 'danger')
+            return redirect (url_for("ovpn.generateBossClient", mode=mode))
+        flash('Cert generation for cn: ' + new_cn + ' queued, check the result at: ' + url_for("ovpn.job", job_id=job_id), 'success')
+        return redirect (url_for("ovpn.generateBossClient", mode=mode))
         # generate new CN here 
     else:      
         flash("Only a-zA-Z, number, _ allowed, please check!", "danger")
@@ -1472,7 +1497,11 @@ def users(page):
 
         us = OvpnUtils.get_all_users()
         total = len(us.all())
-        users = us.limit(page_size).offset((page - 1) * page_size)
+        if page_size > 0:
+            users = us.limit(page_size).offset((page - 1) * page_size)
+        else:
+            # 'All' (-1) page size: one page of every user
+            users, page_size = us, max(total, 1)
 
         pagination = Pagination(page=page, total=total, per_page=page_size)
         return render_template("ovpn/users.html", users=users, pagination=pagination)
@@ -1530,18 +1559,20 @@ def system_config():
             return redirect(url_for("ovpn.system_config"))
 
         if result == "success":
-            for key in list(args.keys()):
-                try:
+            try:
+                for key in list(args.keys()):
                     dbs.execute(
                         update(OfSystemConfig).where(OfSystemConfig.item == key).values(ivalue=args.get(key))
                         )
-                    app.config.update({key: args.get(key)})
-                    dbs.commit()
-                except Exception as e:
-                    message = e
-                    result = "danger"
-                finally:
-                    pass
+                # all the workers reload the config and their app.config when this commits
+                SystemConfig.notify(dbs, list(args.keys()))
+                dbs.commit()
+            except Exception as e:
+                dbs.rollback()
+                message = e
+                result = "danger"
+            finally:
+                SystemConfig.reload()
         
         if not message:
             message = "Update successfully!!"
@@ -1618,3 +1649,20 @@ def show_url_map():
         #     links.append((url, rule.endpoint))
         links.append({rule.endpoint: rule.rule})
     return jsonify(links)
+
+
+@ovpn_bp.route("/metrics", methods=("GET",))
+def metrics():
+    """
+    Request histograms of all the worker processes for Prometheus, see OVPN_INSTRUMENTATION.
+    No login, the scraper sends the bearer token OVPN_INSTRUMENTATION_TOKEN.
+
+    @return: Prometheus text format
+    """
+    token = app.config.get('OVPN_INSTRUMENTATION_TOKEN')
+    if not app.config.get('OVPN_INSTRUMENTATION') or not token:
+        abort(404)
+    # behind the Apache proxy every request comes from 127.0.0.1, the address proves nothing
+    if not hmac.compare_digest(request.headers.get('Authorization', '').encode(), "Bearer {}".format(token).encode()):
+        abort(401)
+    return Response(RequestMetrics.render(), mimetype="text/plain; version=0.0.4")
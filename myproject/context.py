@@ -24,7 +24,25 @@ logger = logutil.get_logger(log_name=ProductionConfig.LOG_FILE or 'ovpn_flask_mg
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker, scoped_session
 from config import ProductionConfig
-engine = create_engine(ProductionConfig.SQLALCHEMY_DATABASE_URI, pool_size=20, pool_recycle=600, pool_pre_ping=True, pool_reset_on_return='rollback', pool_timeout=15)
+
+
+def request_threads() -> int:
+    """ Request threads of this process, the "threads" option of uWSGI. """
+    try:
+        import uwsgi
+        return max(int(uwsgi.opt.get("threads", 1)), 1)
+    except (ImportError, ValueError, TypeError):
+        return ProductionConfig.DB_POOL_REQUEST_THREADS
+
+
+# a connection per request thread and per background thread is kept, the overflow is small and fixed:
+# the connections of all the processes must stay under the postgres max_connections
+engine = create_engine(
+    ProductionConfig.SQLALCHEMY_DATABASE_URI,
+    pool_size=request_threads() + ProductionConfig.OVPN_JOB_WORKERS + ProductionConfig.DB_POOL_BACKGROUND,
+    max_overflow=ProductionConfig.DB_POOL_OVERFLOW,
+    pool_recycle=600, pool_pre_ping=True, pool_reset_on_return='rollback', pool_timeout=15,
+)
 DBSession = scoped_session(sessionmaker(bind=engine, autocommit=False, autoflush=False))
 
 
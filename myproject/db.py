@@ -4,6 +4,8 @@ import click
 from flask import current_app
 from flask import g
 from flask.cli import with_appcontext
+from common.utils.bp_ovpn.instrumentation import RequestMetrics
+from myproject.context import engine
 
 """
 the get_db and some other functions are for traditional db connections
@@ -18,18 +20,14 @@ cur.execute(
 
 """
 def get_db():
-    """Connect to the application's configured database. The connection
-    is unique for each request and will be reused if this is called
-    again.
+    """Borrow a raw psycopg2 connection of the engine pool for the request,
+    it is reused if this is called again and returned to the pool by
+    close_db when the app context ends, instead of a new connection per
+    request.
     """
     if "db" not in g:
-        g.db = psycopg2.connect(
-            host=current_app.config['PG_DATABASE_HOST'], 
-            user=current_app.config['PG_DATABASE_USER'], 
-            password=current_app.config['PG_DATABASE_PASSWORD'], 
-            database=current_app.config['PG_DATABASE_DB'],
-            port=int(current_app.config['PG_DATABASE_PORT']),
-        )
+        # timed cursors if the request instrumentation is on
+        g.db = RequestMetrics.wrap_connection(engine.raw_connection())
         # g.db.row_factory = MySQL.Row
     return g.db
 
@@ -45,7 +43,8 @@ def get_cur():
 
 def close_db(e=None):
     """
-        If this request connected to the database, close the connection.
+        If this request borrowed a connection, return it to the pool, the
+        pool rolls back what was not committed.
     """
     db = g.pop("db", None)
 
@@ -2,6 +2,7 @@ import click
 from flask.cli import with_appcontext
 from myproject.context import logger
 from orm.ovpn import OfUser, OfGroup, OfSystemConfig, OvpnServers, OvpnClients, OvpnCommonConfig
+from common.utils.bp_ovpn.sysconfig import SystemConfig
 from sqlalchemy import select
 from werkzeug.security import generate_password_hash
 import uuid
@@ -23,6 +24,7 @@ def check_db_integrity():
     # Base.metadata.drop_all(engine)
     logger.debug("Run create all to create table if sone table or all tables not been created before!")
     Base.metadata.create_all(engine)
+    check_db_indexes()
     
     # table: om_group
     new_groups = []
@@ -57,6 +59,9 @@ def check_db_integrity():
         'CUSTOMER_SITE': 'Un-named', 
         'DIR_APACHE_ROOT': '/etc/apache2',
         'DIR_APACHE_SUB': 'site-enabled',
+        'DIR_NGINX_ROOT': '/etc/nginx',
+        'DIR_NGINX_SUB': 'conf.d',
+        'DIR_ISSUED_CERTS': '/opt/easyrsa-all/pki/issued',
         "DIR_EASYRSA": 'easyrsa',
         "DIR_GENERIC_CLIENT": 'generic',
         "DIR_REQ_TMP": 'reqs_tmp',
@@ -69,7 +74,8 @@ def check_db_integrity():
         "ZIP_EASYRSA": '/opt/certs_ovpn_flask/easyrsa.zip',
         "IP_PORT": '',
         "IP_REMOTE": '',
-        "PROXY_PREFIX": ''
+        "PROXY_PREFIX": '',
+        "PROXY_SERVER": 'apache'
     }
     new_items = []
     for item in system_config_dict.keys():
@@ -81,24 +87,185 @@ def check_db_integrity():
     if new_items:
         dbsession.add_all(new_items)
         dbsession.commit()
+        SystemConfig.invalidate()
         
     logger.info("Sqlalchemy tables initialize done")
     
 
+def check_db_indexes():
+    """
+        Create the indexes added after the tables were created, create_all does not touch existing tables.
+    """
+    from myproject.context import engine
+    from sqlalchemy import text
+    logger.info("- Check the ovpn_clients indexes now")
+    for index in OvpnClients.__table__.indexes:
+        try:
+            index.create(engine, checkfirst=True)
+        except Exception as e:
+            logger.error("Failed to create index {}: {}".format(index.name, str(e)))
+
+    # trigram indexes for the ilike '%x%' search, pg_trgm needs the privilege to create extensions
+    with engine.connect() as conn:
+        try:
+            conn.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+            for col in OvpnClients.SEARCH_COLUMNS:
+                conn.execute(text(
+                    "CREATE INDEX IF NOT EXISTS ix_ovpn_clients_{col}_trgm ON ovpn_clients USING gin ({col} gin_trgm_ops)".format(col=col)
+                ))
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            logger.error("Failed to create the clients search trigram indexes: {}".format(str(e)))
+
+
 @click.command("prepare-data")
 # @with_appcontext
 @click.argument('action')
+@click.option('--users', default=Stress_Num, type=int, help='Test users test1..N.')
+@click.option('--servers', default=2, type=int, help='Test ovpn servers test1..N.')
+@click.option('--clients', default=Stress_Num*2, type=int, help='Test clients, spread over the servers.')
 # @click.option('--toduhornot', is_flag=True, help='prints "duh..."')
-def prepare_data_command(action):
+def prepare_data_command(action, users, servers, clients):
     """
     Add or delete data to database for test purpose.
     
         add:\n
             add test data\n
         delete:\n
-            delete test data
+            delete test data, only the users and servers test1..N of --users and --servers
+    """
+    prepare_data(action, users, servers, clients)
+
+
+@click.command("sync-status")
+@click.option('--interval', default=0, type=float, help='Seconds between two syncs, 0 to sync once.')
+def sync_status_command(interval):
+    """
+    Sync the openvpn status files of the managed servers to ovpn_clients.
+
+    With an interval, this is also the only process connected to the management interfaces,
+    see etc/ovpnflask-sync-status.service.
+    """
+    import time
+    from common.utils.bp_ovpn import OvpnUtils
+    from common.utils.bp_ovpn.management import OvpnManagementPool
+
+    while True:
+        servers = OvpnUtils.get_all_openvpn_services(managed=1).all()
+        for server in servers:
+            result = OvpnUtils.sync_openvpn_status_file(server)
+            if result["changed"]:
+                logger.info("Status file of {} synced: {}".format(server.server_name, str(result)))
+            if interval:
+                OvpnManagementPool.sync(server)
+        OvpnManagementPool.retain(s.id for s in servers)
+        dbsession.remove()
+        if not interval:
+            break
+        time.sleep(interval)
+
+
+@click.command("issue-certs")
+@click.option('--mode', type=click.Choice(['tun', 'tap']), default='tun', help='Files dir of the PKI.')
+@click.option('--wait', is_flag=True, help='Wait for the job and print its log.')
+@click.argument('paths', nargs=-1, required=True, type=click.Path(exists=True))
+def issue_certs_command(mode, wait, paths):
+    """
+    Issue the BOSS certs of .req files, .zip files of .req files or dirs of them in one job.
+    """
+    import os
+    import threading
+    import time
+    from flask import current_app
+    from common.utils.bp_ovpn.cert_batch import CertBatch, read_reqs
+    from common.utils.bp_ovpn.jobs import JobQueue, JOB_QUEUED, JOB_RUNNING
+
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(os.path.join(path, n) for n in sorted(os.listdir(path)) if n.lower().endswith((".req", ".zip")))
+        else:
+            files.append(path)
+    reqs = []
+    for path in files:
+        with open(path, "rb") as fp:
+            reqs.extend(read_reqs(os.path.basename(path), fp))
+
+    files_dir = current_app.config['TUN_FILES_DIR' if mode == 'tun' else 'TAP_FILES_DIR']
+    result = CertBatch.submit(files_dir, current_app.config['SITE_NAME'], "{}-ovpn-files".format(mode), reqs, created_by="cli")
+    for name, error in result["rejected"].items():
+        click.echo("Rejected {}: {}".format(name, error))
+    if result["job_id"] is None:
+        raise click.ClickException("No valid req file")
+    click.echo("Job {}: {} reqs queued".format(result["job_id"], len(result["accepted"])))
+
+    if wait:
+        # run it here if the web workers are busy or not started, but no other job: they would be killed with the command
+        threading.Thread(target=JobQueue.run_one, args=(result["job_id"],), name="ovpn-job-cli", daemon=True).start()
+        offset = 0
+        while True:
+            job = JobQueue.get(result["job_id"], offset)
+            click.echo(job["log"], nl=False)
+            offset = job["offset"]
+            if job["status"] not in (JOB_QUEUED, JOB_RUNNING):
+                break
+            time.sleep(1)
+        click.echo("Job {}: {}, package: {}".format(job["id"], job["state"], (job["meta"] or {}).get("package")))
+
+
+@click.command("update-expire-dates")
+@click.option('--issued-dir', multiple=True, help='Dir of the issued <cn>.crt files, the system config DIR_ISSUED_CERTS by default.')
+@click.option('--full', is_flag=True, help='Parse all the certs, not only the changed ones.')
+@click.option('--workers', default=0, type=int, help='Parser processes, 0 for OVPN_CERT_EXPIRY_WORKERS.')
+def update_expire_dates_command(issued_dir, full, workers):
+    """
+    Update the expire date of the clients from their issued certs.
+    """
+    from common.utils.bp_ovpn.cert_expiry import CertExpiryScanner
+
+    issued_dirs = issued_dir or [SystemConfig.get("DIR_ISSUED_CERTS", '/opt/easyrsa-all/pki/issued')]
+    result = CertExpiryScanner(issued_dirs, workers=workers or None).scan(full=full)
+    click.echo("{certs} certs, {parsed} parsed, {failed} failed, {updated} clients updated".format(**result))
+
+
+@click.command("benchmark")
+@click.option('--clients', default='1000,10000,100000', help='Comma separated test clients sizes, empty to skip.')
+@click.option('--files', default='10000,100000', help='Comma separated cert files sizes per kind, empty to skip.')
+@click.option('--servers', default=1, type=int, help='Test ovpn servers the clients are spread over.')
+@click.option('--requests', default=50, type=int, help='Measured requests per endpoint.')
+@click.option('--output', default='benchmark.json', type=click.Path(dir_okay=False), help='JSON report file.')
+@click.option('--compare', type=click.Path(exists=True, dir_okay=False), help='Report of a previous run to compare with.')
+@click.option('--keep', is_flag=True, help='Keep the test data of the last size.')
+def benchmark_command(clients, files, servers, requests, output, compare, keep):
     """
-    prepare_data(action)
+    Benchmark the ovpn endpoints against the configured database, it replaces the prepare-data test data.
+    """
+    import json
+    from flask import current_app
+    from common.utils.bp_ovpn.benchmark import EndpointBenchmark, compare_reports, write_report
+
+    def sizes(value):
+        return [int(v) for v in value.split(',') if v.strip()]
+
+    bench = EndpointBenchmark(current_app._get_current_object(), requests=requests, servers=servers)
+    report = bench.run(sizes(clients), sizes(files), keep=keep)
+    write_report(report, output)
+    for r in report["results"]:
+        click.echo("{:<28} {:>8} p50 {:>9.2f}ms p90 {:>9.2f}ms p99 {:>9.2f}ms {:>6} queries".format(
+            r["endpoint"], r.get("clients", r.get("files")), r["p50_ms"], r["p90_ms"], r["p99_ms"], r["queries_per_request"]
+        ))
+    click.echo("Report written to {}".format(output))
+
+    if compare:
+        with open(compare, "r") as fp:
+            old = json.load(fp)
+        click.echo("Compared with {} ({}), new/old:".format(compare, old.get("meta", {}).get("commit", "")[:10]))
+        for row in compare_reports(old, report):
+            click.echo("{:<28} {:>8} p50 {} p99 {} queries {}".format(
+                row["endpoint"], row["clients"] or row["files"],
+                row["p50_ms"][2], row["p99_ms"][2], row["queries_per_request"][2],
+            ))
 
 
 def init_app(app):
@@ -106,168 +273,37 @@ def init_app(app):
     the application factory.
     """
     app.cli.add_command(prepare_data_command)
+    app.cli.add_command(sync_status_command)
+    app.cli.add_command(issue_certs_command)
+    app.cli.add_command(update_expire_dates_command)
+    app.cli.add_command(benchmark_command)
     
 from myproject.context import engine, DBSession as dbsession
 from orm.ovpn import Base   
  
-def prepare_data(action="add"):
+def prepare_data(action="add", users=Stress_Num, servers=2, clients=Stress_Num*2):
     if action not in ("add", "delete"):
         logger.warning("Run command |prepare-data| without correct action: add or delete")
         return
     
     logger.info("##############################################################")
     logger.info("Check database test data.")
+    from common.utils.bp_ovpn.seed import TestDataSeeder, remove_tree
     if action == "add":
         """Add test data."""
-        
-        # table: om_group
-        logger.debug("- Check the om_group table group: TEST")
-        group = "TEST"
-        result = dbsession.scalar(select(OfGroup).where(OfGroup.name == group))
-        logger.debug("Check group: {} {}".format(group, str(result)))
-        if not result:
-            logger.info(f"Add group to db {group}")
-            dbsession.add(OfGroup(name=group))
-            dbsession.commit()
-        else:
-            logger.debug("- Om_group table group: TEST has been added before!")        
-            
-        # table: om_users 
-        logger.info("- Check the user table now")
-        logger.info("- Check the test 1-1000 users list")
-        for i in range(1, Stress_Num+1):
-            username = "test{}".format(str(i))
-            result = dbsession.scalar(select(OfUser).where(OfUser.username == username))
-            if not result:
-                logger.debug("Add test user: {} to db".format(username))
-                dbsession.add(OfUser(
-                    username=username, 
-                    password=generate_password_hash(username), 
-                    name=username, 
-                    email='{}@example.com'.format(username), 
-                    group_id=dbsession.scalar(select(OfGroup).where(OfGroup.name == 'TEST')).id
-                    ))
-                dbsession.commit()
-        
-        # table: ovpn_servers
-        logger.debug("- Check the ovpn_servers table, ovpn service: test1 ")
-        logger.info("- Check the ovpn_servers table now")
-        for i in range(1, 3):
-            service = "test{}".format(str(i))
-            result = dbsession.scalar(select(OvpnServers).where(OvpnServers.server_name == service))
-            if not result:
-                logger.debug("Add test ovpn service: {} to db".format(service))
-                dbsession.add(OvpnServers(
-                    server_name=service, 
-                    configuration_dir='/etc/openvpn/test{}'.format(str(i)), 
-                    configuration_file='test{}.conf'.format(str(i)), 
-                    status_file='test{}-status.log'.format(str(i)),
-                    log_file_dir='/var/log/',
-                    log_file='test{}.log'.format(str(i)),
-                    startup_service='test{}-ovpn.service'.format(str(i)),
-                    certs_dir='certs-test{}'.format(str(i)),
-                    management_port=33000+i,
-                    management_password='123456789'
-                    ))
-                dbsession.commit()
-                    
-        # table: ovpn_clients 
-        logger.debug("- Check the ovpn_clients table, ovpn clients: test1-1000")
-        for i in range(1, 3):
-            service = "test{}".format(str(i))
-            result = dbsession.scalar(select(OvpnServers).where(OvpnServers.server_name == service))
-            if not result:
-                logger.debug("Add test ovpn service: {} to db".format(service))
-                dbsession.add(OvpnServers(
-                    server_name=service, 
-                    configuration_dir='/etc/openvpn/test{}'.format(str(i)), 
-                    configuration_file='test{}.conf'.format(str(i)), 
-                    status_file='test{}-status.log'.format(str(i)),
-                    log_file_dir='/var/log/',
-                    log_file='test{}.log'.format(str(i)),
-                    startup_service='test{}-ovpn.service'.format(str(i)),
-                    certs_dir='certs-test{}'.format(str(i)),
-                    management_port=33000+i,
-                    management_password='123456789'
-                    ))
-                dbsession.commit()
-            else:
-                logger.debug(f"- ovpn_servers table: ovpn servcie test{i} has been added")        
-            
-        logger.debug("- Check the ovpn_clients table now")
-        logger.info("- Check the fake test clients: test1-1000 ")
-        start_ip = ipaddress.ip_address('10.168.0.0')
-        for s in range(1, 3):
-            for i in range(1, Stress_Num+1):
-                start_ip = start_ip + 1
-                site_name = "test{}".format(str(i))
-                cn = "test-{}".format(str(uuid.uuid4()))
-                ts_id = dbsession.scalar(select(OvpnServers).where(OvpnServers.server_name == f"test{s}")).id
-                result = dbsession.scalar(select(OvpnClients).where(OvpnClients.site_name == site_name, OvpnClients.server_id == ts_id))
-                if not result:
-                    logger.debug("Add test client site_name: {} to db".format(site_name))
-                    dbsession.add(OvpnClients(
-                        server_id=dbsession.scalar(select(OvpnServers).where(OvpnServers.server_name == f'test{s}'.format())).id, 
-                        site_name=site_name, 
-                        cn=cn, 
-                        ip=start_ip.exploded              
-                        ))
-                    dbsession.commit()                          
+        logger.info("- Add the test users, ovpn servers and clients: {} {} {}".format(users, servers, clients))
+        TestDataSeeder(users, servers, clients).add()
         logger.info("Test data added done!")
     else:
         """Delete test data."""
-        
-        # table: om_users 
-        logger.info("- Check the user table now")
-        logger.info("- Check the test 1-1000 users list")
-        for i in range(1, Stress_Num+1):
-            username = "test{}".format(str(i))
-            result = dbsession.scalar(select(OfUser).where(OfUser.username == username))
-            if result:
-                logger.debug("Delete test user: {}".format(username))
-                dbsession.delete(result)
-                dbsession.commit()
-                        
-        # table: om_group
-        logger.debug("- Check the om_group table group: TEST")
-        group = "TEST"
-        result = dbsession.scalar(select(OfGroup).where(OfGroup.name == group))
-        logger.debug("Check group: {} {}".format(group, str(result)))
-        if result:
-            logger.info(f"Delete group from db {group}")
-            dbsession.delete(result)
-            dbsession.commit()    
-                    
-        # table: ovpn_clients 
-        logger.debug("- Check the ovpn_clients table, ovpn clients: test1-1000") 
-        logger.debug("- Check the ovpn_clients table now")
-        for i in range(1, Stress_Num*2+1):
-            site_name = 'test{}'.format(str(i))
-            results = dbsession.scalars(select(OvpnClients).where(OvpnClients.site_name == site_name))
-            if results:
-                for result in results:
-                    logger.debug("Delete test client site_name: {}".format(site_name))
-                    dbsession.delete(result)
-                    dbsession.commit()
-
-        # table: ovpn_servers
-        logger.debug("- Check the ovpn_servers table, ovpn service: test1-2 ")
-        logger.info("- Check the ovpn_servers table now")
-        for i in range(1, 3):
-            service = "test{}".format(str(i))
-            results = dbsession.scalars(select(OvpnServers).where(OvpnServers.server_name == service))
-            if results:
-                for result in results:
-                    logger.debug("Delete test ovpn service: {}".format(service))
-                    dbsession.delete(result)
-                    dbsession.commit()
-                                        
+        logger.info("- Delete the test users, ovpn servers and clients: {} {}".format(users, servers))
+        TestDataSeeder(users, servers, clients).delete()
         logger.info("Test data deleted done!")
 
     
     logger.info("##############################################################")
     logger.info("Check ovpn certs test files.")
-    cert_root = dbsession.scalar(select(OfSystemConfig).where(OfSystemConfig.item == "DIR_CERT_ROOT")).ivalue.strip()
+    cert_root = SystemConfig.get("DIR_CERT_ROOT")
     logger.debug(f"Certs root: {cert_root}")
     system_type = platform.system()
     logger.debug(f"System: {system_type}")
@@ -282,7 +318,7 @@ def prepare_data(action="add"):
     if action == "add":
         """Add cert test files."""    
         logger.info("Check ovpn certs test files.")
-        cert_root = dbsession.scalar(select(OfSystemConfig).where(OfSystemConfig.item == "DIR_CERT_ROOT")).ivalue.strip()
+        cert_root = SystemConfig.get("DIR_CERT_ROOT")
         logger.debug(f"Certs root: {cert_root}")
         system_type = platform.system()
         logger.debug(f"System: {system_type}")
@@ -290,16 +326,16 @@ def prepare_data(action="add"):
             cert_root = "D:/tmp/ovpn_flask"
             logger.debug(f"Set certs root DIR: {cert_root}")
             
-        for i in range(1, 3):
-            logger.debug(f"OpenVPN Service test{i}...")
-            server_name = f'test{i}'
-            ovpn_service = dbsession.scalar(select(OvpnServers).where(OvpnServers.server_name == server_name))
+        # the servers the seeder added, whatever --servers was
+        server_names = TestDataSeeder(users, servers, clients).server_names()
+        for ovpn_service in dbsession.scalars(select(OvpnServers).where(OvpnServers.server_name.in_(server_names))).all():
+            logger.debug(f"OpenVPN Service {ovpn_service.server_name}...")
             certs_dir = ovpn_service.certs_dir
             server_id = ovpn_service.id
-            dir_reqs = dbsession.scalar(select(OfSystemConfig).where(OfSystemConfig.item == "DIR_REQS")).ivalue.strip()
-            dir_plain_certs = dbsession.scalar(select(OfSystemConfig).where(OfSystemConfig.item == "DIR_PLAIN_CERTS")).ivalue.strip()
-            dir_encrypts_certs = dbsession.scalar(select(OfSystemConfig).where(OfSystemConfig.item == "DIR_ENCRYPT_CERTS")).ivalue.strip()
-            dir_zip_certs = dbsession.scalar(select(OfSystemConfig).where(OfSystemConfig.item == "DIR_ZIP_CERTS")).ivalue.strip()
+            dir_reqs = SystemConfig.get("DIR_REQS")
+            dir_plain_certs = SystemConfig.get("DIR_PLAIN_CERTS")
+            dir_encrypts_certs = SystemConfig.get("DIR_ENCRYPT_CERTS")
+            dir_zip_certs = SystemConfig.get("DIR_ZIP_CERTS")
             
             clients_us = dbsession.scalars(select(OvpnClients).where(OvpnClients.server_id == server_id))    
                          
@@ -342,13 +378,9 @@ def prepare_data(action="add"):
         logger.info("Check ovpn certs test dirs to delete them.")
         t_path=pathlib.Path(cert_root)
         if t_path.exists():
-            rm_tree(t_path)
-        
-def rm_tree(pth):
-    for child in pth.iterdir():
-        if child.is_file():
-            logger.debug("Delete file: " + child.absolute().as_posix())
-            child.unlink()
-        else:
-            rm_tree(child)
-    pth.rmdir()
+            remove_tree(t_path)
+
+    # test clients were added or deleted, drop the cached clients list totals
+    from common.utils.bp_ovpn.pagination import invalidate_clients_cache
+    invalidate_clients_cache()
+
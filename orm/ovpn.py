@@ -9,7 +9,7 @@ import uuid
 from sqlalchemy import UniqueConstraint
 
 from sqlalchemy import Boolean, Column, DateTime, Float, ForeignKey, ForeignKeyConstraint, Integer, \
-    SmallInteger, Text, UniqueConstraint, text, Numeric, Date, Time
+    SmallInteger, Text, UniqueConstraint, text, Numeric, Date, Time, Index
 from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.orm import relationship
 from sqlalchemy.ext.declarative import declarative_base
@@ -149,7 +149,16 @@ class OvpnClients(Base):
     __table_args__ = (
         UniqueConstraint('cn'),
         UniqueConstraint("server_id", "site_name"),
+        # keyset pagination of the clients list, one per sortable column
+        Index("ix_ovpn_clients_server_site_name", "server_id", text("coalesce(site_name, '')"), "id"),
+        Index("ix_ovpn_clients_server_cn", "server_id", "cn", "id"),
+        Index("ix_ovpn_clients_server_ip", "server_id", "ip", "id"),
+        Index("ix_ovpn_clients_server_toggle_time", "server_id", "toggle_time", "id"),
+        Index("ix_ovpn_clients_server_expire_date", "server_id", "expire_date", "id"),
+        Index("ix_ovpn_clients_server_status", "server_id", "status", "id"),
     )
+    # trigram indexes of the clients search, created by check_db_integrity if pg_trgm is available
+    SEARCH_COLUMNS = ("site_name", "cn", "ip")
     
     id: Mapped[UUID] = mapped_column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
     server_id: Mapped[UUID] = mapped_column(
@@ -242,4 +251,35 @@ class OfSystemConfig(Base):
     # id: Mapped[UUID] = mapped_column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)   
     item: Mapped[str] = mapped_column(String(50), primary_key=True)
     ivalue: Mapped[str] = mapped_column(String(200), nullable=True)
-    category: Mapped[str] = mapped_column(String(50), default='dedicated')
\ No newline at end of file
+    category: Mapped[str] = mapped_column(String(50), default='dedicated')
+
+class OvpnJobs(Base):
+    """
+    Background job model, the certificate generation scripts run by the job queue
+    """
+    __tablename__ = "ovpn_jobs"
+    __table_args__ = (
+        # the queued jobs are claimed oldest first
+        Index("ix_ovpn_jobs_status_create_time", "status", "create_time"),
+    )
+    STATUS_CHOICE = {0: "queued", 1: "running", 2: "done", 3: "failed"}
+
+    id: Mapped[UUID] = mapped_column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
+    kind: Mapped[str] = mapped_column(String(50))
+    # the easyrsa files dir the job writes to, the concurrency is capped per pki
+    pki: Mapped[str] = mapped_column(String(200))
+    args: Mapped[list] = mapped_column(JSONB, default=list)
+    status: Mapped[int] = mapped_column(ChoiceType(STATUS_CHOICE), default=0)
+    returncode: Mapped[int] = mapped_column(Integer, nullable=True)
+    log: Mapped[str] = mapped_column(Text, default='')
+    # job specific data, e.g. the reqs of a batch and its package
+    meta: Mapped[dict] = mapped_column(JSONB, nullable=True)
+    created_by: Mapped[str] = mapped_column(String(100), nullable=True)
+    create_time: Mapped[datetime.datetime] = mapped_column(
+        DateTime(timezone=True), server_default=func.now()
+    )
+    start_time: Mapped[datetime.datetime] = mapped_column(DateTime(timezone=True), nullable=True)
+    finish_time: Mapped[datetime.datetime] = mapped_column(DateTime(timezone=True), nullable=True)
+
+    def toDict(self):
+        return {c.name: getattr(self, c.name) for c in self.__table__.columns}
@@ -48,6 +48,12 @@ $(document).ready(function() {
         return [year, month, day].join('-') + "_" + [hour, min, sec].join(':');
     };
 
+    // text of an html attribute or element, the values come from the clients
+    function escapeHtml(value) {
+        return String(value).replace(/&/g, "&amp;").replace(/</g, "&lt;").replace(/>/g, "&gt;")
+            .replace(/"/g, "&quot;").replace(/'/g, "&#39;");
+    };
+
     /*
        nav highlight when a.href == location.pathname
    */
@@ -79,6 +85,22 @@ $(document).ready(function() {
     /* **********************************************
         OpenVPN serivces overview page functions
     ********************************************** */
+    // running dots of the servers page, from the batch probe of servers/status
+    function refreshServerStatuses(force) {
+        $.getJSON(window.servers_status_url, force ? { 'force': 1 } : {}, function(statuses) {
+            $(".server_running_status").each(function() {
+                var s_uuid = $.trim($(this).closest('tr').children("th").first().text());
+                if (s_uuid in statuses) {
+                    $(this).toggleClass("text-green", statuses[s_uuid] == 1).toggleClass("text-red", statuses[s_uuid] != 1);
+                }
+            });
+        });
+    };
+
+    if (window.servers_status_url && $(".server_running_status").length) {
+        setInterval(function() { refreshServerStatuses(false); }, 30000);
+    }
+
     // Post to stop an OpenVPN service
     $('tbody').on('click', '.stop_ovpn_service', function() {
         // alert("debug");
@@ -97,6 +119,8 @@ $(document).ready(function() {
             // $tr.find(".server_running_status").addClass("text-green").removeClass("text-red");
             if (result['result'] == 'success') {
                 current_ob.removeClass("text-green").addClass("text-red");
+                // the service may take a moment to stop
+                setTimeout(function() { refreshServerStatuses(true); }, 3000);
             }
             appendAlert(result['message'], result['result']);
         });
@@ -120,6 +144,8 @@ $(document).ready(function() {
             // $tr.find(".server_running_status").addClass("text-red").removeClass("text-green");
             if (result['result'] == 'success') {
                 current_ob.removeClass("text-red").addClass("text-green");
+                // the service may fail right after its start
+                setTimeout(function() { refreshServerStatuses(true); }, 3000);
             }
             appendAlert(result['message'], result['result']);
         });
@@ -222,6 +248,13 @@ $(document).ready(function() {
                 "render": function(data, type, row) {
                     // console.log(data[5]);
                     var html = data["status"] ? "<i class='fa fa-circle text-green'></i>" : "<i class='fa fa-circle text-red'></i>";
+                    // live info from the openvpn management interface
+                    if (data["real_address"]) {
+                        var title = "From: " + escapeHtml(data["real_address"]) +
+                            "&#10;Since: " + formatTime(new Date(data["connected_since"])) +
+                            "&#10;Rx/Tx: " + escapeHtml(data["bytes_received"]) + "/" + escapeHtml(data["bytes_sent"]) + " bytes";
+                        html = "<span title='" + title + "'>" + html + "</span>";
+                    }
                     return html;
                 }
             },
@@ -277,6 +310,38 @@ $(document).ready(function() {
         }
     });
 
+    // reload the clients table when a client of this service connects or disconnects
+    if (window.EventSource && $("#tb_openvpn_clients").length) {
+        var clients_reload_timer = null;
+        var clients_events = new EventSource("../events");
+        clients_events.addEventListener("clients", function(e) {
+            var current_uuid = $("#tb_openvpn_clients:first").data("openvpn_service_uuid");
+            var changed = JSON.parse(e.data).some(function(ev) { return ev.server_id == current_uuid; });
+            if (changed && !clients_reload_timer) {
+                // one reload for a burst of events, keep the current page
+                clients_reload_timer = setTimeout(function() {
+                    clients_reload_timer = null;
+                    tb_openvpn_clients.ajax.reload(null, false);
+                }, 2000);
+            }
+        });
+        // refused over the streams limit of the server process: poll instead
+        clients_events.onerror = function() {
+            if (clients_events.readyState === EventSource.CLOSED) {
+                setInterval(function() { tb_openvpn_clients.ajax.reload(null, false); }, 30000);
+            }
+        };
+        // the proxy config changes are applied by a delayed graceful reload
+        clients_events.addEventListener("proxy", function(e) {
+            var status = JSON.parse(e.data);
+            if (status.ok) {
+                appendAlert("Apache proxy config reloaded.", "success");
+            } else {
+                appendAlert("Apache proxy reload failed: " + status.output, "danger");
+            }
+        });
+    }
+
     $('#tunclientStatusModal').on('shown.bs.modal',
         function(e) {
             storename = $(e.relatedTarget).parent().parent().children(".dtr-control").text();
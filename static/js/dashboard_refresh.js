@@ -1,4 +1,19 @@
 $(document).ready(function() {
+    // inline svg sparkline of a series of numbers
+    function sparkline(selector, values, max) {
+        var $el = $(selector);
+        if (!$el.length || !values || values.length < 2) {
+            return;
+        }
+        var width = 120, height = 24;
+        max = max || Math.max.apply(null, values) || 1;
+        var step = width / (values.length - 1);
+        var points = values.map(function(v, i) {
+            return (i * step).toFixed(1) + "," + (height - Math.min(v / max, 1) * height).toFixed(1);
+        }).join(" ");
+        $el.html("<svg width='" + width + "' height='" + height + "'><polyline fill='none' stroke='currentColor' stroke-width='1.5' points='" + points + "'/></svg>");
+    };
+
     function ds_refresh() {
         /**
         {"system_info":
@@ -28,24 +43,73 @@ $(document).ready(function() {
             $("#db_cpu_cores").text(system_info.cpu_cores);
             $("#db_system_uptime").text(system_info.system_uptime);
             $("#db_system_time").text(system_info.system_time);
-            $("#db_db_load_avg0").text(system_info.load_avg[0]);
-            $("#db_db_load_avg1").text(system_info.load_avg[1]);
-            $("#db_db_load_avg2").text(system_info.load_avg[2]);
-            $("#db_memory").html("Memory <b>" + system_info.memory_used + "</b>/" + system_info.memory_total + " MB - " + system_info.memory_percent + " %");
-            $("#db_swap").html("Swap <b>" + system_info.swap_used + "</b>/" + system_info.swap_total + " MB - " + system_info.swap_percent + " %");
             $("#db_openvpn_version").text(system_info.openvpn_version);
             $("#db_system_information").text(system_info.system_information);
+            render_metrics(system_info);
 
-            var memory_percent = parseFloat(system_info.memory_percent).toFixed(1);
-            $('#memory_progressBar').css('width', memory_percent.toString() + '%');
-            $('#momery_progressBar').html(memory_percent.toString() + '%');
-
-            var swap_percent = parseFloat(system_info.swap_percent).toFixed(1);
-            $('#swap_progressBar').css('width', swap_percent.toString() + '%');
-            $('#swap_progressBar').html(swap_percent.toString() + '%');
+            // history sampled by the server in the background
+            if (result.history) {
+                history = result.history;
+                render_sparklines();
+            }
         });
     };
 
-    setInterval(ds_refresh, 10000);
+    // the values of one sample of the server side system sampler
+    function render_metrics(m) {
+        $("#db_db_load_avg0").text(m.load_avg[0]);
+        $("#db_db_load_avg1").text(m.load_avg[1]);
+        $("#db_db_load_avg2").text(m.load_avg[2]);
+        $("#db_cpu_percent").text(m.cpu_percent);
+        $("#db_memory").html("Memory <b>" + m.memory_used + "</b>/" + m.memory_total + " MB - " + m.memory_percent + " %");
+        $("#db_swap").html("Swap <b>" + m.swap_used + "</b>/" + m.swap_total + " MB - " + m.swap_percent + " %");
+
+        var memory_percent = parseFloat(m.memory_percent).toFixed(1);
+        $('#memory_progressBar').css('width', memory_percent.toString() + '%');
+        $('#momery_progressBar').html(memory_percent.toString() + '%');
+
+        var swap_percent = parseFloat(m.swap_percent).toFixed(1);
+        $('#swap_progressBar').css('width', swap_percent.toString() + '%');
+        $('#swap_progressBar').html(swap_percent.toString() + '%');
+    };
+
+    var history = null;
+    var history_size = 120;
+
+    function render_sparklines() {
+        sparkline("#db_cpu_sparkline", history.cpu_percent, 100);
+        sparkline("#db_memory_sparkline", history.memory_percent, 100);
+        sparkline("#db_swap_sparkline", history.swap_percent, 100);
+        sparkline("#db_load_sparkline", history.load_avg.map(function(l) { return l[0]; }));
+    };
+
+    ds_refresh();
+    if (window.EventSource) {
+        // metrics pushed by the server, the full refresh is only needed for the uptime/time now
+        var source = new EventSource("events");
+        source.addEventListener("metrics", function(e) {
+            var m = JSON.parse(e.data);
+            render_metrics(m);
+            if (history && history.time[history.time.length - 1] != m.time) {
+                ["time", "cpu_percent", "memory_percent", "swap_percent", "load_avg"].forEach(function(key) {
+                    history[key].push(m[key]);
+                    if (history[key].length > history_size) {
+                        history[key].shift();
+                    }
+                });
+                render_sparklines();
+            }
+        });
+        var refresh_timer = setInterval(ds_refresh, 60000);
+        // refused over the streams limit of the server process: poll instead
+        source.onerror = function() {
+            if (source.readyState === EventSource.CLOSED) {
+                clearInterval(refresh_timer);
+                refresh_timer = setInterval(ds_refresh, 10000);
+            }
+        };
+    } else {
+        setInterval(ds_refresh, 10000);
+    }
 
 });
\ No newline at end of file
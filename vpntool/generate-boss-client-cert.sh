@@ -38,11 +38,10 @@ FILES_DIR=$3
 export OPENSSL=/usr/bin/openssl
 export EASYRSACMD=${OVPN_DIR}/easyrsa/easyrsa
 
-export REQDIR=${OVPN_DIR}/reqs
-
 export BACKUPDIR=${OVPN_DIR}/easyrsa-all
 export TOOLDIR=${OVPN_DIR}/easyrsa
-export REQDIR=${OVPN_DIR}/reqs
+# the job queue passes the own req dir of each job, see cert_batch.make_req_dir
+export REQDIR=${REQDIR:-${OVPN_DIR}/reqs}
 export REQDONEDIR=${OVPN_DIR}/reqs-done
 
 if ! [[ -r ${OPENSSL} ]]; then